@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks for the Lada Modal pipeline (needs local ffmpeg, no GPU)
+
+A local directory stands in for the volume (use_local_volume) and lada-cli
+is replaced by a stub with configurable speed, so split, merge and
+scheduling overhead can be measured without spending GPU money.
+
+Imports helpers from lada_modal_v7_dev.py, so the modal package must be
+installed (it is in .venv312).
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).parent
+sys.path.insert(0, str(SCRIPT_DIR))
+
+import lada_modal_v7_dev as pipeline  # noqa: E402
+
+# 用于替换 lada-cli 的 stub：打印与 lada-cli 相同格式的进度并复制输入
+STUB_LADA_CLI = r'''
+import argparse, os, shutil, subprocess, sys, time
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--input")
+parser.add_argument("--output")
+args, _ = parser.parse_known_args()
+
+fps = float(os.environ.get("LADA_STUB_FPS", "300"))
+startup = float(os.environ.get("LADA_STUB_STARTUP", "0"))
+probe = subprocess.run(["ffprobe", "-v", "error", "-select_streams", "v:0", "-count_packets",
+                        "-show_entries", "stream=nb_read_packets", "-of", "csv=p=0", args.input],
+                       capture_output=True, text=True)
+frames = int(probe.stdout.strip() or 0)
+
+time.sleep(startup)
+start = time.time()
+for pct in range(0, 101, 5):
+    done = frames * pct // 100
+    elapsed = max(time.time() - start, 1e-6)
+    print(f"Processing video: {pct:3d}%|##| {done}/{frames} [00:00<00:00, {done / elapsed:.2f}frames/s]",
+          flush=True)
+    if pct < 100:
+        time.sleep(frames / fps / 20)
+shutil.copyfile(args.input, args.output)
+'''
+
+
+def make_synthetic_video(path: Path, seconds: float, size: str = "640x360", fps: int = 30, gop: int = 60):
+    """Generate a test video (testsrc2 + sine audio) with lavfi sources"""
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size={size}:rate={fps}",
+        "-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000",
+        "-t", str(seconds),
+        "-c:v", "libx264", "-preset", "ultrafast", "-g", str(gop),
+        "-c:a", "aac", "-shortest",
+        str(path), "-y",
+    ]
+    subprocess.run(cmd, check=True)
+
+
+def to_ts(src: Path, dst: Path, offset: float):
+    """Remux to MPEG-TS with a timestamp offset (what restore_video does with container=ts)"""
+    subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", str(src), "-map", "0", "-c", "copy",
+         "-output_ts_offset", f"{offset:.3f}", "-f", "mpegts", str(dst), "-y"],
+        check=True,
+    )
+
+
+class LocalDict(dict):
+    """modal.Dict stand-in (put/get/pop/items)"""
+
+    def put(self, key, value):
+        self[key] = value
+
+
+class LocalVolume:
+    """modal.Volume stand-in: a local directory needs no reload/commit"""
+
+    def reload(self):
+        pass
+
+    def commit(self):
+        pass
+
+
+def use_local_volume(root: Path):
+    """Point the pipeline at a local directory instead of the Modal volume
+
+    The pipeline builds every volume path from VOLUME_PATH at call time, so
+    this only swaps the root and the Modal objects for in-process stand-ins.
+    """
+    pipeline.VOLUME_PATH = str(root)
+    pipeline.volume = LocalVolume()
+    pipeline.catalog, pipeline.job_registry, pipeline.job_queue = LocalDict(), LocalDict(), LocalDict()
+
+
+def install_stub(root: Path, fps: float, startup: float = 0.0):
+    """Point the pipeline's lada-cli at the stub"""
+    stub = root / "stub_lada_cli.py"
+    stub.write_text(STUB_LADA_CLI, encoding="utf-8")
+    os.environ["LADA_STUB_FPS"] = str(fps)
+    os.environ["LADA_STUB_STARTUP"] = str(startup)
+    pipeline.LADA_CLI = [sys.executable, str(stub)]
+
+
+def bench_merge(counts=(10, 100, 1000), segment_seconds: float = 2.0, work_dir: str = ""):
+    """Compare concat-demuxer remux against TS byte append for N segments"""
+    root = Path(work_dir or tempfile.mkdtemp(prefix="lada_bench_"))
+    root.mkdir(parents=True, exist_ok=True)
+    source = root / "segment.mp4"
+    make_synthetic_video(source, segment_seconds)
+
+    print(f"{'segments':>8} {'concat mp4':>12} {'append->mp4':>12} {'append->ts':>12} {'output MB':>10}")
+    rows = []
+    for count in counts:
+        case_dir = root / f"n{count}"
+        case_dir.mkdir(exist_ok=True)
+        mp4_paths, ts_paths = [], []
+        for i in range(count):
+            mp4 = case_dir / f"v_part{i:04d}_restored.mp4"
+            ts = case_dir / f"v_part{i:04d}_restored.ts"
+            shutil.copyfile(source, mp4)
+            to_ts(source, ts, i * segment_seconds)
+            mp4_paths.append(str(mp4))
+            ts_paths.append(str(ts))
+
+        timings = {}
+        start = time.time()
+        pipeline.concat_merge(mp4_paths, str(case_dir / "concat.mp4"), str(case_dir / "list.txt"))
+        timings["concat"] = time.time() - start
+
+        start = time.time()
+        pipeline.append_merge(ts_paths, str(case_dir / "append.mp4"))
+        timings["append_mp4"] = time.time() - start
+
+        start = time.time()
+        pipeline.append_merge(ts_paths, str(case_dir / "append.ts"))
+        timings["append_ts"] = time.time() - start
+
+        size_mb = (case_dir / "concat.mp4").stat().st_size / (1024 * 1024)
+        print(f"{count:>8} {timings['concat']:>11.2f}s {timings['append_mp4']:>11.2f}s "
+              f"{timings['append_ts']:>11.2f}s {size_mb:>10.1f}")
+        rows.append({"segments": count, "output_mb": round(size_mb, 1), **timings})
+        shutil.rmtree(case_dir)
+
+    if not work_dir:
+        shutil.rmtree(root)
+    return rows
+
+
+def bench_split(lengths=(60, 600), sizes=("640x360", "1280x720"), gops=(30, 250), segments: int = 10):
+    """Plan + stream-copy split time across length, resolution and GOP size"""
+    root = Path(tempfile.mkdtemp(prefix="lada_bench_"))
+    print(f"{'length':>7} {'size':>10} {'gop':>5} {'plan':>8} {'split':>8} {'segments':>9} {'spread':>8}")
+    rows = []
+    try:
+        for length in lengths:
+            for size in sizes:
+                for gop in gops:
+                    case_dir = root / f"{length}_{size}_{gop}"
+                    case_dir.mkdir()
+                    source = case_dir / "v.mp4"
+                    make_synthetic_video(source, length, size=size, gop=gop)
+
+                    start = time.time()
+                    plan = pipeline.plan_split(str(source), length / segments / 60)
+                    plan_seconds = time.time() - start
+
+                    start = time.time()
+                    pipeline.split_at_cuts(str(source), str(case_dir / "v_part%03d.mp4"), plan["cuts"])
+                    split_seconds = time.time() - start
+
+                    durations = [s["duration"] for s in plan["segments"]]
+                    spread = max(durations) / max(min(durations), 1e-6)
+                    print(f"{length:>6}s {size:>10} {gop:>5} {plan_seconds:>7.2f}s {split_seconds:>7.2f}s "
+                          f"{len(durations):>9} {spread:>7.2f}x")
+                    rows.append({"length": length, "size": size, "gop": gop, "plan": plan_seconds,
+                                 "split": split_seconds, "segments": len(durations), "spread": spread})
+                    shutil.rmtree(case_dir)
+    finally:
+        shutil.rmtree(root)
+    return rows
+
+
+def bench_schedule(counts=(10, 100, 1000, 2000), max_parallel: int = 10, work_seconds: float = 0.01):
+    """Scheduler overhead and scaling with a fake in-process restore_video"""
+    def fake_restore(segment):
+        started_at = time.time()
+        time.sleep(work_seconds)
+        return {"status": "success", "file": segment, "started_at": started_at, "cold_start": False}
+
+    print(f"{'segments':>8} {'parallel':>8} {'makespan':>10} {'ideal':>8} {'overhead/seg':>13}")
+    rows = []
+    for count in counts:
+        controller = pipeline.ConcurrencyController(max_parallel)
+        executor = pipeline.CallableExecutor(fake_restore, controller.maximum)
+        start = time.time()
+        done = sum(1 for _ in pipeline.run_segments([f"s{i:05d}" for i in range(count)], executor, controller))
+        makespan = time.time() - start
+        executor.shutdown()
+        ideal = -(-count // max_parallel) * work_seconds
+        overhead = (makespan - ideal) / max(done, 1)
+        print(f"{count:>8} {max_parallel:>8} {makespan:>9.2f}s {ideal:>7.2f}s {overhead * 1000:>11.2f}ms")
+        rows.append({"segments": count, "makespan": makespan, "ideal": ideal, "overhead_per_segment": overhead})
+    return rows
+
+
+def bench_pipeline(length: float = 120, segments: int = 12, max_parallel: int = 4, stub_fps: float = 300,
+                   container: str = "mp4"):
+    """Full split -> stub restore -> merge through the pipeline's own job path
+
+    use_local_volume points the volume at a temp directory, so open_job,
+    restore_segment (staging, cache, history), the job ledger and merge_job
+    run unchanged; only lada-cli is the stub.
+    """
+    root = Path(tempfile.mkdtemp(prefix="lada_bench_"))
+    use_local_volume(root)
+    (root / "input").mkdir()
+    install_stub(root, stub_fps)
+    codec, crf, detection, max_clip_length = "libx264", 20, "v4-fast", 900
+    filename = "v.mp4"
+    timings = {}
+    try:
+        make_synthetic_video(root / "input" / filename, length)
+
+        start = time.time()
+        params = pipeline.job_params(filename, round(length / segments / 60, 4), codec, crf, detection,
+                                     max_clip_length, False, container)
+        ledger, plan = pipeline.open_job(filename, params, max_parallel)
+        timings["split"] = time.time() - start
+
+        starts = {s["file"]: s["start"] for s in plan["segments"]}
+        frames = {s["file"]: s.get("frames", 0) for s in plan["segments"]}
+
+        def restore(segment):
+            return pipeline.restore_segment(segment, codec, crf, detection, max_clip_length, True,
+                                            container, starts[segment])
+
+        controller = pipeline.ConcurrencyController(max_parallel)
+        executor = pipeline.CallableExecutor(restore, controller.maximum)
+        results = []
+        start = time.time()
+        for seg, result in pipeline.run_segments(ledger.pending(), executor, controller, frames):
+            if not pipeline.record_segment(ledger, seg, result):
+                raise RuntimeError(f"Segment {seg} failed: {result.get('error', '')}")
+            results.append(result)
+        timings["restore"] = time.time() - start
+        executor.shutdown()
+        report = pipeline.job_report(results)
+        ideal = max(report["gpu_seconds"] / max_parallel, max(r["metrics"]["total_seconds"] for r in results))
+        timings["scheduling_overhead"] = timings["restore"] - ideal
+        timings["volume_io"] = sum(r["metrics"]["volume_io_seconds"] for r in results)
+
+        _, timings["merge"] = pipeline.merge_job(ledger, filename, detection, container)
+    finally:
+        shutil.rmtree(root)
+
+    print(f"Pipeline: {length:.0f}s video, {len(plan['segments'])} segments, "
+          f"max_parallel {max_parallel}, stub {stub_fps} fps, container {container}")
+    for stage, seconds in timings.items():
+        print(f"  {stage:<20} {seconds:>8.2f}s")
+    return timings
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage:")
+        print("  python benchmark.py merge [10,100,1000]          # concat vs TS append merge")
+        print("  python benchmark.py split                        # plan + split by length/size/GOP")
+        print("  python benchmark.py schedule [10,100,1000,2000]  # scheduler overhead and scaling")
+        print("  python benchmark.py pipeline [mp4|ts]            # split -> stub lada-cli -> merge")
+        print("  python benchmark.py all")
+        return
+
+    action = sys.argv[1]
+    counts = [int(c) for c in sys.argv[2].split(",")] if len(sys.argv) > 2 and sys.argv[2][0].isdigit() else None
+
+    if action == "merge":
+        bench_merge(counts or [10, 100, 1000])
+
+    elif action == "split":
+        bench_split()
+
+    elif action == "schedule":
+        bench_schedule(counts or [10, 100, 1000, 2000])
+
+    elif action == "pipeline":
+        bench_pipeline(container=sys.argv[2] if len(sys.argv) > 2 else "mp4")
+
+    elif action == "all":
+        bench_split()
+        bench_schedule()
+        bench_merge()
+        bench_pipeline()
+        bench_pipeline(container="ts")
+
+    else:
+        print(f"Unknown benchmark: {action}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,77 @@
 # -*- coding: utf-8 -*-
 """
 Download restored videos from Modal Volume
+
+Transfers go through the download_file web endpoint: several files at once,
+large files split into byte ranges fetched in parallel, partial files resumed
+after a disconnect, and files that already match (size + sha256) skipped.
+`modal volume get` is only used when the endpoint URL cannot be resolved.
 """
 
+import json
+import os
 import subprocess
 import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+from manifest import file_sha256, load_manifest, manifest_lock, save_manifest
+
 # Get modal.exe path from .venv312
 SCRIPT_DIR = Path(__file__).parent
 MODAL_EXE = SCRIPT_DIR / ".venv312" / "Scripts" / "modal.exe"
 
+APP_NAME = "lada-restore-v7-dev"
+# 可用环境变量直接指定 download_file 的 URL，省去查询
+ENDPOINT_ENV = "LADA_DOWNLOAD_URL"
+CHUNK_SIZE = 64 * 1024 * 1024
+FILE_WORKERS = 4
+RANGE_WORKERS = 4
+RETRIES = 3
+
+_endpoint = {}
+
+
+class RemoteChanged(Exception):
+    """The remote file changed while a ranged download was in progress"""
+
+
+def endpoint_url() -> str:
+    """URL of the download_file endpoint ("" if it cannot be resolved)"""
+    if "url" not in _endpoint:
+        url = os.environ.get(ENDPOINT_ENV, "")
+        if not url:
+            try:
+                import modal
+                url = modal.Function.from_name(APP_NAME, "download_file").get_web_url() or ""
+            except Exception as e:
+                print(f"Download endpoint unavailable ({e}), falling back to modal volume get")
+        _endpoint["url"] = url
+    return _endpoint["url"]
+
+
+def http_json(params: dict) -> dict:
+    url = f"{endpoint_url()}?{urllib.parse.urlencode(params)}"
+    with urllib.request.urlopen(url, timeout=120) as response:
+        return json.load(response)
+
 
 def list_output_files():
     """List output files in Volume (sorted to match display order)"""
-    import json
-    
+    if endpoint_url():
+        return [f["name"] for f in list_remote_files()]
+
     cmd = [str(MODAL_EXE), "volume", "ls", "lada-videos", "/output", "--json"]
     result = subprocess.run(cmd, capture_output=True, text=True)
-    
+
     if result.returncode != 0:
         print("Failed to list files")
         return []
-    
+
     try:
         data = json.loads(result.stdout)
         # Get filenames and sort them to match Modal's display order
@@ -32,17 +81,129 @@ def list_output_files():
         return []
 
 
+def list_remote_files() -> list:
+    """All output entries ({"name", "size", "mtime"}) from the paginated endpoint listing"""
+    files, offset = [], 0
+    while offset is not None:
+        page = http_json({"offset": offset, "limit": 1000})
+        files.extend(page["files"])
+        offset = page["next"]
+    return files
+
+
+def fetch_range(name: str, part_path: Path, start: int, end: int, etag: str) -> int:
+    """Fetch bytes [start, end] into part_path at the same offset; returns bytes written"""
+    url = f"{endpoint_url()}?{urllib.parse.urlencode({'filename': name})}"
+    request = urllib.request.Request(url, headers={"Range": f"bytes={start}-{end}", "If-Range": etag})
+    written = 0
+    with urllib.request.urlopen(request, timeout=120) as response:
+        if response.status != 206:
+            # If-Range 不匹配时服务端返回 200 完整文件
+            raise RemoteChanged(name)
+        with open(part_path, "r+b") as f:
+            f.seek(start)
+            for block in iter(lambda: response.read(1024 * 1024), b""):
+                f.write(block)
+                written += len(block)
+    if written != end - start + 1:
+        raise IOError(f"Short read for {name} bytes {start}-{end}: {written}")
+    return written
+
+
+def fetch_range_with_retry(name: str, part_path: Path, start: int, end: int, etag: str) -> int:
+    for attempt in range(1, RETRIES + 1):
+        try:
+            return fetch_range(name, part_path, start, end, etag)
+        except RemoteChanged:
+            raise
+        except (OSError, IOError) as e:
+            if attempt == RETRIES:
+                raise
+            print(f"  Retry {attempt}/{RETRIES - 1} {name} [{start}-{end}]: {e}")
+            time.sleep(2 ** attempt)
+
+
+def remote_etag(name: str) -> str:
+    url = f"{endpoint_url()}?{urllib.parse.urlencode({'filename': name})}"
+    request = urllib.request.Request(url, headers={"Range": "bytes=0-0"})
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            return response.headers.get("ETag", "")
+    except urllib.error.HTTPError as e:
+        # 空文件的 Range 请求返回 416，同样带 ETag
+        return e.headers.get("ETag", "")
+
+
+def download_http(remote: dict, local_dir: Path, manifest: dict, range_workers: int = RANGE_WORKERS,
+                  verify: bool = True) -> tuple:
+    """Download one output file over ranged HTTP; returns (status, bytes transferred)
+
+    The .part file is preallocated and chunks land at their own offsets; the
+    .part.json sidecar records finished chunks and the ETag they came from,
+    so an interrupted download resumes with only the missing chunks.
+    """
+    name, size = remote["name"], remote["size"]
+    local_path = local_dir / name
+
+    if local_path.exists() and local_path.stat().st_size == size:
+        remote_sha = http_json({"filename": name, "checksum": "true"})["sha256"]
+        if file_sha256(local_path, manifest) == remote_sha:
+            return "skipped", 0
+        print(f"  Checksum differs, downloading again: {name}")
+
+    part_path = local_dir / (name + ".part")
+    state_path = local_dir / (name + ".part.json")
+    etag = remote_etag(name)
+    try:
+        with open(state_path, encoding="utf-8") as f:
+            state = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        state = {}
+    if state.get("etag") != etag or state.get("chunk") != CHUNK_SIZE or not part_path.exists():
+        state = {"etag": etag, "chunk": CHUNK_SIZE, "size": size, "done": []}
+        with open(part_path, "wb") as f:
+            f.truncate(size)
+    elif state["done"]:
+        print(f"  Resuming {name}: {len(state['done'])} chunks already on disk")
+
+    chunks = [(i, start, min(start + CHUNK_SIZE, size) - 1)
+              for i, start in enumerate(range(0, size, CHUNK_SIZE)) if i not in state["done"]]
+    transferred = 0
+    with ThreadPoolExecutor(max_workers=max(1, range_workers)) as pool:
+        futures = {pool.submit(fetch_range_with_retry, name, part_path, start, end, etag): i
+                   for i, start, end in chunks}
+        for future in as_completed(futures):
+            transferred += future.result()
+            state["done"].append(futures[future])
+            with open(state_path, "w", encoding="utf-8") as f:
+                json.dump(state, f)
+
+    if verify:
+        remote_sha = http_json({"filename": name, "checksum": "true"})["sha256"]
+        if file_sha256(part_path, manifest) != remote_sha:
+            state_path.unlink()
+            raise IOError(f"Checksum mismatch after download: {name}")
+        # 与 save_manifest 的 json.dump 并发时，改名必须持锁
+        with manifest_lock:
+            manifest[name] = manifest.pop(part_path.name)
+    # os.replace 保留 mtime，manifest 中记录的 stamp 仍然有效
+    os.replace(part_path, local_path)
+    if state_path.exists():
+        state_path.unlink()
+    return "downloaded", transferred
+
+
 def download_file(filename: str, local_dir: str = "."):
     """
     下载单个文件
-    
+
     Args:
         filename: Volume 中的文件名 (可能带 output/ 前缀)
         local_dir: 本地保存目录
     """
     local_dir = Path(local_dir)
     local_dir.mkdir(parents=True, exist_ok=True)
-    
+
     # 处理路径：ls 返回的文件名可能带 output/ 前缀
     if filename.startswith("output/"):
         remote_path = filename
@@ -50,11 +211,18 @@ def download_file(filename: str, local_dir: str = "."):
     else:
         remote_path = f"output/{filename}"
         local_filename = filename
-    
+
+    if endpoint_url():
+        remote = next((f for f in list_remote_files() if f["name"] == local_filename), None)
+        if not remote:
+            print(f"Failed: {remote_path} not found")
+            return False
+        return download_many([remote], local_dir)["failed"] == 0
+
     local_path = local_dir / local_filename
-    
+
     print(f"Downloading: {remote_path}")
-    
+
     cmd = [
         str(MODAL_EXE), "volume", "get",
         "lada-videos",
@@ -62,9 +230,9 @@ def download_file(filename: str, local_dir: str = "."):
         str(local_path),
         "--force",
     ]
-    
+
     result = subprocess.run(cmd)
-    
+
     if result.returncode == 0:
         print(f"Saved: {local_path}")
         return True
@@ -73,44 +241,90 @@ def download_file(filename: str, local_dir: str = "."):
         return False
 
 
-def download_all(local_dir: str = "./output"):
+def download_many(remotes: list, local_dir: Path, file_workers: int = FILE_WORKERS,
+                  range_workers: int = RANGE_WORKERS, verify: bool = True) -> dict:
+    """Download files concurrently and print an aggregate throughput summary"""
+    local_dir.mkdir(parents=True, exist_ok=True)
+    manifest = load_manifest(local_dir)
+    summary = {"downloaded": 0, "skipped": 0, "failed": 0, "bytes": 0}
+    start = time.time()
+
+    def one(remote):
+        return download_http(remote, local_dir, manifest, range_workers, verify)
+
+    with ThreadPoolExecutor(max_workers=max(1, file_workers)) as pool:
+        futures = {pool.submit(one, remote): remote for remote in remotes}
+        for i, future in enumerate(as_completed(futures), 1):
+            remote = futures[future]
+            try:
+                status, transferred = future.result()
+            except (OSError, IOError, RemoteChanged, KeyError) as e:
+                status, transferred = "failed", 0
+                print(f"[{i}/{len(remotes)}] Failed: {remote['name']} ({e})")
+            else:
+                label = "Skip (unchanged)" if status == "skipped" else "Saved"
+                print(f"[{i}/{len(remotes)}] {label}: {remote['name']} ({remote['size'] / (1024 * 1024):.1f} MB)")
+            summary[status] += 1
+            summary["bytes"] += transferred
+            save_manifest(local_dir, manifest)
+
+    elapsed = max(time.time() - start, 1e-6)
+    mb = summary["bytes"] / (1024 * 1024)
+    print(f"\nDownloaded: {summary['downloaded']}, skipped: {summary['skipped']}, failed: {summary['failed']}")
+    print(f"Transferred {mb:.1f} MB in {elapsed:.1f}s ({mb / elapsed:.1f} MB/s)")
+    summary["seconds"] = round(elapsed, 1)
+    return summary
+
+
+def download_all(local_dir: str = "./output", file_workers: int = FILE_WORKERS):
     """下载所有输出文件"""
+    if endpoint_url():
+        remotes = list_remote_files()
+        if not remotes:
+            print("No output files found")
+            return
+        print(f"Found {len(remotes)} files")
+        download_many(remotes, Path(local_dir), file_workers)
+        return
+
     files = list_output_files()
-    
+
     if not files:
         print("No output files found")
         return
-    
+
     print(f"Found {len(files)} files")
-    
+
     success = 0
     for f in files:
         if download_file(f, local_dir):
             success += 1
-    
+
     print(f"\nDownloaded: {success}/{len(files)}")
 
 
 def main():
     if len(sys.argv) < 2:
         print("Usage:")
-        print("  python download.py list          # List output files")
-        print("  python download.py all           # Download all")
-        print("  python download.py <filename>    # Download specific file")
+        print("  python download.py list                    # List output files")
+        print("  python download.py all [dir] [workers]     # Download all (skips unchanged files)")
+        print("  python download.py <filename> [dir]        # Download specific file")
+        print(f"  (set {ENDPOINT_ENV} to skip the endpoint lookup)")
         return
-    
+
     action = sys.argv[1]
-    
+
     if action == "list":
         files = list_output_files()
         print("Output files:")
         for f in files:
             print(f"  {f}")
-    
+
     elif action == "all":
         local_dir = sys.argv[2] if len(sys.argv) > 2 else "./output"
-        download_all(local_dir)
-    
+        workers = int(sys.argv[3]) if len(sys.argv) > 3 else FILE_WORKERS
+        download_all(local_dir, workers)
+
     else:
         # Support numeric index selection
         filename = action
@@ -126,7 +340,7 @@ def main():
             else:
                 print(f"Error: Invalid index {action}")
                 return
-        
+
         local_dir = sys.argv[2] if len(sys.argv) > 2 else "."
         download_file(filename, local_dir)
 
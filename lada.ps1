@@ -16,6 +16,7 @@ function Show-Menu {
     Write-Host "3. 从 URL 下载并修复"
     Write-Host "4. 查看修复结果 (Volume: /output)"
     Write-Host "5. 登录 Modal 账号"
+    Write-Host "6. 批量修复 (通配符匹配多个文件)"
     Write-Host "Q. 退出"
     Write-Host "==============================="
     Write-Host "使用环境: $venvPython" -ForegroundColor DarkGray
@@ -44,6 +45,13 @@ while ($true) {
         }
         "4" { Invoke-Expression "$m run $script --action output"; Pause }
         "5" { Invoke-Expression "$m setup"; Pause }
+        "6" {
+            Invoke-Expression "$m run $script --action input"
+            $pattern = Read-Host "请输入文件匹配模式 (例如 *.mp4, 默认 *)"
+            if (-not $pattern) { $pattern = "*" }
+            Invoke-Expression "$m run $script --action batch --pattern `"$pattern`""
+            Pause
+        }
         "q" { exit }
         "Q" { exit }
     }
@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
 """Lada Video Restore on Modal v7 DEV - Docker Based"""
 
+import re
+import time
+from typing import Union
+
 import modal
 
 image = (
@@ -10,18 +14,167 @@ image = (
 
 app = modal.App("lada-restore-v7-dev", image=image)
 volume = modal.Volume.from_name("lada-videos", create_if_missing=True)
+# 任务登记表：提交记录与进度快照，HTTP 状态查询无需读取 Volume
+job_registry = modal.Dict.from_name("lada-jobs", create_if_missing=True)
+# 文件目录索引：各阶段写文件时登记，本地 CLI 直接查询，无需启动容器
+catalog = modal.Dict.from_name("lada-catalog", create_if_missing=True)
+# 共享任务队列：所有提交路径在此登记，按加权公平份额分配 GPU 并发
+job_queue = modal.Dict.from_name("lada-queue", create_if_missing=True)
+# Volume 挂载点；所有路径都在调用时由它拼出（benchmark.py 会指向本地目录）
 VOLUME_PATH = "/data"
 MODEL_DIR = "/model_weights"
 
+DETECTION_MODELS = {
+    "v4-fast": "lada_mosaic_detection_model_v4_fast.pt",
+    "v4-accurate": "lada_mosaic_detection_model_v4_accurate.pt",
+    "fast": "lada_mosaic_detection_model_v3.1_fast.pt",
+    "accurate": "lada_mosaic_detection_model_v3.1_accurate.pt",
+    "v2": "lada_mosaic_detection_model_v2.pt",
+}
+RESTORATION_MODEL = "lada_mosaic_restoration_model_generic_v1.2.pth"
+# 命令前缀，离线基准测试中替换为 stub
+LADA_CLI = ["lada-cli"]
+
+# 容器级状态：用于区分冷启动与热容器调用
+CONTAINER_STATE = {"imported_at": time.time(), "calls": 0}
+
+
+CATALOG_VERSION = "_version"
+CATALOG_TTL = 60
+CATALOG_CACHE = "~/.lada_catalog.json"
+
+
+def catalog_status(subdir: str, name: str) -> str:
+    """Default status of a file found by a scan rather than registered by a stage"""
+    if subdir == "output":
+        return "segment" if re.search(r"_part\d+_restored", name) else "restored"
+    if subdir == "input":
+        return "segment" if re.search(r"_part\d+\.", name) else "uploaded"
+    return subdir
+
+
+def catalog_update(subdir: str, name: str, status: str = "", path: str = ""):
+    """Register one volume file in the catalog; best effort, never fails the calling stage
+
+    Stages call this right after writing a file: downloaded/uploaded or split
+    sources, segment and restored outputs, merged results.
+    """
+    import os
+
+    try:
+        stat = os.stat(path or f"{VOLUME_PATH}/{subdir}/{name}")
+        catalog.put(f"{subdir}/{name}", {"name": name, "size": stat.st_size, "mtime": round(stat.st_mtime, 1),
+                                         "status": status or catalog_status(subdir, name)})
+        catalog.put(CATALOG_VERSION, time.time())
+    except Exception as e:
+        print(f"Catalog update skipped for {subdir}/{name}: {e}")
+
+
+def catalog_entries(subdir: str) -> list:
+    """Every catalog entry of one volume directory, sorted by name"""
+    marker = f"{subdir}/"
+    return sorted((entry for key, entry in catalog.items() if key.startswith(marker)), key=lambda e: e["name"])
+
+
+def catalog_rebuild(subdir: str) -> list:
+    """Reconcile the catalog with a scan of one directory
+
+    Keeps the status of unchanged files, adds files written outside the
+    pipeline (modal volume put) and drops deleted ones.
+    """
+    import os
+
+    path = f"{VOLUME_PATH}/{subdir}"
+    known = {entry["name"]: entry for entry in catalog_entries(subdir)}
+    entries = []
+    if os.path.isdir(path):
+        with os.scandir(path) as items:
+            for item in items:
+                if not item.is_file() or item.name.endswith((".part", ".tmp")):
+                    continue
+                stat = item.stat()
+                entry = {"name": item.name, "size": stat.st_size, "mtime": round(stat.st_mtime, 1)}
+                old = known.pop(item.name, {})
+                entry["status"] = old.get("status") if (old.get("size"), old.get("mtime")) == (
+                    entry["size"], entry["mtime"]) else catalog_status(subdir, item.name)
+                if entry != old:
+                    catalog.put(f"{subdir}/{item.name}", entry)
+                entries.append(entry)
+    for name in known:
+        catalog.pop(f"{subdir}/{name}", None)
+    catalog.put(CATALOG_VERSION, time.time())
+    return sorted(entries, key=lambda e: e["name"])
+
+
+def catalog_query(entries: list, prefix: str = "", status: str = "", min_mb: float = 0, max_mb: float = 0,
+                  offset: int = 0, limit: int = 0) -> list:
+    """Filter and page catalog entries, in list_files format (name, size_mb, status, mtime)"""
+    files = []
+    for entry in entries:
+        size_mb = entry["size"] / (1024 * 1024)
+        if (prefix and not entry["name"].startswith(prefix)) or (status and entry["status"] != status) \
+                or size_mb < min_mb or (max_mb and size_mb > max_mb):
+            continue
+        files.append({"name": entry["name"], "size_mb": round(size_mb, 2), "status": entry["status"],
+                      "mtime": entry["mtime"]})
+    return files[offset:offset + limit] if limit else files[offset:]
+
+
+def cached_catalog(subdir: str, ttl: float = CATALOG_TTL, refresh: bool = False) -> list:
+    """Client-side catalog of one directory, cached in CATALOG_CACHE
+
+    Within ttl the local copy is used as is. After that one read of the
+    catalog version decides whether the copy is still current; only a
+    changed (or empty) catalog is read again. refresh rescans the volume.
+    """
+    import json
+    import os
+
+    cache_path = os.path.expanduser(CATALOG_CACHE)
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cached = cache.get(subdir)
+    if cached and not refresh and time.time() - cached["checked"] < ttl:
+        return cached["entries"]
+
+    version = catalog.get(CATALOG_VERSION, 0)
+    if cached and not refresh and cached["version"] == version:
+        entries = cached["entries"]
+    else:
+        entries = [] if refresh else catalog_entries(subdir)
+        if not entries:
+            entries = list_files.remote(subdir, refresh=True, raw=True)
+            version = catalog.get(CATALOG_VERSION, 0)
+    cache[subdir] = {"version": version, "checked": time.time(), "entries": entries}
+    try:
+        with open(cache_path, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+    except OSError as e:
+        print(f"Catalog cache not saved: {e}")
+    return entries
 
 
 @app.function(volumes={VOLUME_PATH: volume})
-def list_files(subdir: str = ""):
-    """List files in Volume"""
+def list_files(subdir: str = "", prefix: str = "", status: str = "", min_mb: float = 0, max_mb: float = 0,
+               offset: int = 0, limit: int = 0, refresh: bool = False, raw: bool = False):
+    """List files in Volume
+
+    Directories other than the volume root are answered from the catalog
+    (rebuilt by a scan when empty or on refresh); raw returns the catalog
+    entries themselves. The local CLI normally skips this function and
+    reads the catalog through cached_catalog.
+    """
     import os
     path = f"{VOLUME_PATH}/{subdir}" if subdir else VOLUME_PATH
     if not os.path.exists(path):
         return []
+    if subdir:
+        entries = [] if refresh else catalog_entries(subdir)
+        entries = entries or catalog_rebuild(subdir)
+        return entries if raw else catalog_query(entries, prefix, status, min_mb, max_mb, offset, limit)
     files = []
     for item in sorted(os.listdir(path)):
         item_path = os.path.join(path, item)
@@ -33,94 +186,1536 @@ def list_files(subdir: str = ""):
     return files
 
 
-@app.function(volumes={VOLUME_PATH: volume}, timeout=3600)
-def split_video(filename: str, segment_minutes: int = 10):
-    """Split long video into segments, reuse existing if available"""
-    import os
-    import subprocess
 
-    input_path = f"{VOLUME_PATH}/input/{filename}"
-    if not os.path.exists(input_path):
-        raise FileNotFoundError(f"File not found: {input_path}")
 
-    name, ext = os.path.splitext(filename)
-    input_dir = f"{VOLUME_PATH}/input"
-    
-    existing_segments = sorted([f for f in os.listdir(input_dir) if f.startswith(f"{name}_part") and f.endswith(ext)])
-    if existing_segments:
-        print(f"Found {len(existing_segments)} existing segments, reusing")
-        return existing_segments
+def probe_video(path: str) -> dict:
+    """Duration, frame rate and resolution of the first video stream"""
+    import json
+    import subprocess
 
     result = subprocess.run(
-        ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-         "-of", "default=noprint_wrappers=1:nokey=1", input_path],
+        ["ffprobe", "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=width,height,avg_frame_rate:format=duration",
+         "-of", "json", path],
         capture_output=True, text=True
     )
     if result.returncode != 0 or not result.stdout.strip():
         raise RuntimeError(f"ffprobe failed: {result.stderr or 'no output'}")
-    duration = float(result.stdout.strip())
-    duration_min = duration / 60
+    info = json.loads(result.stdout)
+    stream = (info.get("streams") or [{}])[0]
+    num, _, den = stream.get("avg_frame_rate", "0/1").partition("/")
+    fps = float(num) / float(den) if den and float(den) else 0.0
+    return {
+        "duration": float(info.get("format", {}).get("duration", 0) or 0),
+        "fps": round(fps, 3),
+        "width": int(stream.get("width", 0)),
+        "height": int(stream.get("height", 0)),
+    }
 
-    print(f"Video: {filename}, Duration: {duration_min:.1f} min")
 
-    if duration_min <= segment_minutes:
-        print("Video is short, no need to split")
-        return [filename]
+def probe_packets(path: str) -> list:
+    """Sorted (pts_time, is_keyframe) for every video packet (demux only, no decode)"""
+    import subprocess
 
-    output_pattern = f"{input_dir}/{name}_part%03d{ext}"
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe packets failed: {result.stderr}")
+    packets = []
+    for line in result.stdout.splitlines():
+        pts, flags = None, ""
+        for field in line.split(","):
+            try:
+                pts = float(field)
+            except ValueError:
+                flags = field
+        if pts is not None:
+            packets.append((pts, "K" in flags))
+    packets.sort()
+    return packets
+
+
+def probe_scene_cuts(path: str, threshold: float = 0.3) -> list:
+    """Timestamps of scene changes (full decode, slow - optional)"""
+    import re
+    import subprocess
 
-    cmd = ["ffmpeg", "-i", input_path, "-c", "copy", "-map", "0",
-           "-segment_time", str(segment_minutes * 60),
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-i", path, "-an",
+         "-vf", f"select='gt(scene,{threshold})',showinfo", "-f", "null", "-"],
+        capture_output=True, text=True
+    )
+    return [float(t) for t in re.findall(r"pts_time:([\d.]+)", result.stderr)]
+
+
+def balanced_cuts(keyframes: list, duration: float, target_seconds: float, scene_cuts: list = ()) -> list:
+    """Pick keyframe cut points that give near-equal segment durations
+
+    Each cut aims at an equal share of the remaining duration, so one early
+    long GOP does not push all later segments off balance. Within 10% of a
+    segment length, keyframes that coincide with a scene cut are preferred.
+    """
+    import math
+
+    count = max(1, math.ceil(duration / target_seconds - 1e-9))
+    if count == 1:
+        return []
+    window = duration / count * 0.1
+    candidates = sorted(k for k in keyframes if 0 < k < duration)
+    cuts = []
+    prev = 0.0
+    for i in range(1, count):
+        ideal = prev + (duration - prev) / (count - i + 1)
+        options = [k for k in candidates if k > prev + 1.0]
+        if not options:
+            break
+        near_scene = [k for k in options
+                      if abs(k - ideal) <= window and any(abs(k - s) <= 0.5 for s in scene_cuts)]
+        best = min(near_scene or options, key=lambda k: abs(k - ideal))
+        cuts.append(best)
+        prev = best
+    return cuts
+
+
+def plan_segments(filename: str, packets: list, duration: float, fps: float, cuts: list) -> list:
+    """Per-segment start/duration/frame count for the given cut points"""
+    import bisect
+    import os
+
+    name, ext = os.path.splitext(filename)
+    times = [p[0] for p in packets]
+    bounds = [0.0] + list(cuts) + [duration]
+    segments = []
+    for i in range(len(bounds) - 1):
+        start, end = bounds[i], bounds[i + 1]
+        if times:
+            frames = bisect.bisect_left(times, end) - bisect.bisect_left(times, start)
+            if i == len(bounds) - 2:
+                frames = len(times) - bisect.bisect_left(times, start)
+        else:
+            frames = int(round((end - start) * fps))
+        segments.append({
+            "file": f"{name}_part{i:03d}{ext}" if len(bounds) > 2 else filename,
+            "index": i,
+            "start": round(start, 3),
+            "duration": round(end - start, 3),
+            "frames": frames,
+        })
+    return segments
+
+
+def plan_split(input_path: str, segment_minutes: float, scene: bool = False) -> dict:
+    """Build a keyframe-balanced split plan for one input file"""
+    import os
+
+    info = probe_video(input_path)
+    packets = probe_packets(input_path)
+    keyframes = [pts for pts, key in packets if key]
+    scene_cuts = probe_scene_cuts(input_path) if scene else []
+    cuts = balanced_cuts(keyframes, info["duration"], segment_minutes * 60, scene_cuts)
+    stat = os.stat(input_path)
+    return {
+        **info,
+        "file": os.path.basename(input_path),
+        "source_size": stat.st_size,
+        "source_mtime": int(stat.st_mtime),
+        "segment_minutes": segment_minutes,
+        "scene": scene,
+        "cuts": cuts,
+        "segments": plan_segments(os.path.basename(input_path), packets, info["duration"], info["fps"], cuts),
+    }
+
+
+def plan_from_segments(input_dir: str, segment_files: list) -> dict:
+    """Rebuild a plan from segments already on the volume (no source needed)"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    def probe(seg):
+        info = probe_video(f"{input_dir}/{seg}")
+        info["frames"] = len(probe_packets(f"{input_dir}/{seg}"))
+        return info
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        infos = list(pool.map(probe, segment_files))
+    segments = []
+    start = 0.0
+    for i, (seg, info) in enumerate(zip(segment_files, infos)):
+        segments.append({"file": seg, "index": i, "start": round(start, 3),
+                         "duration": round(info["duration"], 3), "frames": info["frames"]})
+        start += info["duration"]
+    first = infos[0] if infos else {}
+    return {
+        "duration": round(start, 3),
+        "fps": first.get("fps", 0.0),
+        "width": first.get("width", 0),
+        "height": first.get("height", 0),
+        "cuts": [s["start"] for s in segments[1:]],
+        "segments": segments,
+    }
+
+
+def load_plan(filename: str) -> dict:
+    """Cached plan for an input file, or {}"""
+    import json
+    import os
+
+    path = f"{VOLUME_PATH}/plans/{filename}.json"
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_plan(filename: str, plan: dict):
+    """Write a plan to the volume cache (caller commits)"""
+    import json
+    import os
+
+    os.makedirs(f"{VOLUME_PATH}/plans", exist_ok=True)
+    with open(f"{VOLUME_PATH}/plans/{filename}.json", "w") as f:
+        json.dump(plan, f)
+
+
+
+# 无历史数据时的默认假设（T4, 1080p, v4-fast 量级）
+DEFAULT_RESTORE_FPS_1080P = 20.0
+DEFAULT_COLD_START_SECONDS = 60.0
+DEFAULT_STARTUP_SECONDS = 30.0
+DEFAULT_MERGE_SECONDS_PER_SEGMENT = 0.5
+
+# Modal GPU 单价（美元/小时），价格变动时更新
+GPU_PRICES_PER_HOUR = {
+    "T4": 0.59,
+    "L4": 0.80,
+    "A10G": 1.10,
+    "L40S": 1.95,
+    "A100": 2.10,
+    "H100": 3.95,
+}
+# 没有该 GPU 的历史记录时，相对 T4 的速度先验（粗略估计，有实测后以历史为准）
+GPU_RELATIVE_SPEED = {"T4": 1.0, "L4": 1.5, "A10G": 2.0, "L40S": 3.2, "A100": 3.5, "H100": 5.0}
+DEFAULT_GPU = "T4"
+
+
+def gpu_name() -> str:
+    """Name of the GPU in this container, or "cpu\""""
+    import subprocess
+    try:
+        result = subprocess.run(["nvidia-smi", "--query-gpu=name", "--format=csv,noheader"],
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.TimeoutExpired):
+        return "cpu"
+    return result.stdout.strip().splitlines()[0] if result.returncode == 0 and result.stdout.strip() else "cpu"
+
+
+def gpu_class(name: str) -> str:
+    """Map an nvidia-smi name ("Tesla T4", "NVIDIA L40S", ...) to a GPU_PRICES_PER_HOUR key"""
+    # L40S 要先于 L4 匹配
+    for gpu in ("L40S", "A100", "H100", "A10G", "L4", "T4"):
+        if gpu in name.upper():
+            return gpu
+    return ""
+
+
+def record_history(key: str, record: dict):
+    """Append one JSON line to stats/history/<key>.jsonl (caller commits)
+
+    One file per segment/job keeps concurrent containers from writing the same file.
+    """
+    import json
+    import os
+
+    history_dir = f"{VOLUME_PATH}/stats/history"
+    os.makedirs(history_dir, exist_ok=True)
+    with open(f"{history_dir}/{key}.jsonl", "a") as f:
+        f.write(json.dumps({"time": round(time.time(), 1), **record}) + "\n")
+
+
+def load_history(limit: int = 2000, history_dir: str = "") -> list:
+    """Most recent history records (newest files first)
+
+    history_dir may also be a single .jsonl file, e.g. a local copy for
+    offline what-if runs of select_gpu.
+    """
+    import json
+    import os
+
+    history_dir = history_dir or f"{VOLUME_PATH}/stats/history"
+    if os.path.isfile(history_dir):
+        paths = [history_dir]
+    elif os.path.isdir(history_dir):
+        paths = [os.path.join(history_dir, f) for f in os.listdir(history_dir) if f.endswith(".jsonl")]
+        paths.sort(key=os.path.getmtime, reverse=True)
+    else:
+        return []
+    records = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        if len(records) >= limit:
+            break
+    return records[:limit]
+
+
+def median(values: list, default: float = 0.0) -> float:
+    values = sorted(v for v in values if v)
+    if not values:
+        return default
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2
+
+
+def estimate_restore_fps(history: list, height: int, detection: str, gpu: str = "") -> float:
+    """Restore fps from history for a similar resolution/model (scaled default otherwise)"""
+    segments = [r for r in history if r.get("type") == "segment" and r.get("fps")]
+    if gpu:
+        segments = [r for r in segments if gpu_class(r.get("gpu", "")) == gpu] or segments
+    matching = [r["fps"] for r in segments
+                if r.get("detection") == detection and height and abs(r.get("height", 0) - height) <= height * 0.2]
+    if matching:
+        return median(matching)
+    same_model = [r["fps"] * r.get("height", 1080) / max(height, 1) for r in segments
+                  if r.get("detection") == detection and r.get("height")]
+    if same_model:
+        return median(same_model)
+    return DEFAULT_RESTORE_FPS_1080P * 1080 / max(height or 1080, 1)
+
+
+def gpu_restore_fps(history: list, height: int, detection: str, gpu: str) -> float:
+    """Restore fps on a GPU class: its own history, else other GPUs scaled by GPU_RELATIVE_SPEED"""
+    segments = [r for r in history if r.get("type") == "segment" and r.get("fps")]
+    own = [r for r in segments if gpu_class(r.get("gpu", "")) == gpu]
+    if own:
+        return estimate_restore_fps(own, height, detection)
+    speed = GPU_RELATIVE_SPEED.get(gpu, 1.0)
+    scaled = [{**r, "fps": r["fps"] / GPU_RELATIVE_SPEED.get(gpu_class(r.get("gpu", "")), 1.0) * speed}
+              for r in segments if gpu_class(r.get("gpu", ""))]
+    if scaled:
+        return estimate_restore_fps(scaled, height, detection)
+    # 默认值按 T4 估计
+    return estimate_restore_fps([], height, detection) * speed
+
+
+def predict_makespan(count: int, frames: int, restore_fps: float, max_parallel: int,
+                     cold_start: float, startup: float, merge_per_segment: float) -> dict:
+    """Predicted wall-clock and GPU seconds for `count` equal segments"""
+    import math
+
+    waves = math.ceil(count / max(1, max_parallel))
+    per_segment = frames / count / restore_fps + startup
+    containers = min(count, max_parallel)
+    return {
+        "segments": count,
+        "makespan": round(cold_start + waves * per_segment + count * merge_per_segment, 1),
+        "gpu_seconds": round(containers * cold_start + count * startup + frames / restore_fps, 1),
+    }
+
+
+def history_overheads(history: list) -> tuple:
+    """(cold_start, per-segment startup, merge seconds per segment) medians from history"""
+    jobs = [r for r in history if r.get("type") == "job"]
+    segs = [r for r in history if r.get("type") == "segment"]
+    return (
+        median([r.get("cold_start") for r in jobs], DEFAULT_COLD_START_SECONDS),
+        median([r.get("startup_seconds") for r in segs], DEFAULT_STARTUP_SECONDS),
+        median([r.get("merge_seconds_per_segment") for r in jobs], DEFAULT_MERGE_SECONDS_PER_SEGMENT),
+    )
+
+
+def choose_segment_count(duration: float, video_fps: float, height: int, max_parallel: int,
+                         history: list, detection: str = "v4-fast", restore_fps: float = 0.0) -> dict:
+    """Segment count minimizing predicted makespan, then GPU seconds
+
+    Any count within 5% of the best makespan is acceptable; among those the
+    one with the fewest GPU seconds wins (fewer startups and merge pieces).
+    restore_fps overrides the history estimate (select_gpu passes per-GPU fps).
+    """
+    frames = int(duration * (video_fps or 30))
+    restore_fps = restore_fps or estimate_restore_fps(history, height, detection)
+    cold_start, startup, merge_per_segment = history_overheads(history)
+
+    max_count = max(1, min(int(duration // 60), 4 * max(1, max_parallel)))
+    predictions = [predict_makespan(n, frames, restore_fps, max_parallel, cold_start, startup, merge_per_segment)
+                   for n in range(1, max_count + 1)]
+    best = min(p["makespan"] for p in predictions)
+    choice = min((p for p in predictions if p["makespan"] <= best * 1.05), key=lambda p: p["gpu_seconds"])
+    return {
+        **choice,
+        "segment_minutes": round(duration / choice["segments"] / 60, 2),
+        "restore_fps": round(restore_fps, 2),
+        "cold_start": round(cold_start, 1),
+        "startup_seconds": round(startup, 1),
+    }
+
+
+def select_gpu(duration: float, video_fps: float, height: int, max_parallel: int, history: list,
+               detection: str = "v4-fast", deadline_seconds: float = 0, gpus: list = None,
+               segments: int = 0) -> dict:
+    """Cheapest GPU class whose predicted makespan meets the deadline (pure, no I/O)
+
+    Each class is predicted with fps from gpu_restore_fps, at the given
+    segment count (an existing split plan) or its own best count from
+    choose_segment_count; cost is predicted GPU seconds x price. Without a
+    deadline the cheapest class wins; if none meets it, the fastest does.
+    """
+    options = []
+    for gpu in gpus or list(GPU_PRICES_PER_HOUR):
+        fps = gpu_restore_fps(history, height, detection, gpu)
+        if segments:
+            frames = int(duration * (video_fps or 30))
+            choice = {**predict_makespan(segments, frames, fps, max_parallel, *history_overheads(history)),
+                      "restore_fps": round(fps, 2)}
+        else:
+            choice = choose_segment_count(duration, video_fps, height, max_parallel, history, detection, fps)
+        options.append({**choice, "gpu": gpu,
+                        "cost": round(choice["gpu_seconds"] / 3600 * GPU_PRICES_PER_HOUR[gpu], 3)})
+    meeting = [o for o in options if not deadline_seconds or o["makespan"] <= deadline_seconds]
+    best = min(meeting, key=lambda o: (o["cost"], o["makespan"])) if meeting \
+        else min(options, key=lambda o: o["makespan"])
+    return {**best, "deadline_met": bool(meeting), "options": sorted(options, key=lambda o: o["cost"])}
+
+
+def resolve_gpu(gpu: str, plan: dict, max_parallel: int, detection: str, deadline_minutes: float = 0) -> tuple:
+    """Return (gpu class, selection) - selection is {} unless gpu == "auto\""""
+    if gpu != "auto":
+        return gpu, {}
+    selection = select_gpu(plan["duration"], plan["fps"], plan["height"], max_parallel, load_history(),
+                           detection, deadline_minutes * 60, segments=len(plan["segments"]))
+    print(f"Auto GPU: {selection['gpu']}, predicted {selection['makespan'] / 60:.1f} min, "
+          f"${selection['cost']:.2f}" + ("" if selection["deadline_met"] else " (deadline not reachable)"))
+    return selection["gpu"], selection
+
+
+@app.function(volumes={VOLUME_PATH: volume})
+def predict_gpu(filename: str, max_parallel: int = 10, detection: str = "v4-fast",
+                deadline_minutes: float = 0) -> dict:
+    """Dry-run select_gpu for an input file against the volume's history (no GPU started)"""
+    plan = load_plan(filename)
+    info = plan or probe_video(f"{VOLUME_PATH}/input/{filename}")
+    selection = select_gpu(info["duration"], info["fps"], info["height"], max_parallel, load_history(),
+                           detection, deadline_minutes * 60)
+    return {**selection, "duration": info["duration"], "fps": info["fps"], "height": info["height"]}
+
+
+def resolve_segment_minutes(input_path: str, segment_minutes, max_parallel: int, detection: str):
+    """Return (segment_minutes, prediction) - prediction is {} unless segment_minutes == "auto\""""
+    if str(segment_minutes) != "auto":
+        return float(segment_minutes), {}
+    info = probe_video(input_path)
+    prediction = choose_segment_count(info["duration"], info["fps"], info["height"], max_parallel,
+                                      load_history(), detection)
+    print(f"Auto segment: {prediction['segments']} x {prediction['segment_minutes']} min, "
+          f"predicted makespan {prediction['makespan'] / 60:.1f} min, "
+          f"{prediction['gpu_seconds'] / 3600:.2f} GPU-h (restore {prediction['restore_fps']} fps)")
+    return prediction["segment_minutes"], prediction
+
+
+def sidecar_offset(path: str):
+    """Start of the non-primary streams relative to the primary video, in seconds
+
+    Signed: negative when audio starts before the video. None if the primary
+    video is the only stream (nothing to carry in a sidecar).
+    """
+    import json
+    import subprocess
+
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "stream=index,codec_type,start_time", "-of", "json", path],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed: {result.stderr}")
+    streams = json.loads(result.stdout or "{}").get("streams", [])
+    primary = next((st for st in streams if st.get("codec_type") == "video"), None)
+    others = [st for st in streams if st is not primary]
+    if not others:
+        return None
+    # 附件等流没有 start_time，不参与偏移计算
+    starts = [float(st["start_time"]) for st in others if st.get("start_time") not in (None, "N/A")]
+    video_start = float((primary or {}).get("start_time") or 0)
+    return round(min(starts) - video_start, 3) if starts else 0.0
+
+
+def sidecar_name(filename: str) -> str:
+    """Sidecar file for a source: same container, so every stream it holds fits"""
+    import os
+    return f"{filename}.streams{os.path.splitext(filename)[1]}"
+
+
+def extract_sidecar(input_path: str, sidecar_path: str):
+    """Copy every stream except the primary video once into a sidecar
+
+    Audio, subtitles, data and extra video streams all go in, so the merge can
+    put back everything the video-only segments dropped.
+    """
+    import os
+    import subprocess
+
+    os.makedirs(os.path.dirname(sidecar_path), exist_ok=True)
+    result = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", input_path, "-map", "0", "-map", "-0:v:0",
+         "-c", "copy", sidecar_path, "-y"],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Sidecar extract failed: {result.stderr}")
+
+
+def split_with_audio(input_path: str, output_pattern: str, plan: dict, audio_path: str) -> dict:
+    """Split video-only segments and extract the stream sidecar in parallel
+
+    Adds "audio" (sidecar path) and "audio_offset" to the plan when the
+    source has streams besides the primary video; merge_videos muxes them
+    back once over the whole output.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    offset = sidecar_offset(input_path)
+    if offset is None:
+        split_at_cuts(input_path, output_pattern, plan["cuts"])
+        return plan
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        sidecar = pool.submit(extract_sidecar, input_path, audio_path)
+        split_at_cuts(input_path, output_pattern, plan["cuts"], video_only=True)
+        sidecar.result()
+    return {**plan, "audio": audio_path, "audio_offset": offset}
+
+
+def split_at_cuts(input_path: str, output_pattern: str, cuts: list, video_only: bool = False):
+    """Stream-copy split at planned keyframe cut points (video_only keeps only the primary video)"""
+    import subprocess
+
+    # 切点本身就是关键帧，稍微提前一点避免浮点误差跳到下一个关键帧
+    segment_times = ",".join(f"{max(0.0, t - 0.001):.3f}" for t in cuts)
+
+    cmd = ["ffmpeg", "-i", input_path, "-c", "copy", "-map", "0:v:0" if video_only else "0",
+           "-segment_times", segment_times,
            "-f", "segment", "-reset_timestamps", "1", output_pattern, "-y"]
 
     result = subprocess.run(cmd, capture_output=True, text=True)
     if result.returncode != 0:
         raise RuntimeError(f"Split failed: {result.stderr}")
 
+
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=3600)
+def split_video(filename: str, segment_minutes: Union[int, str] = 10, scene: bool = False,
+                return_plan: bool = False, max_parallel: int = 10, detection: str = "v4-fast"):
+    """Split long video at keyframe-balanced cut points, reuse existing if available
+
+    Args:
+        filename: Video file name in input directory
+        segment_minutes: Target segment length, or "auto" to size segments for
+            minimal predicted makespan at max_parallel (see choose_segment_count)
+        scene: Prefer cut points on scene changes (adds a full decode pass)
+        return_plan: Return the split plan (per-segment start, duration, frames)
+            instead of the list of segment filenames
+    """
+    import os
+
+    input_path = f"{VOLUME_PATH}/input/{filename}"
+    name, ext = os.path.splitext(filename)
+    input_dir = f"{VOLUME_PATH}/input"
+
+    # 先找已有分段：upload.py --presplit 只上传分段和计划，不上传源文件
+    existing_segments = sorted([f for f in os.listdir(input_dir) if f.startswith(f"{name}_part") and f.endswith(ext)]) \
+        if os.path.isdir(input_dir) else []
+    if existing_segments:
+        print(f"Found {len(existing_segments)} existing segments, reusing")
+        if not return_plan:
+            return existing_segments
+        plan = load_plan(filename)
+        if [s["file"] for s in plan.get("segments", [])] != existing_segments:
+            audio = {k: plan[k] for k in ("audio", "audio_offset") if k in plan}
+            plan = {**plan_from_segments(input_dir, existing_segments), **audio}
+            save_plan(filename, plan)
+            volume.commit()
+        return plan
+
+    if not os.path.exists(input_path):
+        raise FileNotFoundError(f"File not found: {input_path}")
+
+    segment_minutes, prediction = resolve_segment_minutes(input_path, segment_minutes, max_parallel, detection)
+    stat = os.stat(input_path)
+    plan = load_plan(filename)
+    if (plan.get("source_size"), plan.get("source_mtime"), plan.get("segment_minutes"), plan.get("scene")) != (
+            stat.st_size, int(stat.st_mtime), segment_minutes, scene):
+        plan = plan_split(input_path, segment_minutes, scene)
+        plan["prediction"] = prediction
+        save_plan(filename, plan)
+    else:
+        print("Using cached split plan")
+
+    print(f"Video: {filename}, Duration: {plan['duration'] / 60:.1f} min")
+
+    if len(plan["segments"]) == 1:
+        print("Video is short, no need to split")
+        volume.commit()
+        return plan if return_plan else [filename]
+
+    # 除主视频外的所有流单独抽出一次，分段只含视频，合并时再整体封装回去
+    audio_path = f"{VOLUME_PATH}/audio/{sidecar_name(filename)}"
+    plan = split_with_audio(input_path, f"{input_dir}/{name}_part%03d{ext}", plan, audio_path)
+    save_plan(filename, plan)
+
     segments = sorted([f for f in os.listdir(input_dir) if f.startswith(f"{name}_part")])
-    print(f"Created {len(segments)} segments")
+    catalog_update("input", filename, "split")
+    for seg in segments:
+        catalog_update("input", seg, "segment")
+    durations = [s["duration"] for s in plan["segments"]]
+    print(f"Created {len(segments)} segments ({min(durations) / 60:.1f}-{max(durations) / 60:.1f} min)")
     volume.commit()
-    return segments
+    return plan if return_plan else segments
 
 
-@app.function(volumes={VOLUME_PATH: volume}, timeout=1800)
-def merge_videos(prefix: str, output_name: str = "merged.mp4"):
-    """Merge video segments"""
+def audio_inputs(audio: str, offset: float) -> tuple:
+    """(extra ffmpeg input args, map args) muxing every sidecar stream over input 0's video
+
+    offset is signed; a negative -itsoffset keeps audio that starts before
+    the video in sync (the muxer shifts all streams together).
+    """
+    if not audio:
+        return [], ["-map", "0"]
+    return ["-itsoffset", f"{offset:.3f}", "-i", audio], ["-map", "0:v", "-map", "1"]
+
+
+def concat_merge(paths: list, output_path: str, list_file: str = "", audio: str = "", audio_offset: float = 0.0):
+    """Remux segments through the ffmpeg concat demuxer (reads and rewrites everything)
+
+    The concat list goes to a private temp file unless list_file is given,
+    so concurrent merges never share one. With an audio sidecar the segments
+    are video-only and the original audio is muxed back in the same pass.
+    """
     import os
     import subprocess
+    import tempfile
+
+    if list_file:
+        f = open(list_file, "w")
+    else:
+        f = tempfile.NamedTemporaryFile("w", prefix="lada_concat_", suffix=".txt", delete=False)
+    with f:
+        for path in paths:
+            f.write("file '{}'\n".format(path.replace("'", "'\\''")))
+
+    extra_inputs, maps = audio_inputs(audio, audio_offset)
+    cmd = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", f.name, *extra_inputs, *maps, "-c", "copy",
+           output_path, "-y"]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+    finally:
+        if not list_file:
+            os.remove(f.name)
+    if result.returncode != 0:
+        raise RuntimeError(f"Merge failed: {result.stderr}")
+
+
+def append_merge(paths: list, output_path: str, audio: str = "", audio_offset: float = 0.0):
+    """Merge MPEG-TS segments by byte append
+
+    A .ts output is a plain byte concatenation. Any other container (or an
+    audio sidecar to mux back) gets the appended stream piped into one
+    ffmpeg remux, so segments are read once and the output written once,
+    with no intermediate file.
+    """
+    import shutil
+    import subprocess
+    import tempfile
 
+    if output_path.endswith(".ts") and not audio:
+        with open(output_path, "wb") as out:
+            for path in paths:
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, out, 8 * 1024 * 1024)
+        return
+
+    extra_inputs, maps = audio_inputs(audio, audio_offset)
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(
+            ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "mpegts", "-i", "pipe:0",
+             *extra_inputs, *maps, "-c", "copy", output_path, "-y"],
+            stdin=subprocess.PIPE, stderr=errors
+        )
+        try:
+            for path in paths:
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, process.stdin, 8 * 1024 * 1024)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+        process.wait()
+        if process.returncode != 0:
+            errors.seek(0)
+            raise RuntimeError(f"Merge failed: {errors.read().decode(errors='replace')}")
+
+
+MERGE_WORKERS = 4
+
+
+def segment_outputs(names: list, prefix: str, container: str, detection: str = "") -> list:
+    """Restored segment files of exactly {prefix}NNN_restored[_detection].{container}, in part order"""
+    suffix = re.escape(f"_{detection}") if detection else r"(?:_[\w-]+)?"
+    pattern = re.compile(rf"{re.escape(prefix)}(\d+)_restored{suffix}\.{re.escape(container)}")
+    matched = [(int(m.group(1)), name) for name in names if (m := pattern.fullmatch(name))]
+    return [name for _, name in sorted(matched)]
+
+
+def probe_segment(path: str) -> dict:
+    """Video stream parameters and duration of one restored segment"""
+    import json
+    import subprocess
+
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=codec_name,width,height,pix_fmt,time_base:format=duration", "-of", "json", path],
+        capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed: {result.stderr.strip()}")
+    data = json.loads(result.stdout or "{}")
+    streams = data.get("streams", [])
+    if not streams:
+        raise RuntimeError("no video stream")
+    return {"params": {k: streams[0].get(k) for k in ("codec_name", "width", "height", "pix_fmt", "time_base")},
+            "duration": float(data.get("format", {}).get("duration") or 0)}
+
+
+def validate_segments(paths: list, durations: list = None, workers: int = 16, tolerance: float = 1.0):
+    """Check segments before an expensive merge; raises ValueError on the first problem found
+
+    Part numbers must run 0..n-1 without gaps or repeats. Every segment is
+    probed in parallel and must be non-empty with the same codec, size,
+    pixel format and timebase as the first. With durations (from the split
+    plan) each segment must also be within tolerance seconds of its slot,
+    which catches outputs truncated by a crashed restore.
+    """
+    import os
+    from concurrent.futures import ThreadPoolExecutor, as_completed
+
+    parts = [re.search(r"_part(\d+)_restored", os.path.basename(p)) for p in paths]
+    numbers = [int(m.group(1)) if m else -1 for m in parts]
+    if numbers != list(range(len(paths))):
+        missing = sorted(set(range(max(numbers) + 1)) - set(numbers))
+        raise ValueError(f"Segment parts not contiguous: got {len(paths)}, missing {missing[:10]}, "
+                         f"order {numbers[:10]}{'...' if len(numbers) > 10 else ''}")
+    if durations is not None and len(durations) != len(paths):
+        raise ValueError(f"Expected {len(durations)} segments, found {len(paths)}")
+
+    probes = [None] * len(paths)
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(paths)))) as pool:
+        futures = {pool.submit(probe_segment, path): i for i, path in enumerate(paths)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                probes[i] = future.result()
+            except Exception as e:
+                for other in futures:
+                    other.cancel()
+                raise ValueError(f"Unreadable segment {os.path.basename(paths[i])}: {e}") from e
+            if probes[i]["duration"] <= 0:
+                raise ValueError(f"Empty segment {os.path.basename(paths[i])}")
+            if durations is not None and abs(probes[i]["duration"] - durations[i]) > tolerance:
+                raise ValueError(f"Segment {os.path.basename(paths[i])} is {probes[i]['duration']:.1f}s, "
+                                 f"expected {durations[i]:.1f}s")
+
+    reference = probes[0]["params"]
+    for path, probe in zip(paths, probes):
+        if probe["params"] != reference:
+            raise ValueError(f"Segment {os.path.basename(path)} has {probe['params']}, "
+                             f"first segment has {reference}")
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=1800)
+def merge_videos(prefix: str, output_name: str = "merged.mp4", container: str = "mp4", files: list = None,
+                 audio: str = "", audio_offset: float = 0.0, detection: str = "", durations: list = None):
+    """Merge video segments
+
+    Safe to run concurrently for different outputs: every merge uses its own
+    concat list. Segments are validated (validate_segments) before the
+    remux starts.
+
+    Args:
+        prefix: Segment name prefix (e.g. "video_part")
+        output_name: Merged file name in output directory
+        container: Segment container - "mp4" (concat demuxer remux) or
+            "ts" (byte append, see append_merge)
+        files: Exact segment outputs in order (from the job ledger); skips
+            the directory scan
+        audio: Audio sidecar from split_video (segments are then video-only),
+            muxed back over the whole output in the same pass
+        audio_offset: Audio start relative to video in the source
+        detection: Only scan outputs of this detection model
+        durations: Planned segment durations to validate against
+    """
     volume.reload()
+    merged = merge_segments(prefix, output_name, container, files, audio, audio_offset, detection, durations)
+    volume.commit()
+    return merged
+
+
+def merge_segments(prefix: str, output_name: str, container: str = "mp4", files: list = None,
+                   audio: str = "", audio_offset: float = 0.0, detection: str = "", durations: list = None) -> str:
+    """Body of merge_videos without the volume reload/commit (arguments as there)
+
+    Orchestrators that merge on background threads reload once themselves
+    before dispatching: Modal refuses a reload while another merge holds
+    files open.
+    """
+    import os
 
     output_dir = f"{VOLUME_PATH}/output"
     os.makedirs(output_dir, exist_ok=True)
 
-    all_files = os.listdir(output_dir)
-    print(f"All files in output: {all_files}")
-
-    files = sorted([f for f in all_files if prefix in f and f.endswith(".mp4")])
+    if not files:
+        files = segment_outputs(os.listdir(output_dir), prefix, container, detection)
     if not files:
         raise FileNotFoundError(f"No files matching prefix: {prefix}")
 
     print(f"Found {len(files)} segments to merge")
 
-    list_file = f"{VOLUME_PATH}/merge_list.txt"
-    with open(list_file, "w") as f:
-        for file in files:
-            f.write(f"file '{output_dir}/{file}'\n")
-
+    paths = [f"{output_dir}/{file}" for file in files]
     output_path = f"{output_dir}/{output_name}"
-    cmd = ["ffmpeg", "-f", "concat", "-safe", "0", "-i", list_file, "-c", "copy", output_path, "-y"]
-
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    if result.returncode != 0:
-        raise RuntimeError(f"Merge failed: {result.stderr}")
+    if audio and not os.path.exists(audio):
+        raise FileNotFoundError(f"Audio sidecar not found: {audio}")
+    start = time.time()
+    validate_segments(paths, durations)
+    print(f"Validated {len(paths)} segments in {time.time() - start:.1f}s")
+    if container == "ts":
+        append_merge(paths, output_path, audio, audio_offset)
+    else:
+        concat_merge(paths, output_path, audio=audio, audio_offset=audio_offset)
 
     size_mb = os.path.getsize(output_path) / (1024 * 1024)
+    catalog_update("output", output_name, "merged")
     print(f"Merged: {output_name} ({size_mb:.1f} MB)")
-    volume.commit()
     return output_name
 
 
+CACHE_MAX_GB = 200
+
+
+# 容器内摘要缓存：(path, size, mtime) -> sha256，模型文件每个容器只算一次
+DIGESTS = {}
+
+
+def file_digest(path: str) -> str:
+    """sha256 of a file, memoized by (full path, size, mtime)
+
+    Volume files are also memoized on the volume (cache/digests), so other
+    containers skip re-hashing the same input.
+    """
+    import hashlib
+    import json
+    import os
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    stamp = [stat.st_size, int(stat.st_mtime)]
+    if DIGESTS.get(path, {}).get("stamp") == stamp:
+        return DIGESTS[path]["sha256"]
+
+    memo_dir = f"{VOLUME_PATH}/cache/digests"
+    # 按完整路径寻址：不同目录下的同名文件不能共用摘要
+    memo_path = f"{memo_dir}/{hashlib.sha256(path.encode()).hexdigest()[:32]}.json" \
+        if path.startswith(VOLUME_PATH + "/") else ""
+    if memo_path:
+        try:
+            with open(memo_path) as f:
+                memo = json.load(f)
+            if memo.get("path") == path and memo.get("stamp") == stamp:
+                DIGESTS[path] = memo
+                return memo["sha256"]
+        except (OSError, json.JSONDecodeError, KeyError):
+            pass
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(chunk)
+    memo = {"path": path, "stamp": stamp, "sha256": digest.hexdigest()}
+    DIGESTS[path] = memo
+    if memo_path:
+        os.makedirs(memo_dir, exist_ok=True)
+        with open(memo_path, "w") as f:
+            json.dump(memo, f)
+    return memo["sha256"]
+
+
+def model_versions(detection: str) -> list:
+    """(name, sha256) of the model files a restore depends on"""
+    import os
+
+    versions = []
+    for model in (DETECTION_MODELS.get(detection, DETECTION_MODELS["v4-fast"]), RESTORATION_MODEL):
+        path = f"{MODEL_DIR}/{model}"
+        # 按内容而非大小区分版本：重新训练的模型可能大小不变
+        versions.append([model, file_digest(path) if os.path.exists(path) else None])
+    return versions
+
+
+def restore_cache_key(input_path: str, params: dict) -> str:
+    """Content address of a restore: input hash + all parameters + model versions"""
+    import hashlib
+    import json
+
+    payload = {
+        "input": file_digest(input_path),
+        "params": params,
+        "models": model_versions(params.get("detection", "v4-fast")),
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def cache_lookup(key: str) -> str:
+    """Path of the cached output for key (refreshing its LRU stamp), or \"\"
+
+    Entries either own a hard-linked object or point at the published
+    output; a pointer whose target changed since it was stored is a miss.
+    """
+    import json
+    import os
+
+    entry_path = f"{VOLUME_PATH}/cache/entries/{key}.json"
+    try:
+        with open(entry_path) as f:
+            entry = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return ""
+    if entry.get("object"):
+        object_path = f"{VOLUME_PATH}/cache/objects/{entry['object']}"
+        if not os.path.exists(object_path):
+            return ""
+    else:
+        object_path = f"{VOLUME_PATH}/output/{entry.get('output', '')}"
+        try:
+            stat = os.stat(object_path)
+        except OSError:
+            return ""
+        if [stat.st_size, int(stat.st_mtime)] != entry.get("stamp"):
+            return ""
+    entry["last_used"] = time.time()
+    with open(entry_path, "w") as f:
+        json.dump(entry, f)
+    return object_path
+
+
+def cache_store(key: str, output_path: str, max_gb: float = CACHE_MAX_GB):
+    """Register a published output in the cache and evict LRU entries (caller commits)
+
+    The output is hard-linked into cache/objects, so the cache costs no extra
+    writes or space while the output exists; where links are unsupported the
+    entry just points at the output file.
+    """
+    import json
+    import os
+
+    os.makedirs(f"{VOLUME_PATH}/cache/objects", exist_ok=True)
+    os.makedirs(f"{VOLUME_PATH}/cache/entries", exist_ok=True)
+    object_name = key + os.path.splitext(output_path)[1]
+    object_path = f"{VOLUME_PATH}/cache/objects/{object_name}"
+    stat = os.stat(output_path)
+    entry = {"size": stat.st_size, "source": os.path.basename(output_path), "last_used": time.time()}
+    try:
+        if os.path.exists(object_path):
+            os.remove(object_path)
+        os.link(output_path, object_path)
+        entry["object"] = object_name
+    except OSError:
+        entry.update({"output": os.path.basename(output_path), "stamp": [stat.st_size, int(stat.st_mtime)]})
+    with open(f"{VOLUME_PATH}/cache/entries/{key}.json", "w") as f:
+        json.dump(entry, f)
+    cache_evict(max_gb * 1024 ** 3)
+
+
+def cache_evict(max_bytes: float):
+    """Delete least recently used entries until the cache fits in max_bytes"""
+    import json
+    import os
+
+    entry_dir = f"{VOLUME_PATH}/cache/entries"
+    entries = []
+    for name in os.listdir(entry_dir):
+        try:
+            with open(f"{entry_dir}/{name}") as f:
+                entries.append((name, json.load(f)))
+        except (OSError, json.JSONDecodeError):
+            continue
+    # 指针条目不占缓存空间，只有硬链接对象计入容量
+    entries = [(name, entry) for name, entry in entries if entry.get("object")]
+    total = sum(e.get("size", 0) for _, e in entries)
+    for name, entry in sorted(entries, key=lambda item: item[1].get("last_used", 0)):
+        if total <= max_bytes:
+            break
+        for path in (f"{VOLUME_PATH}/cache/objects/{entry['object']}", f"{entry_dir}/{name}"):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total -= entry.get("size", 0)
+        print(f"Cache evict: {entry.get('source')} ({entry.get('size', 0) / (1024*1024):.1f} MB)")
+
+
+def serve_from_cache(input_filename: str, output_filename: str, params: dict) -> bool:
+    """Materialize a cached restore as output/<output_filename>; True on hit (caller commits)"""
+    import os
+    import shutil
+
+    input_path = f"{VOLUME_PATH}/input/{input_filename}"
+    if not os.path.exists(input_path):
+        return False
+    cached = cache_lookup(restore_cache_key(input_path, params))
+    if not cached:
+        return False
+    output_path = f"{VOLUME_PATH}/output/{output_filename}"
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    if not (os.path.exists(output_path) and os.path.getsize(output_path) == os.path.getsize(cached)):
+        if os.path.exists(output_path + ".tmp"):
+            os.remove(output_path + ".tmp")
+        try:
+            os.link(cached, output_path + ".tmp")
+        except OSError:
+            shutil.copyfile(cached, output_path + ".tmp")
+        os.replace(output_path + ".tmp", output_path)
+    catalog_update("output", output_filename)
+    print(f"Cache hit: {input_filename} -> {output_filename}")
+    return True
+
+
+def restore_params(codec: str, crf: int, detection: str, max_clip_length: int,
+                   container: str = "", ts_offset: float = 0.0) -> dict:
+    """Every parameter that changes restore_video's output bytes"""
+    ts = container == "ts"
+    # 只有 TS 封装会写入时间偏移；mp4 等同一输入不同 offset 输出相同，应共用缓存
+    return {"codec": codec, "crf": crf, "detection": detection, "max_clip_length": max_clip_length,
+            "container": "ts" if ts else "", "ts_offset": round(ts_offset, 3) if ts else 0.0}
+
+
+def restored_name(input_filename: str, detection: str, container: str = "") -> str:
+    """Output filename restore_video writes for an input"""
+    import os
+    name, ext = os.path.splitext(input_filename)
+    return f"{name}_restored_{detection}{'.ts' if container == 'ts' else ext}"
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=1800)
+def restore_cached(input_filename: str, codec: str = "h264_nvenc", crf: int = 20, detection: str = "v4-fast",
+                   max_clip_length: int = 900, container: str = "", ts_offset: float = 0.0,
+                   gpu: str = "", height: int = 0):
+    """CPU-side cache check: serve a restore without starting a GPU container
+
+    With gpu and height the clip length learned for them is tried too (see
+    cache_clip_lengths). Returns the same dict as restore_video on a hit, or
+    None on a miss.
+    """
+    output_filename = restored_name(input_filename, detection, container)
+    if not any(serve_from_cache(input_filename, output_filename,
+                                restore_params(codec, crf, detection, clip, container, ts_offset))
+               for clip in cache_clip_lengths(max_clip_length, gpu, height, detection)):
+        volume.commit()  # digest memo
+        return None
+    volume.commit()
+    return {"status": "skipped", "cache": "hit", "output": output_filename, "file": input_filename}
+
+
+class GpuMemorySampler:
+    """Background sampler recording peak GPU memory (nvidia-smi) while active
+
+    With pid set, it also tracks that process's own peak RSS (VmHWM from
+    /proc/<pid>/status), so the figure belongs to this restore alone.
+    """
+
+    def __init__(self, interval: float = 2.0):
+        import threading
+        self.interval = interval
+        self.peak_mb = 0
+        self.pid = None
+        self.peak_rss_mb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def sample_rss(self):
+        """Read the watched process's RSS high-water mark (gone once it exits)"""
+        if not self.pid:
+            return
+        try:
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        self.peak_rss_mb = max(self.peak_rss_mb, round(int(line.split()[1]) / 1024))
+                        return
+        except (OSError, ValueError, IndexError):
+            pass
+
+    def _run(self):
+        import subprocess
+        gpu = True
+        while not self._stop.is_set():
+            self.sample_rss()
+            if gpu:
+                try:
+                    result = subprocess.run(
+                        ["nvidia-smi", "--query-gpu=memory.used", "--format=csv,noheader,nounits"],
+                        capture_output=True, text=True, timeout=10
+                    )
+                    used = [int(v) for v in result.stdout.split() if v.isdigit()]
+                    if used:
+                        self.peak_mb = max(self.peak_mb, max(used))
+                except (OSError, subprocess.TimeoutExpired):
+                    gpu = False
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join(timeout=self.interval + 1)
+
+
+class RestoreMetrics:
+    """Throughput metrics for one restore, parsed from lada-cli progress output
+
+    Phases: startup (launch -> first progress line: imports, model load,
+    first detections), process (first progress -> 100%: detection and
+    restoration run concurrently inside lada, so they are not separable from
+    the log), finalize (100% -> exit: encoder flush and audio mux).
+    Only the last `log_lines` raw lines are kept.
+    """
+
+    PROGRESS_RE = re.compile(
+        r"Processing video:\s*(\d+)%(?:.*?\|\s*(\d+)/(\d+))?(?:.*?([\d.]+)\s*(?:frames|it)/s)?"
+    )
+
+    def __init__(self, label: str, log_lines: int = 200):
+        import collections
+        self.label = label
+        self.log = collections.deque(maxlen=log_lines)
+        self.launched_at = time.time()
+        self.first_progress_at = None
+        self.complete_at = None
+        self.finished_at = None
+        self.percent = 0
+        self.frames_done = 0
+        self.frames_total = 0
+        self.rates = []
+        self.peak_gpu_mb = 0
+        self.peak_rss_mb = 0
+
+    def feed(self, line: str):
+        """Record one output line; returns the progress percent for progress lines, else None"""
+        self.log.append(line)
+        match = self.PROGRESS_RE.search(line)
+        if not match:
+            return None
+        now = time.time()
+        if self.first_progress_at is None:
+            self.first_progress_at = now
+        self.percent = int(match.group(1))
+        if match.group(2):
+            self.frames_done, self.frames_total = int(match.group(2)), int(match.group(3))
+        if match.group(4):
+            self.rates.append(float(match.group(4)))
+        if self.percent >= 100 and self.complete_at is None:
+            self.complete_at = now
+        return self.percent
+
+    def finish(self, frames: int = 0):
+        self.finished_at = time.time()
+        self.first_progress_at = self.first_progress_at or self.launched_at
+        self.complete_at = self.complete_at or self.finished_at
+        if frames and not self.frames_total:
+            self.frames_total = self.frames_done = frames
+
+    def tail(self, lines: int = 20) -> str:
+        return "".join(list(self.log)[-lines:])
+
+    def as_dict(self) -> dict:
+        process_seconds = self.complete_at - self.first_progress_at
+        frames = self.frames_total or self.frames_done
+        return {
+            "frames": frames,
+            "fps": round(frames / max(process_seconds, 1e-6), 2),
+            "fps_reported": round(median(self.rates), 2),
+            "startup_seconds": round(self.first_progress_at - self.launched_at, 1),
+            "process_seconds": round(process_seconds, 1),
+            "finalize_seconds": round(self.finished_at - self.complete_at, 1),
+            "total_seconds": round(self.finished_at - self.launched_at, 1),
+            "peak_gpu_mb": self.peak_gpu_mb,
+            "peak_rss_mb": self.peak_rss_mb,
+        }
+
+
+def job_report(results: list) -> dict:
+    """Aggregate per-segment metrics into totals and throughput per GPU type"""
+    per_gpu = {}
+    for result in results:
+        metrics = result.get("metrics")
+        if not metrics:
+            continue
+        gpu = per_gpu.setdefault(result.get("gpu", "unknown"), {"segments": 0, "frames": 0, "seconds": 0.0,
+                                                                 "startup_seconds": 0.0, "peak_gpu_mb": 0})
+        gpu["segments"] += 1
+        gpu["frames"] += metrics["frames"]
+        gpu["seconds"] += metrics["total_seconds"]
+        gpu["startup_seconds"] += metrics["startup_seconds"]
+        gpu["peak_gpu_mb"] = max(gpu["peak_gpu_mb"], metrics["peak_gpu_mb"])
+    for name, gpu in per_gpu.items():
+        price = GPU_PRICES_PER_HOUR.get(gpu_class(name), 0.0)
+        gpu["cost"] = round(gpu["seconds"] / 3600 * price, 3)
+        gpu["seconds"] = round(gpu["seconds"], 1)
+        gpu["startup_seconds"] = round(gpu["startup_seconds"], 1)
+        gpu["fps"] = round(gpu["frames"] / max(gpu["seconds"], 1e-6), 2)
+    volume_io = {}
+    for result in results:
+        metrics = result.get("metrics")
+        if not metrics or "staging" not in metrics:
+            continue
+        mode = volume_io.setdefault("staged" if metrics["staging"] else "direct",
+                                    {"segments": 0, "frames": 0, "seconds": 0.0})
+        mode["segments"] += 1
+        mode["frames"] += metrics["frames"]
+        mode["seconds"] += metrics["total_seconds"] + metrics["volume_io_seconds"]
+        if metrics["staging"]:
+            mode["io_seconds"] = mode.get("io_seconds", 0.0) + metrics["volume_io_seconds"]
+    for mode in volume_io.values():
+        # 直连模式下 Volume I/O 与解码/编码交织，无法单独计时：
+        # 只有 staged 报告 io_seconds，两种模式用端到端 fps 比较
+        if "io_seconds" in mode:
+            mode["io_seconds"] = round(mode["io_seconds"], 1)
+        mode["seconds"] = round(mode["seconds"], 1)
+        mode["fps"] = round(mode["frames"] / max(mode["seconds"], 1e-6), 2)
+    return {
+        "segments": sum(g["segments"] for g in per_gpu.values()),
+        "frames": sum(g["frames"] for g in per_gpu.values()),
+        "gpu_seconds": round(sum(g["seconds"] for g in per_gpu.values()), 1),
+        "cost": round(sum(g["cost"] for g in per_gpu.values()), 3),
+        "per_gpu": per_gpu,
+        "volume_io": volume_io,
+        "retried_segments": sum(1 for r in results if r.get("attempts", 1) > 1),
+        "speculative_wins": sum(1 for r in results if r.get("speculative")),
+    }
+
+
+def write_job_report(job: str, report: dict):
+    """Save a job report to stats/jobs/<job>.json and print the per-GPU summary (caller commits)"""
+    import json
+    import os
+
+    jobs_dir = f"{VOLUME_PATH}/stats/jobs"
+    os.makedirs(jobs_dir, exist_ok=True)
+    with open(f"{jobs_dir}/{job}.json", "w") as f:
+        json.dump(report, f, indent=2)
+    for gpu, stats in report.get("per_gpu", {}).items():
+        print(f"  {gpu}: {stats['segments']} seg, {stats['frames']} frames, "
+              f"{stats['seconds'] / 60:.1f} GPU-min, {stats['fps']} fps, peak {stats['peak_gpu_mb']} MB")
+
+
+# 显存不足时依次降低 max_clip_length
+CLIP_LADDER = (900, 450, 180)
+OOM_PATTERN = re.compile(r"out of memory|OutOfMemoryError|CUBLAS_STATUS_ALLOC_FAILED|CUDNN_STATUS_ALLOC_FAILED",
+                         re.IGNORECASE)
+
+
+class LadaOutOfMemory(RuntimeError):
+    """lada ran out of GPU (or container) memory; retry with a shorter clip length"""
+
+
+def is_out_of_memory(returncode: int, log: str) -> bool:
+    # -9 / 137：容器内存耗尽被 SIGKILL
+    return bool(OOM_PATTERN.search(log)) or returncode in (-9, 137)
+
+
+def clip_ladder(start: int) -> list:
+    """max_clip_length values to try: start, then every smaller CLIP_LADDER rung"""
+    return [start] + [rung for rung in CLIP_LADDER if rung < start]
+
+
+def clip_key(gpu: str, height: int, detection: str) -> str:
+    return f"{gpu_class(gpu) or 'gpu'}_{height}p_{detection}"
+
+
+def learned_clip_length(key: str) -> int:
+    """Largest max_clip_length known to fit for this GPU/resolution/model, 0 if none"""
+    import json
+    try:
+        with open(f"{VOLUME_PATH}/stats/clip/{key}.json") as f:
+            return int(json.load(f)["max_clip_length"])
+    except (OSError, json.JSONDecodeError, KeyError, ValueError):
+        return 0
+
+
+def cache_clip_lengths(max_clip_length: int, gpu: str = "", height: int = 0, detection: str = "") -> list:
+    """Clip lengths whose cached output may answer a request for max_clip_length
+
+    Cache entries are keyed on the clip length actually used. A request is
+    served by an entry made at exactly its length, or at the shorter length
+    learned for its GPU/resolution, since that is what a GPU run would use now.
+    """
+    learned = learned_clip_length(clip_key(gpu, height, detection)) if gpu and height else 0
+    return [max_clip_length] + ([learned] if 0 < learned < max_clip_length else [])
+
+
+def record_clip_length(key: str, max_clip_length: int, oom_at: list):
+    """Remember the clip length that worked after OOM failures (caller commits)"""
+    import json
+    import os
+
+    os.makedirs(f"{VOLUME_PATH}/stats/clip", exist_ok=True)
+    with open(f"{VOLUME_PATH}/stats/clip/{key}.json", "w") as f:
+        json.dump({"max_clip_length": max_clip_length, "oom_at": oom_at, "updated": round(time.time(), 1)}, f)
+
+
+def run_lada_cli(input_path: str, output_path: str, codec: str, crf: int, detection: str,
+                 max_clip_length: int, label: str) -> RestoreMetrics:
+    """Restore one file with a lada-cli subprocess (reloads torch and models every call)"""
+    import subprocess
+
+    model_dir = MODEL_DIR
+    detection_model = DETECTION_MODELS.get(detection, DETECTION_MODELS["v4-fast"])
+
+    cmd = [
+        *LADA_CLI,
+        "--input", input_path,
+        "--output", output_path,
+        "--encoder", codec,
+        "--encoder-options", f"-crf {crf}",
+        "--max-clip-length", str(max_clip_length),
+        "--mosaic-detection-model", f"{model_dir}/{detection_model}",
+        "--mosaic-restoration-model", f"{model_dir}/{RESTORATION_MODEL}",
+    ]
+
+    print(f"Running: {' '.join(cmd)}")
+    metrics = RestoreMetrics(label)
+    with GpuMemorySampler() as sampler, subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1
+    ) as process:
+        sampler.pid = process.pid
+        last_reported = 0
+
+        for line in process.stdout:
+            pct = metrics.feed(line)
+            if pct is not None:
+                milestone = (pct // 25) * 25
+                if milestone > last_reported:
+                    last_reported = milestone
+                    print(f"  {label}: {pct}%", flush=True)
+            elif "error" in line.lower() or "failed" in line.lower():
+                print(line.strip(), flush=True)
+
+        # 进程退出前最后读一次峰值，/proc 条目在 wait() 回收后消失
+        sampler.sample_rss()
+        process.wait()
+
+        if process.returncode != 0:
+            print(f"Lada failed with return code: {process.returncode}")
+            if is_out_of_memory(process.returncode, metrics.tail(50)):
+                raise LadaOutOfMemory(f"Lada out of memory at max_clip_length={max_clip_length}: "
+                                      f"{metrics.tail(5)}")
+            raise RuntimeError(f"Lada failed: {metrics.tail()}")
+
+    metrics.peak_gpu_mb = sampler.peak_mb
+    metrics.peak_rss_mb = sampler.peak_rss_mb  # 无 /proc（Windows 本地基准测试）时为 0
+    return metrics
+
+
+SCRATCH_DIR = "/tmp/lada-scratch"
+
+
+class ScratchStager:
+    """Local-disk staging so lada never reads or writes the network volume
+
+    stage_in copies an input segment to container disk; publish copies the
+    result back under a temporary name and renames it into place, so readers
+    never see a partial output.
+    """
+
+    def __init__(self, scratch_dir: str = SCRATCH_DIR):
+        self.scratch_dir = scratch_dir
+
+    def local_path(self, kind: str, filename: str) -> str:
+        import os
+        os.makedirs(f"{self.scratch_dir}/{kind}", exist_ok=True)
+        return f"{self.scratch_dir}/{kind}/{filename}"
+
+    def stage_in(self, input_filename: str) -> tuple:
+        """(local_path, seconds spent reading the volume)"""
+        import shutil
+
+        start = time.time()
+        local = self.local_path("in", input_filename)
+        shutil.copyfile(f"{VOLUME_PATH}/input/{input_filename}", local + ".part")
+        shutil.move(local + ".part", local)
+        return local, time.time() - start
+
+    def publish(self, local_output: str, output_path: str) -> float:
+        """Copy to the volume and atomically rename into place; returns seconds"""
+        import os
+        import shutil
+
+        start = time.time()
+        # 推测执行的两个副本可能同时发布同一输出，临时名需唯一
+        part = f"{output_path}.{os.getpid()}-{int(time.time() * 1000)}.part"
+        shutil.copyfile(local_output, part)
+        os.replace(part, output_path)
+        return time.time() - start
+
+    def discard(self, input_filename: str):
+        import os
+        path = f"{self.scratch_dir}/in/{input_filename}"
+        for p in (path, path + ".part"):
+            if os.path.exists(p):
+                os.remove(p)
+
+
+# 每个容器一个 stager
+STAGER = ScratchStager()
+
+
+def restore_segment(
+    input_filename: str,
+    codec: str,
+    crf: int,
+    detection: str,
+    max_clip_length: int,
+    skip_existing: bool,
+    container: str,
+    ts_offset: float,
+    runner=run_lada_cli,
+    runner_name: str = "cli",
+    staging: bool = True,
+) -> dict:
+    """Shared body of restore_video and LadaWorker.restore (see restore_video for args)"""
+    import os
+    import subprocess
+
+    started_at = time.time()
+    cold_start = CONTAINER_STATE["calls"] == 0
+    CONTAINER_STATE["calls"] += 1
+
+    input_path = f"{VOLUME_PATH}/input/{input_filename}"
+    output_dir = f"{VOLUME_PATH}/output"
+    os.makedirs(output_dir, exist_ok=True)
+
+    name, ext = os.path.splitext(input_filename)
+    output_filename = restored_name(input_filename, detection, container)
+    output_path = f"{output_dir}/{output_filename}"
+    # 暂存模式下结果先写本地磁盘，最后一次性发布到 Volume
+    final_path = STAGER.local_path("out", output_filename) if staging else output_path
+    # TS 模式下 lada 先写本地临时文件，再带时间偏移封装为 TS
+    lada_output_path = STAGER.local_path("out", f"{name}_restored_{detection}{ext}") \
+        if container == "ts" else final_path
+
+    try:
+        if not os.path.exists(input_path):
+            # 热容器可能早于该分段上传（upload.py 预切分流水线），刷新一次再判断
+            volume.reload()
+        if not os.path.exists(input_path):
+            raise FileNotFoundError(f"Input not found: {input_path}")
+
+        params = restore_params(codec, crf, detection, max_clip_length, container, ts_offset)
+        if skip_existing and serve_from_cache(input_filename, output_filename, params):
+            volume.commit()
+            return {"status": "skipped", "cache": "hit", "output": output_filename, "file": input_filename,
+                    "started_at": started_at, "cold_start": cold_start}
+
+        io = {"staging": staging, "stage_in_seconds": 0.0, "publish_seconds": 0.0}
+        source_path = input_path
+        if staging:
+            source_path, io["stage_in_seconds"] = STAGER.stage_in(input_filename)
+
+        info = probe_video(source_path)
+        gpu = gpu_name()
+        key = clip_key(gpu, info["height"], detection)
+        learned = learned_clip_length(key)
+        clip = min(max_clip_length, learned) if learned else max_clip_length
+
+        if skip_existing and clip != max_clip_length and serve_from_cache(
+                input_filename, output_filename, restore_params(codec, crf, detection, clip, container, ts_offset)):
+            volume.commit()
+            return {"status": "skipped", "cache": "hit", "output": output_filename, "file": input_filename,
+                    "started_at": started_at, "cold_start": cold_start}
+
+        print(f"Processing: {input_filename}")
+        print(f"Detection: {detection}, Codec: {codec}, CRF: {crf}, MaxClip: {clip}"
+              + (f" (learned for {key})" if clip != max_clip_length else "") + f", Runner: {runner_name}")
+
+        oom_at = []
+        for clip in clip_ladder(clip):
+            try:
+                metrics = runner(source_path, lada_output_path, codec, crf, detection, clip, input_filename)
+                break
+            except LadaOutOfMemory as e:
+                print(f"Out of memory at max_clip_length={clip}: {e}", flush=True)
+                oom_at.append(clip)
+                if os.path.exists(lada_output_path):
+                    os.remove(lada_output_path)
+        else:
+            raise RuntimeError(f"Out of memory at every max_clip_length {oom_at}")
+        if oom_at:
+            print(f"Succeeded with max_clip_length={clip}, remembering it for {key}")
+            record_clip_length(key, clip, oom_at)
+
+        if container == "ts":
+            remux = subprocess.run(
+                ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", lada_output_path,
+                 "-map", "0", "-c", "copy", "-output_ts_offset", f"{ts_offset:.3f}",
+                 "-f", "mpegts", final_path, "-y"],
+                capture_output=True, text=True
+            )
+            os.remove(lada_output_path)
+            if remux.returncode != 0:
+                raise RuntimeError(f"TS remux failed: {remux.stderr}")
+
+        size_mb = os.path.getsize(final_path) / (1024 * 1024)
+        metrics.finish(int(info["duration"] * info["fps"]))
+        sha256 = file_digest(final_path)
+        if staging:
+            io["publish_seconds"] = STAGER.publish(final_path, output_path)
+        # 缓存按实际使用的 clip 长度登记（可能因学习值或 OOM 降级而小于请求值）
+        cache_store(restore_cache_key(input_path, restore_params(codec, crf, detection, clip, container, ts_offset)),
+                    output_path)
+        io["volume_io_seconds"] = round(io["stage_in_seconds"] + io["publish_seconds"], 2)
+        io["stage_in_seconds"] = round(io["stage_in_seconds"], 2)
+        io["publish_seconds"] = round(io["publish_seconds"], 2)
+        summary = {**metrics.as_dict(), **io, "max_clip_length": clip, "oom_retries": len(oom_at)}
+        print(f"Done: {output_filename} ({size_mb:.1f} MB, {summary['fps']:.1f} fps, "
+              f"startup {summary['startup_seconds']:.1f}s, peak GPU {summary['peak_gpu_mb']} MB)")
+        record_history(f"{name}_{detection}", {
+            "type": "segment", "file": input_filename, "detection": detection, "gpu": gpu,
+            "width": info["width"], "height": info["height"],
+            "runner": runner_name, **summary,
+        })
+        catalog_update("output", output_filename)
+        volume.commit()
+        return {"status": "success", "output": output_filename, "file": input_filename, "sha256": sha256,
+                "started_at": started_at, "cold_start": cold_start, "gpu": gpu,
+                "runner": runner_name, "startup_seconds": summary["startup_seconds"], "metrics": summary}
+    finally:
+        # 失败时同样清理本地暂存，避免热容器的 /tmp 越积越多
+        if staging:
+            STAGER.discard(input_filename)
+        for path in {final_path, lada_output_path}:
+            if path.startswith(STAGER.scratch_dir) and os.path.exists(path):
+                os.remove(path)
+
+
 @app.function(gpu="T4", volumes={VOLUME_PATH: volume}, timeout=7200)
 def restore_video(
     input_filename: str,
@@ -129,6 +1724,9 @@ def restore_video(
     detection: str = "v4-fast",
     max_clip_length: int = 900,
     skip_existing: bool = True,
+    container: str = "",
+    ts_offset: float = 0.0,
+    staging: bool = True,
 ):
     """Process single video
     
@@ -138,99 +1736,913 @@ def restore_video(
         crf: Quality (18-20 recommended, lower = better quality)
         detection: Detection model (v4-fast default, v4-accurate/v2/fast/accurate available)
         max_clip_length: Max frames per clip (900 = more stable, 180 = less memory)
-        skip_existing: Skip if output already exists
+        skip_existing: Serve from the restoration cache if the same input was
+            already restored with identical parameters and models
+        container: "ts" writes an MPEG-TS intermediate for byte-append merge
+            (default keeps the input container)
+        ts_offset: Segment start time in the source, applied to TS timestamps
+            so appended segments form one continuous stream
+        staging: Restore against local container disk and publish the result
+            to the volume with one atomic rename (False = lada reads/writes
+            the volume directly)
     """
-    import os
-    import subprocess
+    return restore_segment(input_filename, codec, crf, detection, max_clip_length, skip_existing,
+                           container, ts_offset, staging=staging)
 
-    input_path = f"{VOLUME_PATH}/input/{input_filename}"
-    output_dir = f"{VOLUME_PATH}/output"
-    os.makedirs(output_dir, exist_ok=True)
 
-    name, ext = os.path.splitext(input_filename)
-    output_filename = f"{name}_restored_{detection}{ext}"
-    output_path = f"{output_dir}/{output_filename}"
+def missing_parameters(fn, values: dict) -> list:
+    """Required parameters of fn that values does not provide"""
+    import inspect
 
-    if skip_existing and os.path.exists(output_path):
-        size_mb = os.path.getsize(output_path) / (1024 * 1024)
-        print(f"Skip (exists): {output_filename} ({size_mb:.1f} MB)")
-        return {"status": "skipped", "output": output_filename, "file": input_filename}
+    params = inspect.signature(fn).parameters
+    return [n for n, p in params.items()
+            if p.default is p.empty and p.kind in (p.POSITIONAL_OR_KEYWORD, p.KEYWORD_ONLY) and n not in values]
 
-    if not os.path.exists(input_path):
-        raise FileNotFoundError(f"Input not found: {input_path}")
 
-    print(f"Processing: {input_filename}")
-    print(f"Detection: {detection}, Codec: {codec}, CRF: {crf}, MaxClip: {max_clip_length}")
+def call_by_name(fn, values: dict):
+    """Call fn with the entries of values that match its parameter names"""
+    import inspect
 
-    model_dir = MODEL_DIR
-    detection_models = {
-        "v4-fast": "lada_mosaic_detection_model_v4_fast.pt",
-        "v4-accurate": "lada_mosaic_detection_model_v4_accurate.pt",
-        "fast": "lada_mosaic_detection_model_v3.1_fast.pt",
-        "accurate": "lada_mosaic_detection_model_v3.1_accurate.pt",
-        "v2": "lada_mosaic_detection_model_v2.pt",
+    missing = missing_parameters(fn, values)
+    if missing:
+        raise TypeError(f"{fn.__name__} needs unsupported parameters: {missing}")
+    return fn(**{n: values[n] for n in inspect.signature(fn).parameters if n in values})
+
+
+def load_lada_api():
+    """Bind lada's in-process entry points, or None if this lada version has none we recognise
+
+    lada's Python functions are not a stable interface, so they are called by
+    parameter name and anything unexpected falls back to lada-cli.
+    """
+    try:
+        import torch
+        from lada.lib.frame_restorer import load_models
+        from lada.cli.main import process_video_file
+    except Exception as e:
+        print(f"Lada Python API unavailable ({e}), using lada-cli")
+        return None
+    return {
+        "device": "cuda:0" if torch.cuda.is_available() else "cpu",
+        "load_models": load_models,
+        "process_video_file": process_video_file,
     }
-    detection_model = detection_models.get(detection, detection_models["v4-fast"])
 
-    cmd = [
-        "lada-cli",
-        "--input", input_path,
-        "--output", output_path,
-        "--encoder", codec,
-        "--encoder-options", f"-crf {crf}",
-        "--max-clip-length", str(max_clip_length),
-        "--mosaic-detection-model", f"{model_dir}/{detection_model}",
-        "--mosaic-restoration-model", f"{model_dir}/lada_mosaic_restoration_model_generic_v1.2.pth",
-    ]
 
-    print(f"Running: {' '.join(cmd)}")
-    with subprocess.Popen(
-        cmd,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1
-    ) as process:
-        output_lines = []
-        last_reported = 0
+@app.cls(gpu="T4", volumes={VOLUME_PATH: volume}, timeout=7200, scaledown_window=300)
+class LadaWorker:
+    """Warm GPU worker: torch and model weights load once per container
+
+    Segments are restored in-process through the lada Python API; containers
+    stay up for scaledown_window between segments so a queue of segments
+    reuses them. Falls back to lada-cli when the API cannot be bound.
+    """
+
+    @modal.enter()
+    def load(self):
+        start = time.time()
+        self.api = load_lada_api()
+        self.models = {}
+        if self.api:
+            try:
+                models = self.get_models("v4-fast")
+                missing = missing_parameters(self.api["process_video_file"],
+                                             self.process_args("", "", "", 0, models, 0))
+                if missing:
+                    raise TypeError(f"process_video_file needs unsupported parameters: {missing}")
+            except Exception as e:
+                print(f"Lada model load failed ({e}), using lada-cli")
+                self.api = None
+        self.model_load_seconds = round(time.time() - start, 1)
+        print(f"Worker ready in {self.model_load_seconds}s ({'api' if self.api else 'cli'})")
+
+    def get_models(self, detection: str):
+        """(detection_model, restoration_model, pad_mode), loaded on first use per detection model"""
+        if detection not in self.models:
+            detection_model = DETECTION_MODELS.get(detection, DETECTION_MODELS["v4-fast"])
+            self.models[detection] = call_by_name(self.api["load_models"], {
+                "device": self.api["device"],
+                "mosaic_restoration_model_name": "basicvsrpp-v1.2",
+                "mosaic_restoration_model_path": f"{MODEL_DIR}/{RESTORATION_MODEL}",
+                "mosaic_restoration_config_path": None,
+                "mosaic_detection_model_path": f"{MODEL_DIR}/{detection_model}",
+                "fp16": True,
+                "detect_face_mosaics": False,
+            })
+        return self.models[detection]
+
+    def process_args(self, input_path: str, output_path: str, codec: str, crf: int, models: tuple,
+                     max_clip_length: int) -> dict:
+        """Keyword arguments offered to lada's process_video_file"""
+        detection_model, restoration_model, pad_mode = models
+        return {
+            "input_path": input_path,
+            "output_path": output_path,
+            "temp_dir_path": "/tmp",
+            "device": self.api["device"],
+            "mosaic_restoration_model": restoration_model,
+            "mosaic_detection_model": detection_model,
+            "mosaic_restoration_model_name": "basicvsrpp-v1.2",
+            "preferred_pad_mode": pad_mode,
+            "max_clip_length": max_clip_length,
+            "encoder": codec,
+            "encoder_options": f"-crf {crf}",
+            "mp4_fast_start": False,
+        }
+
+    def run_in_process(self, input_path: str, output_path: str, codec: str, crf: int, detection: str,
+                       max_clip_length: int, label: str) -> dict:
+        """run_lada_cli equivalent using the already-loaded models
+
+        A detection model or lada call this API binding does not fit falls
+        back to lada-cli for the segment instead of failing it.
+        """
+        import os
+        import torch
+
+        try:
+            models = self.get_models(detection)
+        except Exception as e:
+            print(f"Lada model load failed for {detection} ({e}), using lada-cli for {label}")
+            return run_lada_cli(input_path, output_path, codec, crf, detection, max_clip_length, label)
+        metrics = RestoreMetrics(label)
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        try:
+            call_by_name(self.api["process_video_file"],
+                         self.process_args(input_path, output_path, codec, crf, models, max_clip_length))
+        except TypeError as e:
+            print(f"Lada API call failed ({e}), using lada-cli for {label}")
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            return run_lada_cli(input_path, output_path, codec, crf, detection, max_clip_length, label)
+        except Exception as e:
+            if not (isinstance(e, torch.cuda.OutOfMemoryError) or is_out_of_memory(0, str(e))):
+                raise
+            # 释放缓存后交给 restore_segment 用更短的 clip 重试
+            torch.cuda.empty_cache()
+            raise LadaOutOfMemory(f"Out of memory at max_clip_length={max_clip_length}: {e}")
+        # 模型已常驻，进程内无额外启动开销
+        metrics.first_progress_at = metrics.launched_at
+        if torch.cuda.is_available():
+            metrics.peak_gpu_mb = round(torch.cuda.max_memory_allocated() / (1024 * 1024))
+        return metrics
+
+    @modal.method()
+    def restore(
+        self,
+        input_filename: str,
+        codec: str = "h264_nvenc",
+        crf: int = 20,
+        detection: str = "v4-fast",
+        max_clip_length: int = 900,
+        skip_existing: bool = True,
+        container: str = "",
+        ts_offset: float = 0.0,
+        staging: bool = True,
+    ):
+        """Same contract as restore_video"""
+        volume.reload()
+        runner = self.run_in_process if self.api else run_lada_cli
+        result = restore_segment(input_filename, codec, crf, detection, max_clip_length, skip_existing,
+                                 container, ts_offset, runner, "api" if self.api else "cli",
+                                 staging)
+        if result.get("cold_start"):
+            result["model_load_seconds"] = self.model_load_seconds
+        return result
+
+
+def restore_function(gpu: str = DEFAULT_GPU, warm: bool = False):
+    """restore_video / LadaWorker.restore on a GPU class (with_options for non-default GPUs)"""
+    if warm:
+        worker = LadaWorker.with_options(gpu=gpu) if gpu != DEFAULT_GPU else LadaWorker
+        return worker().restore
+    return restore_video.with_options(gpu=gpu) if gpu != DEFAULT_GPU else restore_video
+
+
+QUEUE_SLOTS = 20
+QUEUE_SLOTS_KEY = "_slots"
+QUEUE_REFRESH = 15
+QUEUE_STALE = 300
+
+
+def fair_shares(jobs: dict, slots: int) -> dict:
+    """Weighted max-min fair split of GPU slots: {job_id: slots}
+
+    jobs maps job_id -> {"user", "weight", "demand", "submitted"}. Slots are
+    handed out one at a time, first to the user with the fewest slots per
+    unit of weight (a user's weight is that of their heaviest job), then
+    within that user to the job with the fewest slots per weight; ties go to
+    the earlier submission. No job gets more than its demand, so unused
+    share flows to the others. Jobs left at 0 are queued.
+    """
+    alloc = {job_id: 0 for job_id in jobs}
+    per_user = {}
+    for _ in range(max(0, int(slots))):
+        open_jobs = [j for j, job in jobs.items() if alloc[j] < job.get("demand", 0)]
+        if not open_jobs:
+            break
+        users = {}
+        for j in open_jobs:
+            user = jobs[j].get("user", "")
+            weight, first = users.get(user, (0.0, float("inf")))
+            users[user] = (max(weight, jobs[j].get("weight", 1.0)), min(first, jobs[j].get("submitted", 0)))
+        user = min(users, key=lambda u: (per_user.get(u, 0) / users[u][0], users[u][1], u))
+        job_id = min((j for j in open_jobs if jobs[j].get("user", "") == user),
+                     key=lambda j: (alloc[j] / jobs[j].get("weight", 1.0), jobs[j].get("submitted", 0), j))
+        alloc[job_id] += 1
+        per_user[user] = per_user.get(user, 0) + 1
+    return alloc
+
+
+def queue_slots() -> int:
+    """Shared GPU slot budget (set with --action queue --slots N)"""
+    try:
+        return int(job_queue.get(QUEUE_SLOTS_KEY, QUEUE_SLOTS))
+    except Exception:
+        return QUEUE_SLOTS
+
+
+def live_tickets() -> dict:
+    """Queue entries with a recent heartbeat; entries of dead jobs are removed"""
+    now = time.time()
+    jobs = {}
+    for key, entry in list(job_queue.items()):
+        if key.startswith("_"):
+            continue
+        if now - entry.get("heartbeat", 0) > QUEUE_STALE:
+            job_queue.pop(key, None)
+        else:
+            jobs[key] = entry
+    return jobs
+
+
+def queue_stats(jobs: dict, slots: int) -> dict:
+    """Queue depth, slot use and wait times of the live entries"""
+    now = time.time()
+    shares = fair_shares(jobs, slots)
+    waits = {key: round((entry.get("started") or now) - entry["submitted"], 1) for key, entry in jobs.items()}
+    users = {}
+    for key, entry in jobs.items():
+        user = users.setdefault(entry.get("user", ""), {"jobs": 0, "demand": 0, "share": 0})
+        user["jobs"] += 1
+        user["demand"] += entry.get("demand", 0)
+        user["share"] += shares[key]
+    queued = [key for key in jobs if not shares[key]]
+    return {
+        "slots": slots,
+        "slots_used": sum(shares.values()),
+        "running": len(jobs) - len(queued),
+        "depth": len(queued),
+        "max_wait_seconds": max(waits.values(), default=0),
+        "mean_wait_seconds": round(sum(waits.values()) / len(waits), 1) if waits else 0,
+        "users": users,
+        "jobs": {key: {**jobs[key], "share": shares[key], "wait_seconds": waits[key]} for key in jobs},
+    }
+
+
+class QueueTicket:
+    """One job's entry in the shared GPU queue (job_queue Dict)
+
+    Every submission path holds a ticket while it has GPU work. share()
+    returns the job's current slot count from fair_shares over all live
+    tickets; a background heartbeat keeps the entry alive, and entries of
+    jobs that died without closing expire after QUEUE_STALE seconds. There
+    is no preemption: a job over its share just stops launching segments, so
+    a newly queued urgent job gets slots as running segments finish.
+
+    priority: 0 normal, 1 high, 2 urgent, -1 low (weight 2**priority)
+    """
+
+    def __init__(self, job_id: str, user: str = "", priority: int = 0, demand: int = 1):
+        import threading
+
+        now = time.time()
+        self.key = f"{job_id}-{int(now * 1000)}"
+        self.entry = {"job": job_id, "user": user or "default", "priority": priority,
+                      "weight": 2.0 ** priority, "demand": demand, "submitted": now,
+                      "started": 0, "heartbeat": now}
+        self.stopped = threading.Event()
+        self._put()
+        self.beat = threading.Thread(target=self._heartbeat, daemon=True)
+        self.beat.start()
+
+    def _put(self):
+        try:
+            job_queue.put(self.key, self.entry)
+        except Exception as e:
+            print(f"Queue update skipped: {e}")
+
+    def _heartbeat(self):
+        while not self.stopped.wait(QUEUE_REFRESH):
+            self.entry["heartbeat"] = time.time()
+            self._put()
+
+    @property
+    def waited(self) -> float:
+        return (self.entry["started"] or time.time()) - self.entry["submitted"]
+
+    def share(self, demand: int = None) -> int:
+        """This job's slots now; a failing queue store never blocks work"""
+        if demand is not None:
+            self.entry["demand"] = demand
+        self.entry["heartbeat"] = time.time()
+        try:
+            jobs = live_tickets()
+            jobs[self.key] = self.entry
+            slots = queue_slots()
+        except Exception as e:
+            print(f"Queue unavailable ({e}), running unthrottled")
+            return max(1, self.entry["demand"])
+        share = fair_shares(jobs, slots)[self.key]
+        if share and not self.entry["started"]:
+            self.entry["started"] = round(time.time(), 1)
+            if self.waited > 1:
+                print(f"Queue: started after {self.waited:.0f}s wait", flush=True)
+        elif not share:
+            print(f"Queue: waiting ({len(jobs)} jobs sharing {slots} slots)", flush=True)
+        self._put()
+        return share
+
+    def wait(self) -> int:
+        """Block until the job has at least one slot"""
+        while True:
+            share = self.share()
+            if share:
+                return share
+            time.sleep(QUEUE_REFRESH)
+
+    def close(self):
+        self.stopped.set()
+        try:
+            job_queue.pop(self.key, None)
+        except Exception as e:
+            print(f"Queue cleanup skipped: {e}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConcurrencyController:
+    """In-flight segment limit for run_segments
+
+    Args:
+        max_parallel: Hard cap on concurrent segments (GPU quota)
+        adaptive: Adjust the limit from observed start delays
+        initial: Starting limit (defaults to max_parallel, or half of it when adaptive)
+        high_wait: Queue wait (s) above which the limit is lowered
+        low_wait: Queue wait (s) below which the limit is raised
+        ticket: QueueTicket whose fair share caps the limit (see refresh)
+    """
+
+    def __init__(self, max_parallel: int, adaptive: bool = False, initial: int = 0,
+                 high_wait: float = 180.0, low_wait: float = 30.0, ticket: QueueTicket = None):
+        self.maximum = max(1, int(max_parallel))
+        self.adaptive = adaptive
+        if not initial:
+            initial = max(1, self.maximum // 2) if adaptive else self.maximum
+        self.limit = min(max(1, int(initial)), self.maximum)
+        self.high_wait = high_wait
+        self.low_wait = low_wait
+        self.cold_start = None
+        self.queue_waits = []
+        self.ticket = ticket
+        self.share = self.maximum
+        self.refreshed = 0.0
+
+    def refresh(self, demand: int) -> int:
+        """Cap the limit at the job's fair share (re-read at most every QUEUE_REFRESH seconds)"""
+        if not self.ticket or time.time() - self.refreshed < QUEUE_REFRESH:
+            return self.limit
+        self.refreshed = time.time()
+        share = min(self.maximum, self.ticket.share(demand))
+        if share != self.share:
+            print(f"  Fair share: {share} of {self.maximum} slots", flush=True)
+        self.share = share
+        # 自适应模式从当前值继续调整，否则直接取份额
+        self.limit = min(max(self.limit, 1) if self.adaptive else self.maximum, share)
+        return self.limit
+
+    def observe(self, start_delay: float, cold: bool) -> int:
+        """Feed one submit->container-start delay, return the new limit
+
+        A cold container's delay is queue wait plus cold start; the smallest
+        cold delay seen is taken as the cold-start baseline.
+        """
+        if cold:
+            if self.cold_start is None or start_delay < self.cold_start:
+                self.cold_start = start_delay
+            queue_wait = max(0.0, start_delay - self.cold_start)
+        else:
+            queue_wait = max(0.0, start_delay)
+        self.queue_waits.append(queue_wait)
+
+        if not self.adaptive:
+            return self.limit
+        if queue_wait > self.high_wait and self.limit > 1:
+            self.limit = max(1, int(self.limit * 0.75))
+            print(f"  Queue wait {queue_wait:.0f}s, lowering parallel limit to {self.limit}", flush=True)
+        elif queue_wait < self.low_wait and self.limit < min(self.maximum, self.share):
+            self.limit += 1
+            print(f"  Queue wait {queue_wait:.0f}s, raising parallel limit to {self.limit}", flush=True)
+        return self.limit
+
+
+class CallableExecutor:
+    """Executor that runs a blocking callable(segment) on worker threads
+
+    The worker pool is sized to the controller maximum; run_segments decides
+    how many of those threads actually carry a segment. With spawned=True,
+    fn(segment) must return a Modal FunctionCall; its result is awaited on a
+    worker thread and cancel() stops the remote call too (used to drop the
+    losing copy of a speculative duplicate).
+    """
+
+    def __init__(self, fn, max_workers: int, spawned: bool = False):
+        from concurrent.futures import ThreadPoolExecutor
+        self.fn = fn
+        self.spawned = spawned
+        self.calls = {}
+        # 推测执行的副本可能超出 max_workers，线程池留出余量
+        self.pool = ThreadPoolExecutor(max_workers=max(1, max_workers) * 2)
+
+    def submit(self, segment):
+        if not self.spawned:
+            return self.pool.submit(self.fn, segment)
+        call = self.fn(segment)
+        future = self.pool.submit(call.get)
+        self.calls[future] = call
+        return future
+
+    def cancel(self, future):
+        future.cancel()
+        call = self.calls.pop(future, None)
+        if call is not None:
+            try:
+                call.cancel()
+            except Exception as e:
+                print(f"  Cancel failed: {e}", flush=True)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def modal_executor(fn, max_workers: int, *args, **kwargs) -> CallableExecutor:
+    """Executor calling a Modal function remotely as fn.spawn(segment, *args, **kwargs)"""
+    return CallableExecutor(lambda segment: fn.spawn(segment, *args, **kwargs), max_workers, spawned=True)
+
+
+def run_segments(segments, executor, controller: ConcurrencyController, frames: dict = None,
+                 retries: int = 0, backoff: float = 30.0, speculate: float = 0.0, timeout_factor: float = 0.0,
+                 min_peers: int = 3, poll_seconds: float = 15.0):
+    """Bounded scheduler: keep at most controller.limit segments in flight
+
+    Starts the next segment as soon as one finishes. `segments` may be any
+    iterable (it is consumed lazily). Yields (segment, result) in completion
+    order, once per segment; exceptions are turned into {"status": "failed"}
+    results.
+
+    Straggler handling (all off by default):
+        retries: Resubmit a failed segment up to this many times, waiting
+            backoff * 2**n seconds before attempt n+1
+        speculate: Once the queue is drained, launch a duplicate of any
+            segment running longer than speculate x the time its peers needed
+            (median seconds per frame of finished segments x its frames);
+            the first copy to succeed wins, the other is cancelled
+        timeout_factor: Cancel an attempt running longer than this multiple
+            of the peer estimate and treat it as failed (then retried)
+    """
+    from concurrent.futures import wait, FIRST_COMPLETED
+
+    frames = frames or {}
+    try:
+        total = len(segments)
+    except TypeError:
+        total = None
+    remaining = iter(segments)
+    exhausted = False
+    in_flight = {}
+    attempts = {}
+    delayed = []
+    peer_rates = []
+
+    def launch(segment, speculative=False):
+        attempts[segment] = attempts.get(segment, 0) + 1
+        in_flight[executor.submit(segment)] = {"segment": segment, "submitted": time.time(),
+                                               "speculative": speculative}
+
+    def copies(segment):
+        return [f for f, info in in_flight.items() if info["segment"] == segment]
+
+    def expected_seconds(segment):
+        if len(peer_rates) < min_peers:
+            return None
+        return median(peer_rates) * frames.get(segment, 1)
+
+    while True:
+        now = time.time()
+        if total is not None:
+            pending = total - len(attempts)
+        else:
+            pending = 0 if exhausted else controller.maximum
+        controller.refresh(len(in_flight) + len(delayed) + pending)
+        for retry in [d for d in delayed if d[0] <= now]:
+            if len(in_flight) < controller.limit:
+                delayed.remove(retry)
+                launch(retry[1])
+        while not exhausted and len(in_flight) < controller.limit:
+            try:
+                segment = next(remaining)
+            except StopIteration:
+                exhausted = True
+                break
+            launch(segment)
+
+        if exhausted and not delayed and speculate:
+            # 队列已空、有空闲额度时，为明显落后的分段启动副本
+            for info in sorted(in_flight.values(), key=lambda i: i["submitted"]):
+                expected = expected_seconds(info["segment"])
+                if len(in_flight) >= controller.limit or expected is None:
+                    break
+                if len(copies(info["segment"])) == 1 and now - info["submitted"] > speculate * expected:
+                    print(f"  Straggler {info['segment']}: {now - info['submitted']:.0f}s vs "
+                          f"~{expected:.0f}s for peers, launching a speculative copy", flush=True)
+                    launch(info["segment"], speculative=True)
+
+        if timeout_factor:
+            for future, info in list(in_flight.items()):
+                expected = expected_seconds(info["segment"])
+                if not info.get("timed_out") and expected is not None \
+                        and now - info["submitted"] > timeout_factor * expected:
+                    print(f"  Timeout {info['segment']} after {now - info['submitted']:.0f}s, cancelling",
+                          flush=True)
+                    info["timed_out"] = True
+                    executor.cancel(future)
+
+        if not in_flight and not delayed and exhausted:
+            return
+        if not in_flight:
+            # 无公平份额（排队中）时按轮询间隔重查，否则睡到下一次重试
+            due = min(d[0] for d in delayed) - time.time() if delayed else 0.0
+            time.sleep(due if due > 0 and controller.limit else poll_seconds)
+            continue
+
+        done, _ = wait(list(in_flight), timeout=poll_seconds, return_when=FIRST_COMPLETED)
+        for future in done:
+            info = in_flight.pop(future, None)
+            if info is None:
+                # 已被同一分段先完成的副本取消
+                continue
+            segment = info["segment"]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {"status": "failed", "file": segment, "error": str(e) or type(e).__name__}
+            if result.get("started_at"):
+                controller.observe(result["started_at"] - info["submitted"], result.get("cold_start", False))
+
+            others = copies(segment)
+            if result.get("status") in ("success", "skipped"):
+                peer_rates.append((time.time() - info["submitted"]) / max(frames.get(segment, 1), 1))
+                for other in others:
+                    in_flight.pop(other)
+                    executor.cancel(other)
+                result["attempts"] = attempts[segment]
+                result["speculative"] = info["speculative"]
+                yield segment, result
+            elif others:
+                # 另一个副本仍在运行，等它的结果
+                continue
+            elif attempts[segment] <= retries:
+                wait_seconds = backoff * 2 ** (attempts[segment] - 1)
+                print(f"  {segment} failed ({result.get('error', '')[:80]}), "
+                      f"retry {attempts[segment]}/{retries} in {wait_seconds:.0f}s", flush=True)
+                delayed.append((time.time() + wait_seconds, segment))
+            else:
+                result["attempts"] = attempts[segment]
+                yield segment, result
+
+
+
+
+class JobLedger:
+    """Append-only JSONL record of one job (jobs/<job_id>.jsonl)
+
+    The orchestrating container is the only writer. Replaying the events
+    gives the job parameters, the plan and each segment's latest state, so a
+    restart resumes exactly the unfinished segments without scanning
+    output/. A small <job_id>.status.json snapshot is rewritten alongside
+    for cheap status reads.
+    """
+
+    def __init__(self, job_id: str, jobs_dir: str = ""):
+        self.job_id = job_id
+        self.jobs_dir = jobs_dir or f"{VOLUME_PATH}/jobs"
+        self.path = f"{self.jobs_dir}/{job_id}.jsonl"
+        self.state = self.replay()
+
+    @staticmethod
+    def job_id_for(filename: str, params: dict) -> str:
+        """Stable id: same file + parameters -> same ledger (so re-runs resume)"""
+        import hashlib
+        import json
+        import os
+        digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode()).hexdigest()[:8]
+        return f"{os.path.splitext(filename)[0]}-{digest}"
+
+    def replay(self) -> dict:
+        import json
+        import os
+
+        state = {"job": {}, "plan": {}, "segments": {}, "merge": {}, "status": "new"}
+        if not os.path.exists(self.path):
+            return state
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    self.apply(state, json.loads(line))
+                except (json.JSONDecodeError, KeyError):
+                    continue
+        return state
+
+    @staticmethod
+    def apply(state: dict, event: dict):
+        kind = event["event"]
+        if kind == "job":
+            state["job"] = event
+        elif kind == "plan":
+            state["plan"] = event["plan"]
+            # 流式任务先记录分段结果、下载完成后才写计划：保留已有状态
+            known = state["segments"]
+            state["segments"] = {s["file"]: {"state": "pending", "attempts": 0, **known.get(s["file"], {}),
+                                             "frames": s.get("frames", 0)}
+                                 for s in event["plan"]["segments"]}
+        elif kind == "segment":
+            segment = state["segments"].setdefault(event["file"], {"attempts": 0})
+            segment.update({k: v for k, v in event.items() if k not in ("event", "file", "attempts")})
+            if event["state"] in ("done", "failed"):
+                # 一次运行内的重试次数记在事件里；续跑时累加
+                segment["attempts"] = segment.get("attempts", 0) + event.get("attempts", 1)
+        elif kind == "merge":
+            state["merge"] = event
+        elif kind == "status":
+            state["status"] = event["status"]
+            if event["status"] == "running":
+                state["running_since"] = event["time"]
+
+    def append(self, event: str, **fields):
+        """Record an event (caller commits the volume)"""
+        import json
+        import os
+
+        record = {"event": event, "time": round(time.time(), 1), **fields}
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        self.apply(self.state, record)
+        self.write_status()
+
+    def pending(self) -> list:
+        return [seg for seg, s in self.state["segments"].items() if s.get("state") != "done"]
+
+    def outputs(self) -> list:
+        """Restored segment outputs in plan order"""
+        return [self.state["segments"][s["file"]].get("output") for s in self.state["plan"].get("segments", [])]
+
+    def summary(self) -> dict:
+        segments = self.state["segments"].values()
+        counts = {}
+        for s in segments:
+            counts[s.get("state", "pending")] = counts.get(s.get("state", "pending"), 0) + 1
+        return {
+            "job_id": self.job_id,
+            "file": self.state["job"].get("file", ""),
+            "status": self.state["status"],
+            "segments": len(self.state["segments"]),
+            "states": counts,
+            "attempts": sum(s.get("attempts", 0) for s in segments),
+            "output": self.state["merge"].get("output", ""),
+            "updated": round(time.time(), 1),
+            **self.progress(),
+        }
+
+    def progress(self) -> dict:
+        """Frames done, mean per-segment fps and ETA from this run's throughput"""
+        segments = self.state["segments"].values()
+        total = sum(s.get("frames", 0) for s in segments)
+        done = [s for s in segments if s.get("state") == "done"]
+        frames_done = sum(s.get("frames", 0) for s in done)
+        since = self.state.get("running_since", 0)
+        # 只用本次运行中真正在 GPU 上完成的分段估算吞吐（排除缓存命中与上次运行）
+        restored = [s for s in done if s.get("time", 0) >= since and s.get("cache") != "hit"]
+        elapsed = time.time() - since if since else 0
+        throughput = sum(s.get("frames", 0) for s in restored) / elapsed if elapsed > 0 else 0
+        fps = [s["metrics"]["fps"] for s in restored if s.get("metrics", {}).get("fps")]
+        return {
+            "frames_done": frames_done,
+            "frames_total": total,
+            "fps": round(sum(fps) / len(fps), 2) if fps else None,
+            "eta_seconds": round((total - frames_done) / throughput) if throughput else None,
+        }
+
+    def write_status(self):
+        import json
+        summary = self.summary()
+        with open(f"{self.jobs_dir}/{self.job_id}.status.json", "w") as f:
+            json.dump(summary, f)
+        try:
+            job_registry.put(f"{self.job_id}:status", summary)
+        except Exception as e:
+            print(f"Warning: job registry update failed: {e}")
+
+
+def list_job_status(jobs_dir: str = "") -> list:
+    """All job status snapshots, newest first"""
+    import json
+    import os
+
+    jobs_dir = jobs_dir or f"{VOLUME_PATH}/jobs"
+    if not os.path.isdir(jobs_dir):
+        return []
+    snapshots = []
+    for name in os.listdir(jobs_dir):
+        if name.endswith(".status.json"):
+            try:
+                with open(f"{jobs_dir}/{name}") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                continue
+    return sorted(snapshots, key=lambda s: s.get("updated", 0), reverse=True)
+
+
+@app.function(volumes={VOLUME_PATH: volume})
+def job_status(job_id: str = ""):
+    """Ledger summary for one job (with per-segment state), or snapshots of all jobs"""
+    import os
+
+    if not job_id:
+        return list_job_status()
+    ledger = JobLedger(job_id)
+    if not os.path.exists(ledger.path):
+        return {}
+    return {**ledger.summary(), "params": ledger.state["job"].get("params", {}),
+            "url": ledger.state["job"].get("url", ""), "planned": bool(ledger.state["plan"]),
+            "segment_states": ledger.state["segments"]}
+
+
+def job_params(filename: str, segment_minutes, codec: str, crf: int, detection: str, max_clip_length: int,
+               scene: bool, container: str) -> dict:
+    """Parameters that identify a job (JobLedger.job_id_for hashes these)"""
+    if str(segment_minutes) != "auto":
+        # 10 / 10.0 / "10" 必须得到同一个 job id
+        segment_minutes = float(segment_minutes)
+        segment_minutes = int(segment_minutes) if segment_minutes.is_integer() else segment_minutes
+    return {"filename": filename, "segment_minutes": segment_minutes, "codec": codec, "crf": crf,
+            "detection": detection, "max_clip_length": max_clip_length, "scene": scene,
+            "container": container}
+
+
+def open_job(filename: str, params: dict, max_parallel: int, plan: dict = None) -> tuple:
+    """Ledger + split plan for one file, reusing the plan already in the ledger
+
+    plan: result of a split_video call the caller already ran (e.g. spawned
+    for many files at once); without it the file is split here.
+    """
+    ledger = JobLedger(JobLedger.job_id_for(filename, params))
+    print(f"Job: {ledger.job_id} ({ledger.state['status']})")
+    if not ledger.state["job"]:
+        ledger.append("job", file=filename, params=params)
+    if ledger.state["plan"]:
+        print("Using plan from job ledger")
+        plan = ledger.state["plan"]
+    elif plan:
+        ledger.append("plan", plan=plan)
+    else:
+        plan = split_video.local(filename, params["segment_minutes"], params["scene"], return_plan=True,
+                                 max_parallel=max_parallel, detection=params["detection"])
+        ledger.append("plan", plan=plan)
+    ledger.append("status", status="running")
+    return ledger, plan
+
+
+def skip_cached_segments(ledger: JobLedger, plan: dict, codec: str, crf: int, detection: str,
+                         max_clip_length: int, container: str, gpu: str = "") -> list:
+    """Unfinished segments of a job that still need a GPU; cache hits are marked done"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    starts = {s["file"]: s["start"] for s in plan["segments"]}
+    unfinished = ledger.pending()
+    clips = cache_clip_lengths(max_clip_length, gpu, plan.get("height", 0), detection)
+
+    def cached(seg):
+        return any(serve_from_cache(seg, restored_name(seg, detection, container),
+                                    restore_params(codec, crf, detection, clip, container, starts.get(seg, 0.0)))
+                   for clip in clips)
+
+    # 只检查账本中未完成的分段；按内容哈希 + 全部参数查缓存，命中的无需启动 GPU
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        hits = dict(zip(unfinished, pool.map(cached, unfinished)))
+
+    pending = []
+    for seg in unfinished:
+        if hits[seg]:
+            print(f"  Skip (cached): {seg}")
+            ledger.append("segment", file=seg, state="done", output=restored_name(seg, detection, container),
+                          cache="hit")
+        else:
+            pending.append(seg)
+    return pending
+
 
-        for line in process.stdout:
-            output_lines.append(line)
-            if "Processing video:" in line:
-                try:
-                    pct = int(line.split("%")[0].split()[-1])
-                    milestone = (pct // 25) * 25
-                    if milestone > last_reported:
-                        last_reported = milestone
-                        print(f"  {input_filename}: {pct}%", flush=True)
-                except (ValueError, IndexError):
-                    pass
-            elif "error" in line.lower() or "failed" in line.lower():
-                print(line.strip(), flush=True)
+def record_segment(ledger: JobLedger, seg: str, result: dict) -> bool:
+    """Append a restore result to the ledger; True if the segment succeeded"""
+    ok = result.get("status") in ("success", "skipped")
+    ledger.append("segment", file=seg, state="done" if ok else "failed",
+                  output=result.get("output", ""), sha256=result.get("sha256", ""),
+                  error=result.get("error", ""), metrics=result.get("metrics", {}),
+                  attempts=result.get("attempts", 1))
+    return ok
 
-        process.wait()
 
-        if process.returncode != 0:
-            print(f"Lada failed with return code: {process.returncode}")
-            raise RuntimeError(f"Lada failed: {''.join(output_lines[-20:])}")
+def merge_job(ledger: JobLedger, filename: str, detection: str, container: str) -> tuple:
+    """Merge a finished job's segment outputs; returns (merged name, seconds)
 
-    size_mb = os.path.getsize(output_path) / (1024 * 1024)
-    print(f"Done: {output_filename} ({size_mb:.1f} MB)")
-    volume.commit()
-    return {"status": "success", "output": output_filename, "file": input_filename}
+    Does not reload the volume (safe on a merge thread); the caller reloads
+    once before dispatching so the restored segments are visible.
+    """
+    import os
+
+    name, ext = os.path.splitext(filename)
+    merge_start = time.time()
+    plan = ledger.state["plan"]
+    merged = merge_segments(f"{name}_part", f"{name}_restored_{detection}{ext}",
+                            "ts" if container == "ts" else ext.lstrip("."), files=ledger.outputs(),
+                            audio=plan.get("audio", ""), audio_offset=plan.get("audio_offset", 0.0),
+                            durations=[seg["duration"] for seg in plan.get("segments", [])] or None)
+    merge_seconds = time.time() - merge_start
+    ledger.append("merge", output=merged, seconds=round(merge_seconds, 1),
+                  size=os.path.getsize(f"{VOLUME_PATH}/output/{merged}"))
+    ledger.append("status", status="success")
+    return merged, merge_seconds
 
 
 @app.function(volumes={VOLUME_PATH: volume}, timeout=3600)
 def parallel_restore(
     filename: str,
-    segment_minutes: int = 10,
+    segment_minutes: Union[int, str] = 10,
     codec: str = "h264_nvenc",
     crf: int = 20,
     detection: str = "v4-fast",
     max_clip_length: int = 900,
     max_parallel: int = 10,
+    adaptive: bool = False,
+    scene: bool = False,
+    longest_first: bool = True,
+    container: str = "mp4",
+    warm: bool = False,
+    staging: bool = True,
+    gpu: str = DEFAULT_GPU,
+    deadline_minutes: float = 0,
+    retries: int = 2,
+    speculate: float = 2.0,
+    user: str = "",
+    priority: int = 0,
 ):
-    """Parallel processing: split -> parallel restore -> merge"""
+    """Parallel processing: split -> parallel restore -> merge
+
+    segment_minutes="auto" sizes segments from duration, resolution,
+    max_parallel and recorded cold-start/fps history.
+
+    container="ts" restores segments to MPEG-TS with continuous timestamps so
+    the merge is a byte append plus at most one remux.
+
+    warm=True sends segments to LadaWorker containers that keep the models
+    loaded, instead of one lada-cli process per segment.
+
+    staging=True (default) runs each restore against local container disk;
+    the job report compares end-to-end fps of staged and direct segments
+    and the volume I/O time of staged ones.
+
+    gpu picks the GPU class for the restore containers; "auto" lets
+    select_gpu choose the cheapest class predicted to finish within
+    deadline_minutes (0 = no deadline) from recorded per-GPU fps.
+
+    Failed segments are retried up to `retries` times with backoff. Once the
+    queue is drained, a segment running speculate x longer than its peers
+    (per frame) gets a speculative duplicate; the first copy to finish wins.
+    Attempts past 2 x speculate are cancelled. speculate=0 turns both off.
+
+    At most max_parallel segments run at once; with adaptive=True the limit
+    starts lower and follows the observed queue wait (never above max_parallel).
+    With longest_first the split plan's frame counts order the queue so the
+    biggest segments start first and do not straggle at the end.
+
+    The job holds a QueueTicket for user/priority while it restores, so the
+    limit is further capped by its fair share of the team's GPU slots.
+    """
     import os
     import time
     from tqdm import tqdm
@@ -243,88 +2655,366 @@ def parallel_restore(
     print(f"Segment: {segment_minutes} min, Max parallel: {max_parallel}")
     print("=" * 50)
 
+    params = job_params(filename, segment_minutes, codec, crf, detection, max_clip_length, scene, container)
     print("\n[1/3] Splitting video...")
-    segments = split_video.local(filename, segment_minutes)
-    
+    ledger, plan = open_job(filename, params, max_parallel)
+    volume.commit()
+    prediction = plan.get("prediction") or {}
+    gpu, gpu_selection = resolve_gpu(gpu, plan, max_parallel, detection, deadline_minutes)
+    segments = [s["file"] for s in plan["segments"]]
+    frames = {s["file"]: s["frames"] for s in plan["segments"]}
+    starts = {s["file"]: s["start"] for s in plan["segments"]}
+
     if len(segments) == 1 and segments[0] == filename:
         print("Video is short, processing directly...")
-        result = restore_video.remote(filename, codec, crf, detection, max_clip_length, skip_existing=False)
+        result = restore_cached.local(filename, codec, crf, detection, max_clip_length, container,
+                                      gpu=gpu, height=plan.get("height", 0))
+        if not result:
+            with QueueTicket(ledger.job_id, user, priority) as ticket:
+                ticket.wait()
+                result = restore_function(gpu, warm).remote(filename, codec, crf, detection, max_clip_length,
+                                                            True, container, 0.0, staging)
+        ledger.append("segment", file=filename, state="done", output=result["output"],
+                      sha256=result.get("sha256", ""))
+        ledger.append("merge", output=result["output"])
+        ledger.append("status", status="success")
+        volume.commit()
         return {
             "status": "success",
             "mode": "direct",
             "output": result["output"],
             "elapsed_minutes": round((time.time() - start_time) / 60, 1),
+            "prediction": prediction,
         }
 
     print(f"Split into {len(segments)} segments")
+    if prediction:
+        print(f"Predicted makespan: {prediction['makespan'] / 60:.1f} min")
 
     print(f"\n[2/3] Processing {len(segments)} segments in parallel...")
     
     volume.reload()
-    output_dir = f"{VOLUME_PATH}/output"
-    existing_files = set(os.listdir(output_dir)) if os.path.exists(output_dir) else set()
-    
-    pending_segments = []
-    for seg in segments:
-        seg_name, seg_ext = os.path.splitext(seg)
-        expected_output = f"{seg_name}_restored_{detection}{seg_ext}"
-        if expected_output in existing_files:
-            print(f"  Skip (exists): {seg}")
-        else:
-            pending_segments.append(seg)
-    
+    done_before = len(segments) - len(ledger.pending())
+    if done_before:
+        print(f"  Ledger: {done_before} segments already done")
+    pending_segments = skip_cached_segments(ledger, plan, codec, crf, detection, max_clip_length, container, gpu)
+    volume.commit()
+
+    if longest_first:
+        pending_segments.sort(key=lambda seg: frames.get(seg, 0), reverse=True)
+
     if not pending_segments:
         print("All segments already processed!")
     else:
         print(f"Pending: {len(pending_segments)}/{len(segments)} segments")
-        print(f"Starting up to {min(len(pending_segments), max_parallel)} GPU instances...")
+        print(f"Starting up to {min(len(pending_segments), max_parallel)} GPU instances"
+              + (" (adaptive)" if adaptive else "") + "...")
     
     results = []
     success_count = len(segments) - len(pending_segments)
     failed_count = 0
+    queue_wait = 0.0
 
     if pending_segments:
+        ticket = QueueTicket(ledger.job_id, user, priority, len(pending_segments))
+        controller = ConcurrencyController(min(len(pending_segments), max_parallel), adaptive=adaptive,
+                                           ticket=ticket)
+        restore = restore_function(gpu, warm)
+        executor = CallableExecutor(
+            lambda seg: restore.spawn(seg, codec, crf, detection, max_clip_length, True,
+                                      container, starts.get(seg, 0.0), staging),
+            controller.maximum,
+            spawned=True,
+        )
         with tqdm(total=len(pending_segments), desc="GPU Processing", unit="seg", ncols=80) as pbar:
-            for result in restore_video.starmap(
-                [(seg, codec, crf, detection, max_clip_length, True) for seg in pending_segments]
-            ):
+            for seg, result in run_segments(pending_segments, executor, controller, frames, retries=retries,
+                                            speculate=speculate, timeout_factor=2 * speculate):
                 results.append(result)
+                ok = record_segment(ledger, seg, result)
+                volume.commit()
                 pbar.update(1)
-                if result.get("status") in ("success", "skipped"):
+                if ok:
                     success_count += 1
                     pbar.set_postfix_str(f"{result.get('file', '')[:25]}")
                 else:
                     failed_count += 1
                     pbar.set_postfix_str(f"FAIL:{result.get('file', '')[:20]}")
-    
+        executor.shutdown()
+        queue_wait = ticket.waited
+        ticket.close()
+
+    startups = [r["startup_seconds"] for r in results if "startup_seconds" in r]
+    startup_summary = {}
+    if startups:
+        startup_summary = {
+            "runner": results[0].get("runner", "cli") if results else "cli",
+            "startup_seconds_avg": round(sum(startups) / len(startups), 1),
+            "startup_seconds_total": round(sum(startups), 1),
+            "model_load_seconds": [r["model_load_seconds"] for r in results if "model_load_seconds" in r],
+        }
+        print(f"Per-segment startup: avg {startup_summary['startup_seconds_avg']}s, "
+              f"total {startup_summary['startup_seconds_total']}s ({startup_summary['runner']})")
+
+    report = job_report(results)
+    report["startup"] = startup_summary
+    report["gpu"] = gpu
+    report["queue"] = {"user": user or "default", "priority": priority, "wait_seconds": round(queue_wait, 1)}
+    if gpu_selection:
+        report["gpu_selection"] = {k: v for k, v in gpu_selection.items() if k != "options"}
+    job = f"{name}-{int(start_time)}"
+    write_job_report(job, report)
+    volume.commit()
+
     if failed_count > 0:
+        ledger.append("status", status="partial")
+        volume.commit()
         return {
             "status": "partial",
+            "job_id": ledger.job_id,
             "success": success_count,
             "failed": failed_count,
             "results": results,
             "elapsed_minutes": round((time.time() - start_time) / 60, 1),
+            "report": report,
         }
 
     print(f"\n[3/3] Merging {len(segments)} segments...")
-    
-    restored_prefix = f"{name}_part"
-    output_name = f"{name}_restored_{detection}{ext}"
-    
-    merged = merge_videos.local(restored_prefix, output_name)
-    
+    volume.reload()
+    merged, merge_seconds = merge_job(ledger, filename, detection, container)
+
+    record_history(f"job_{name}", {
+        "type": "job", "file": filename, "segments": len(segments), "detection": detection,
+        "cold_start": round(controller.cold_start, 1) if pending_segments and controller.cold_start else None,
+        "merge_seconds_per_segment": round(merge_seconds / len(segments), 3),
+        "elapsed_seconds": round(time.time() - start_time, 1),
+        "queue_wait_seconds": round(queue_wait, 1),
+    })
+    report["merge_seconds"] = round(merge_seconds, 1)
+    report["elapsed_seconds"] = round(time.time() - start_time, 1)
+    write_job_report(job, report)
+    volume.commit()
+
     elapsed = round((time.time() - start_time) / 60, 1)
     print("\n" + "=" * 50)
-    print(f"COMPLETE: {output_name}")
+    print(f"COMPLETE: {merged}")
     print(f"Segments: {len(segments)}, Time: {elapsed} min")
     print("=" * 50)
     
     return {
         "status": "success",
         "mode": "parallel",
+        "job_id": ledger.job_id,
         "segments": len(segments),
         "output": merged,
         "elapsed_minutes": elapsed,
+        "prediction": prediction,
+        "report": report,
+    }
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=86400)
+def batch_restore(
+    pattern: str = "*",
+    segment_minutes: Union[int, str] = 10,
+    codec: str = "h264_nvenc",
+    crf: int = 20,
+    detection: str = "v4-fast",
+    max_clip_length: int = 900,
+    max_parallel: int = 10,
+    adaptive: bool = False,
+    scene: bool = False,
+    container: str = "mp4",
+    warm: bool = False,
+    staging: bool = True,
+    gpu: str = DEFAULT_GPU,
+    deadline_minutes: float = 0,
+    retries: int = 2,
+    speculate: float = 2.0,
+    user: str = "",
+    priority: int = 0,
+):
+    """Restore every input file matching a glob pattern through one shared GPU pool
+
+    All files are split first (concurrently, one split_video container per
+    file that has no plan yet), then every pending segment of every file goes
+    into a single longest-first queue, so short files fill the gaps left by
+    long ones instead of each file waiting for its own tail. A file is merged
+    as soon as its own segments are done, while the pool keeps running.
+    Each file keeps its own job ledger, so --action resume works per file.
+    With gpu="auto" the GPU class is chosen per file (resolution and length
+    differ), so one pool can mix GPU types. Retries and speculative
+    duplicates work as in parallel_restore. The whole batch is one job in
+    the shared queue.
+    """
+    import fnmatch
+    import os
+    from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+    from tqdm import tqdm
+
+    start_time = time.time()
+    volume.reload()
+    input_dir = f"{VOLUME_PATH}/input"
+    files = sorted(
+        f for f in os.listdir(input_dir)
+        if fnmatch.fnmatch(f, pattern) and not re.search(r"_part\d+\.", f)
+        and os.path.isfile(f"{input_dir}/{f}")
+    )
+    if not files:
+        raise FileNotFoundError(f"No input files match: {pattern}")
+
+    print("=" * 50)
+    print(f"BATCH RESTORE: {pattern} ({len(files)} files)")
+    print(f"Segment: {segment_minutes} min, Max parallel: {max_parallel}")
+    print("=" * 50)
+
+    print(f"\n[1/3] Splitting {len(files)} files...")
+    params = {f: job_params(f, segment_minutes, codec, crf, detection, max_clip_length, scene, container)
+              for f in files}
+    # 各文件的切分互不依赖：并发 spawn，GPU 不必等第一个长文件切完
+    splits = {f: split_video.spawn(f, segment_minutes, scene, return_plan=True, max_parallel=max_parallel,
+                                   detection=detection)
+              for f in files if not JobLedger(JobLedger.job_id_for(f, params[f])).state["plan"]}
+    plans = {f: call.get() for f, call in splits.items()}
+    if splits:
+        volume.reload()
+    jobs = {}
+    owner = {}
+    frames = {}
+    starts = {}
+    queue = []
+    for filename in files:
+        ledger, plan = open_job(filename, params[filename], max_parallel, plans.get(filename))
+        file_gpu = resolve_gpu(gpu, plan, max_parallel, detection, deadline_minutes)[0]
+        pending = skip_cached_segments(ledger, plan, codec, crf, detection, max_clip_length, container, file_gpu)
+        volume.commit()
+        segments = [s["file"] for s in plan["segments"]]
+        jobs[filename] = {
+            "ledger": ledger, "segments": len(segments), "remaining": set(pending), "failed": 0,
+            "direct": segments == [filename], "prediction": plan.get("prediction") or {},
+            "gpu": file_gpu,
+        }
+        for s in plan["segments"]:
+            owner[s["file"]] = filename
+            frames[s["file"]] = s["frames"]
+            starts[s["file"]] = s["start"]
+        queue.extend(pending)
+        print(f"  {filename}: {len(segments)} segments, {len(pending)} pending")
+
+    # 全局最长优先：所有文件的分段排进同一个队列
+    queue.sort(key=lambda seg: frames.get(seg, 0), reverse=True)
+    serial = sum(job["prediction"].get("makespan", 0) for job in jobs.values())
+    if serial:
+        print(f"Sum of per-file predicted makespans: {serial / 60:.1f} min")
+
+    def finish(filename):
+        job = jobs[filename]
+        if job["direct"]:
+            output = restored_name(filename, detection, container)
+            job["ledger"].append("merge", output=output)
+            job["ledger"].append("status", status="success")
+            return output, 0.0
+        return merge_job(job["ledger"], filename, detection, container)
+
+    # 每个合并用自己的 concat 列表，可以并行；合并主要是磁盘 I/O，限制并发数
+    merge_pool = ThreadPoolExecutor(max_workers=MERGE_WORKERS)
+    merges = {}
+    ready = [f for f, job in jobs.items() if not job["remaining"]]
+
+    def dispatch_merges(force: bool = False):
+        """Reload once on this thread, then hand every ready file to the merge pool
+
+        The reload fails while a running merge holds files open; ready files
+        then wait for the next attempt (force dispatches without it).
+        """
+        if ready and (reload_volume() or force):
+            for filename in ready:
+                merges[filename] = merge_pool.submit(finish, filename)
+            ready.clear()
+
+    dispatch_merges()
+
+    print(f"\n[2/3] Processing {len(queue)} segments from {len(files)} files in one pool...")
+    results = []
+    ticket = QueueTicket(f"batch-{int(start_time)}", user, priority, len(queue))
+    controller = ConcurrencyController(min(len(queue), max_parallel) or 1, adaptive=adaptive, ticket=ticket)
+    if queue:
+        restore = {job["gpu"]: restore_function(job["gpu"], warm) for job in jobs.values()}
+        executor = CallableExecutor(
+            lambda seg: restore[jobs[owner[seg]]["gpu"]].spawn(seg, codec, crf, detection, max_clip_length, True,
+                                                               container, starts.get(seg, 0.0), staging),
+            controller.maximum,
+            spawned=True,
+        )
+        with tqdm(total=len(queue), desc="GPU Processing", unit="seg", ncols=80) as pbar:
+            for seg, result in run_segments(queue, executor, controller, frames, retries=retries,
+                                            speculate=speculate, timeout_factor=2 * speculate):
+                results.append(result)
+                filename = owner[seg]
+                job = jobs[filename]
+                job["remaining"].discard(seg)
+                if not record_segment(job["ledger"], seg, result):
+                    job["failed"] += 1
+                    pbar.set_postfix_str(f"FAIL:{seg[:20]}")
+                elif not job["remaining"] and not job["failed"]:
+                    # 该文件的分段已全部完成，立即合并，不等其他文件
+                    print(f"\n  All segments done: {filename}, merging", flush=True)
+                    ready.append(filename)
+                volume.commit()
+                dispatch_merges()
+                pbar.update(1)
+        executor.shutdown()
+    queue_wait = ticket.waited
+    ticket.close()
+
+    while ready:
+        running = [future for future in merges.values() if not future.done()]
+        if running:
+            wait(running, return_when=FIRST_COMPLETED)
+        dispatch_merges(force=not running)
+
+    print(f"\n[3/3] Waiting for {len(merges)} merges...")
+    summary = {}
+    for filename, job in jobs.items():
+        if filename not in merges:
+            job["ledger"].append("status", status="partial")
+            summary[filename] = {"status": "partial", "job_id": job["ledger"].job_id, "failed": job["failed"]}
+            continue
+        try:
+            merged, merge_seconds = merges[filename].result()
+        except Exception as e:
+            job["ledger"].append("status", status="failed", error=str(e))
+            summary[filename] = {"status": "failed", "job_id": job["ledger"].job_id, "error": str(e)}
+            continue
+        summary[filename] = {"status": "success", "job_id": job["ledger"].job_id, "output": merged,
+                             "gpu": job["gpu"]}
+        if not job["direct"]:
+            record_history(f"job_{os.path.splitext(filename)[0]}", {
+                "type": "job", "file": filename, "segments": job["segments"], "detection": detection,
+                "cold_start": round(controller.cold_start, 1) if controller.cold_start else None,
+                "merge_seconds_per_segment": round(merge_seconds / job["segments"], 3),
+            })
+    merge_pool.shutdown()
+
+    report = job_report(results)
+    report["elapsed_seconds"] = round(time.time() - start_time, 1)
+    report["serial_predicted_seconds"] = round(serial, 1)
+    report["queue"] = {"user": user or "default", "priority": priority, "wait_seconds": round(queue_wait, 1)}
+    report["files"] = summary
+    write_job_report(f"batch-{int(start_time)}", report)
+    volume.commit()
+
+    succeeded = sum(1 for s in summary.values() if s["status"] == "success")
+    elapsed = round((time.time() - start_time) / 60, 1)
+    print("\n" + "=" * 50)
+    print(f"BATCH COMPLETE: {succeeded}/{len(files)} files, {len(queue)} segments, Time: {elapsed} min")
+    print("=" * 50)
+
+    return {
+        "status": "success" if succeeded == len(files) else "partial",
+        "files": summary,
+        "segments": len(queue),
+        "elapsed_minutes": elapsed,
+        "report": report,
     }
 
 
@@ -402,7 +3092,71 @@ def download_with_progress(url: str, output_path: str) -> int:
     return os.path.getsize(output_path)
 
 
-@app.function(gpu="T4", volumes={VOLUME_PATH: volume}, timeout=14400)
+def url_filename(url: str) -> str:
+    """Derive a volume filename from a URL path"""
+    import os
+    import urllib.parse
+    parsed = urllib.parse.urlparse(url)
+    path = urllib.parse.unquote(parsed.path)
+    return os.path.basename(path) or "video.mp4"
+
+
+def check_filename(name: str) -> str:
+    """Reject names that could leave input/ (path separators, "..")"""
+    if not name or "/" in name or "\\" in name or ".." in name:
+        raise ValueError(f"Invalid filename: {name!r}")
+    return name
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=14400)
+def ingest_url(url: str, output_name: str = ""):
+    """CPU-only ingest: download URL into input/ and commit the volume
+
+    Runs without a GPU so slow hosts no longer bill GPU time while downloading.
+    """
+    import os
+
+    input_dir = f"{VOLUME_PATH}/input"
+    os.makedirs(input_dir, exist_ok=True)
+    output_name = check_filename(output_name or url_filename(url))
+    input_path = f"{input_dir}/{output_name}"
+
+    start = time.time()
+    file_size = download_with_progress(url, input_path)
+    download_seconds = round(time.time() - start, 1)
+    print(f"Downloaded: {output_name} ({file_size / (1024*1024):.1f} MB in {download_seconds}s)")
+    catalog_update("input", output_name, "downloaded")
+    volume.commit()
+    return {
+        "file": output_name,
+        "size_mb": round(file_size / (1024 * 1024), 2),
+        "download_seconds": download_seconds,
+        # 下载阶段以前在 T4 容器内执行，这部分时间按 GPU 计费
+        "gpu_seconds_saved": download_seconds,
+    }
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=14400)
+def queued_restore(filename: str, codec: str = "h264_nvenc", crf: int = 20, detection: str = "v4-fast",
+                   max_clip_length: int = 900, user: str = "", priority: int = 0):
+    """Single-file restore_video behind the shared queue: wait for a slot, then run"""
+    with QueueTicket(filename, user, priority) as ticket:
+        ticket.wait()
+        result = restore_video.remote(filename, codec, crf, detection, max_clip_length)
+    result["queue_wait_seconds"] = round(ticket.waited, 1)
+    return result
+
+
+def restore_handoff(filename: str, codec: str, crf: int, detection: str, max_clip_length: int,
+                    parallel: bool, segment_minutes: int, max_parallel: int, user: str = "", priority: int = 0):
+    """Spawn the GPU stage for an ingested file, return the FunctionCall"""
+    if parallel:
+        return parallel_restore.spawn(filename, segment_minutes, codec, crf, detection, max_clip_length, max_parallel,
+                                      user=user, priority=priority)
+    return queued_restore.spawn(filename, codec, crf, detection, max_clip_length, user, priority)
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=14400)
 def restore_from_url(
     url: str,
     output_name: str = "",
@@ -412,58 +3166,618 @@ def restore_from_url(
     max_clip_length: int = 900,
     parallel: bool = False,
     segment_minutes: int = 10,
+    max_parallel: int = 10,
+    user: str = "",
+    priority: int = 0,
+):
+    """Download video from URL (CPU) and restore (GPU)"""
+    ingest = ingest_url.local(url, output_name)
+    print(f"Download phase: {ingest['download_seconds']}s on CPU "
+          f"(previously {ingest['gpu_seconds_saved']}s of T4 time)")
+
+    cached = None if parallel else restore_cached.local(ingest["file"], codec, crf, detection, max_clip_length)
+    if cached:
+        result = cached
+    else:
+        call = restore_handoff(ingest["file"], codec, crf, detection, max_clip_length,
+                               parallel, segment_minutes, max_parallel, user, priority)
+        result = call.get()
+    result["ingest"] = ingest
+    return result
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=14400)
+def restore_from_urls(
+    urls: list,
+    codec: str = "h264_nvenc",
+    crf: int = 20,
+    detection: str = "v4-fast",
+    max_clip_length: int = 900,
+    parallel: bool = False,
+    segment_minutes: int = 10,
+    max_parallel: int = 10,
+    user: str = "",
+    priority: int = 0,
+):
+    """Ingest several URLs concurrently, hand each file to GPU as soon as it lands"""
+    calls = []
+    ingests = []
+    for ingest in ingest_url.map(urls, order_outputs=False, return_exceptions=True):
+        if isinstance(ingest, Exception):
+            print(f"Ingest failed: {ingest}")
+            ingests.append({"status": "failed", "error": str(ingest)})
+            continue
+        ingests.append(ingest)
+        print(f"Ingested: {ingest['file']} ({ingest['download_seconds']}s), starting restore")
+        calls.append((ingest, restore_handoff(ingest["file"], codec, crf, detection, max_clip_length,
+                                              parallel, segment_minutes, max_parallel, user, priority)))
+
+    results = []
+    for ingest, call in calls:
+        try:
+            result = call.get()
+        except Exception as e:
+            result = {"status": "failed", "file": ingest["file"], "error": str(e)}
+        result["ingest"] = ingest
+        results.append(result)
+
+    download_seconds = sum(i.get("download_seconds", 0) for i in ingests)
+    print(f"Download phase: {download_seconds:.0f}s total on CPU "
+          f"(previously {download_seconds:.0f}s of T4 time, serialized per URL)")
+    return {"results": results, "ingest": ingests, "gpu_seconds_saved": download_seconds}
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=14400)
+def stream_restore_from_url(
+    url: str,
+    output_name: str = "",
+    segment_minutes: int = 10,
+    codec: str = "h264_nvenc",
+    crf: int = 20,
+    detection: str = "v4-fast",
+    max_clip_length: int = 900,
+    max_parallel: int = 10,
+    user: str = "",
+    priority: int = 0,
 ):
-    """Download video from URL and restore"""
+    """Streaming ingest: segment while downloading, restore segments as they land
+
+    The HTTP body is piped into an ffmpeg segmenter (and teed to input/ so the
+    full file is kept). Each segment is dispatched to restore_video as soon as
+    ffmpeg closes it, overlapping download, split and GPU work. Inputs that
+    cannot be demuxed from a pipe (MP4 with the moov atom at the end) fall back
+    to parallel_restore once the download completes.
+
+    Segments are video-only like split_video's; the other streams go into the
+    sidecar once the download is complete. The job uses the same ledger as
+    parallel_restore for this file, so --action resume picks it up: after the
+    download finished it resumes the ledger, before that it re-streams and
+    the restore cache serves the segments that were already restored.
+    """
     import os
-    import urllib.parse
+    import subprocess
+    import threading
+    import requests
+    from tqdm import tqdm
 
+    start_time = time.time()
+    if segment_minutes == "auto":
+        # 流式模式下载完成前不知道时长，无法自动计算分段
+        print("Streaming mode cannot size segments before the duration is known, using 10 min")
+        segment_minutes = 10
     input_dir = f"{VOLUME_PATH}/input"
     os.makedirs(input_dir, exist_ok=True)
+    output_name = check_filename(output_name or url_filename(url))
+    name, ext = os.path.splitext(output_name)
+    input_path = f"{input_dir}/{output_name}"
+    list_path = f"/tmp/{name}_segments.csv"
+    if os.path.exists(list_path):
+        os.remove(list_path)
 
-    if not output_name:
-        parsed = urllib.parse.urlparse(url)
-        path = urllib.parse.unquote(parsed.path)
-        output_name = os.path.basename(path) or "video.mp4"
+    print("=" * 50)
+    print(f"STREAMING RESTORE: {output_name}")
+    print(f"Segment: {segment_minutes} min, Max parallel: {max_parallel}")
+    print("=" * 50)
 
-    input_path = f"{input_dir}/{output_name}"
+    # 与 parallel_restore 使用同一个账本：下载完成后中断的任务直接按账本续跑
+    params = job_params(output_name, segment_minutes, codec, crf, detection, max_clip_length, False, "mp4")
+    ledger = JobLedger(JobLedger.job_id_for(output_name, params))
+    print(f"Job: {ledger.job_id} ({ledger.state['status']})")
+    if ledger.state["plan"]:
+        print("Download finished in an earlier run, resuming from the job ledger")
+        return parallel_restore.local(output_name, segment_minutes, codec, crf, detection, max_clip_length,
+                                      max_parallel, user=user, priority=priority)
+    if not ledger.state["job"]:
+        ledger.append("job", file=output_name, params=params, url=url)
+    ledger.append("status", status="running")
+
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", "pipe:0",
+           "-c", "copy", "-map", "0:v:0",
+           "-segment_time", str(segment_minutes * 60),
+           "-f", "segment", "-reset_timestamps", "1",
+           "-segment_list", list_path, "-segment_list_type", "csv",
+           f"{input_dir}/{name}_part%03d{ext}", "-y"]
+    ffmpeg = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    download = {"bytes": 0, "error": None, "seconds": 0.0}
+
+    def pump():
+        """HTTP body -> ffmpeg stdin + input file"""
+        piping = True
+        try:
+            resp = requests.get(url, stream=True, timeout=600, allow_redirects=True)
+            resp.raise_for_status()
+            with open(input_path, "wb") as f:
+                for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                    if not chunk:
+                        continue
+                    f.write(chunk)
+                    download["bytes"] += len(chunk)
+                    if piping:
+                        try:
+                            ffmpeg.stdin.write(chunk)
+                        except (BrokenPipeError, OSError):
+                            # ffmpeg 退出（例如 moov 在文件末尾），继续完整下载以便回退
+                            piping = False
+        except Exception as e:
+            download["error"] = e
+        finally:
+            download["seconds"] = time.time() - start_time
+            try:
+                ffmpeg.stdin.close()
+            except OSError:
+                pass
+
+    pump_thread = threading.Thread(target=pump, daemon=True)
+    pump_thread.start()
+
+    timing = {"first_dispatch": None}
+
+    def landed_segments():
+        """Yield segment filenames as ffmpeg finishes them"""
+        seen = 0
+        while True:
+            finished = ffmpeg.poll() is not None
+            lines = []
+            if os.path.exists(list_path):
+                with open(list_path) as f:
+                    lines = [line for line in f.read().splitlines() if line.strip()]
+            new = lines[seen:]
+            if new:
+                volume.commit()
+            for line in new:
+                seen += 1
+                if timing["first_dispatch"] is None:
+                    timing["first_dispatch"] = time.time() - start_time
+                    print(f"First segment dispatched after {timing['first_dispatch']:.1f}s", flush=True)
+                yield line.split(",")[0]
+            if finished:
+                return
+            time.sleep(2)
+
+    segments = []
+
+    def uncached_segments():
+        """Landed segments that still need a GPU; cache hits are marked done in the ledger"""
+        for segment in landed_segments():
+            segments.append(segment)
+            if restore_cached.local(segment, codec, crf, detection, max_clip_length, gpu=DEFAULT_GPU):
+                print(f"  Skip (cached): {segment}")
+                ledger.append("segment", file=segment, state="done", output=restored_name(segment, detection),
+                              cache="hit")
+                continue
+            yield segment
+
+    ticket = QueueTicket(ledger.job_id, user, priority, max_parallel)
+    controller = ConcurrencyController(max_parallel, ticket=ticket)
+    executor = modal_executor(restore_video, controller.maximum, codec, crf, detection, max_clip_length, True)
+    failed_count = 0
+    with tqdm(desc="GPU Processing", unit="seg", ncols=80) as pbar:
+        for segment, result in run_segments(uncached_segments(), executor, controller):
+            pbar.update(1)
+            if not record_segment(ledger, segment, result):
+                failed_count += 1
+                pbar.set_postfix_str(f"FAIL:{segment[:20]}")
+    executor.shutdown()
+    ticket.close()
+
+    pump_thread.join()
+    if download["error"]:
+        ledger.append("status", status="failed", error=str(download["error"]))
+        volume.commit()
+        raise RuntimeError(f"Download failed: {download['error']}")
+    print(f"Downloaded: {download['bytes'] / (1024*1024):.1f} MB in {download['seconds']:.0f}s")
+    catalog_update("input", output_name, "downloaded")
+    for segment in segments:
+        catalog_update("input", segment, "segment")
+    volume.commit()
 
-    file_size = download_with_progress(url, input_path)
-    print(f"Downloaded: {file_size / (1024*1024):.1f} MB")
+    if ffmpeg.returncode != 0 or not segments:
+        stderr = ffmpeg.stderr.read().decode(errors="replace")
+        if segments:
+            ledger.append("status", status="failed", error=stderr[-500:])
+            volume.commit()
+            raise RuntimeError(f"Streaming split failed: {stderr}")
+        print(f"Input not streamable ({stderr.strip()[:200]}), falling back to parallel restore")
+        result = parallel_restore.local(output_name, segment_minutes, codec, crf, detection, max_clip_length,
+                                        max_parallel, user=user, priority=priority)
+        result["mode"] = "stream-fallback"
+        return result
+
+    # 下载完成后才有完整计划与 sidecar；记入账本后即可按账本续跑
+    plan = plan_from_segments(input_dir, segments)
+    offset = sidecar_offset(input_path)
+    if offset is not None:
+        audio_path = f"{VOLUME_PATH}/audio/{sidecar_name(output_name)}"
+        extract_sidecar(input_path, audio_path)
+        plan.update({"audio": audio_path, "audio_offset": offset})
+    save_plan(output_name, plan)
+    ledger.append("plan", plan=plan)
     volume.commit()
 
-    if parallel:
-        result = parallel_restore.remote(output_name, segment_minutes, codec, crf, detection, max_clip_length)
+    elapsed = round((time.time() - start_time) / 60, 1)
+    if failed_count > 0:
+        ledger.append("status", status="partial")
+        volume.commit()
+        return {
+            "status": "partial",
+            "mode": "stream",
+            "job_id": ledger.job_id,
+            "success": len(segments) - failed_count,
+            "failed": failed_count,
+            "elapsed_minutes": elapsed,
+        }
+
+    print(f"\nMerging {len(segments)} segments...")
+    volume.reload()
+    merged, _ = merge_job(ledger, output_name, detection, "mp4")
+    volume.commit()
+    elapsed = round((time.time() - start_time) / 60, 1)
+    print(f"COMPLETE: {merged}, Time: {elapsed} min")
+    return {
+        "status": "success",
+        "mode": "stream",
+        "segments": len(segments),
+        "output": merged,
+        "job_id": ledger.job_id,
+        "time_to_first_gpu_seconds": round(timing["first_dispatch"], 1),
+        "download_seconds": round(download["seconds"], 1),
+        "elapsed_minutes": elapsed,
+    }
+
+
+JOB_DEFAULTS = {
+    "segment_minutes": 10, "codec": "h264_nvenc", "crf": 20, "detection": "v4-fast",
+    "max_clip_length": 900, "max_parallel": 10, "adaptive": False, "scene": False,
+    "container": "mp4", "warm": False, "gpu": DEFAULT_GPU, "deadline_minutes": 0,
+    "user": "", "priority": 0,
+}
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=86400)
+def run_job(filename: str, url: str = "", options: dict = None):
+    """Detached body of submit_job: optional CPU ingest, then parallel_restore in this container"""
+    options = {**JOB_DEFAULTS, **(options or {})}
+    if url:
+        ingest_url.local(url, filename)
+    return parallel_restore.local(
+        filename, options["segment_minutes"], options["codec"], options["crf"], options["detection"],
+        options["max_clip_length"], options["max_parallel"], options["adaptive"], options["scene"],
+        container=options["container"], warm=options["warm"], gpu=options["gpu"],
+        deadline_minutes=options["deadline_minutes"], user=options["user"], priority=options["priority"],
+    )
+
+
+def call_running(call_id: str) -> bool:
+    """True while a spawned FunctionCall has not finished"""
+    try:
+        modal.FunctionCall.from_id(call_id).get(timeout=0)
+    except TimeoutError:
+        return True
+    except Exception:
+        return False
+    return False
+
+
+@app.function()
+@modal.fastapi_endpoint(method="POST", requires_proxy_auth=True)
+def submit_job(request: dict):
+    """Start a restore job without a connected client
+
+    Requires a workspace proxy auth token (Modal-Key / Modal-Secret headers).
+
+    Body: {"filename": ...} or {"url": ..., "filename": optional name}, plus
+    any parallel_restore option (segment_minutes, codec, crf, detection,
+    max_clip_length, max_parallel, adaptive, scene, container, warm, gpu,
+    deadline_minutes, user, priority).
+    Returns the job id used by job_progress and cancel_job.
+    """
+    from fastapi.responses import JSONResponse
+
+    url = request.get("url", "")
+    filename = request.get("filename") or (url_filename(url) if url else "")
+    if not filename:
+        return JSONResponse({"error": "filename or url required"}, status_code=400)
+    try:
+        check_filename(filename)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    unknown = set(request) - set(JOB_DEFAULTS) - {"url", "filename"}
+    if unknown:
+        return JSONResponse({"error": f"Unknown options: {sorted(unknown)}"}, status_code=400)
+
+    options = {k: request.get(k, v) for k, v in JOB_DEFAULTS.items()}
+    params = job_params(filename, options["segment_minutes"], options["codec"], options["crf"],
+                        options["detection"], options["max_clip_length"], options["scene"], options["container"])
+    job_id = JobLedger.job_id_for(filename, params)
+
+    previous = job_registry.get(job_id)
+    if previous and call_running(previous["call_id"]):
+        status = job_registry.get(f"{job_id}:status", {}).get("status", "submitted")
+        return JSONResponse({"job_id": job_id, "status": status, "duplicate": True})
+
+    call = run_job.spawn(filename, url, options)
+    job_registry.put(job_id, {"call_id": call.object_id, "file": filename, "url": url, "options": options,
+                              "submitted": round(time.time(), 1)})
+    job_registry.put(f"{job_id}:status", {"job_id": job_id, "file": filename, "status": "submitted",
+                                          "updated": round(time.time(), 1)})
+    return {"job_id": job_id, "status": "submitted"}
+
+
+@app.function()
+@modal.fastapi_endpoint(method="GET")
+def queue_status():
+    """Shared GPU queue: slot use, depth, wait times and per-user shares"""
+    return queue_stats(live_tickets(), queue_slots())
+
+
+@app.function()
+@modal.fastapi_endpoint(method="GET")
+def job_progress(job_id: str):
+    """Status and progress of a submitted job (segments done, fps, ETA)
+
+    Reads the snapshot that JobLedger mirrors into the job registry, so no
+    volume access is needed.
+    """
+    from fastapi.responses import JSONResponse
+
+    submission = job_registry.get(job_id)
+    status = job_registry.get(f"{job_id}:status")
+    if not submission and not status:
+        return JSONResponse({"error": f"Unknown job: {job_id}"}, status_code=404)
+    status = dict(status or {})
+    if status.get("eta_seconds") is not None:
+        # 快照写入后已过去的时间
+        status["eta_seconds"] = max(0, round(status["eta_seconds"] - (time.time() - status["updated"])))
+    return {**status, "submitted": (submission or {}).get("submitted")}
+
+
+@app.function(volumes={VOLUME_PATH: volume})
+@modal.fastapi_endpoint(method="POST", requires_proxy_auth=True)
+def cancel_job(job_id: str):
+    """Cancel a submitted job; finished segments stay in the ledger for resume (proxy auth required)"""
+    from fastapi.responses import JSONResponse
+
+    submission = job_registry.get(job_id)
+    if not submission:
+        return JSONResponse({"error": f"Unknown job: {job_id}"}, status_code=404)
+    if not call_running(submission["call_id"]):
+        status = job_registry.get(f"{job_id}:status", {}).get("status", "")
+        return {"job_id": job_id, "status": status, "cancelled": False}
+    modal.FunctionCall.from_id(submission["call_id"]).cancel()
+
+    volume.reload()
+    ledger = JobLedger(job_id)
+    if ledger.state["job"]:
+        ledger.append("status", status="cancelled")
+        volume.commit()
     else:
-        result = restore_video.local(output_name, codec, crf, detection, max_clip_length, skip_existing=False)
-    
-    return result
+        # 仍在下载阶段，账本尚未创建
+        status = job_registry.get(f"{job_id}:status", {})
+        job_registry.put(f"{job_id}:status", {**status, "status": "cancelled", "updated": round(time.time(), 1)})
+    return {"job_id": job_id, "status": "cancelled", "cancelled": True}
 
 
-@app.function(volumes={VOLUME_PATH: volume}, timeout=3600)
+OUTPUT_INDEX = {"built": 0.0, "files": []}
+OUTPUT_INDEX_TTL = 30
+STREAM_CHUNK = 4 * 1024 * 1024
+
+
+def reload_volume() -> bool:
+    """volume.reload() that tolerates files held open by concurrent downloads"""
+    try:
+        volume.reload()
+        return True
+    except Exception as e:
+        print(f"Volume reload skipped: {e}")
+        return False
+
+
+def output_index(ttl: float = OUTPUT_INDEX_TTL) -> list:
+    """Output listing with size/mtime, rebuilt at most every ttl seconds per container"""
+    import os
+
+    if time.time() - OUTPUT_INDEX["built"] < ttl:
+        return OUTPUT_INDEX["files"]
+    reload_volume()
+    output_dir = f"{VOLUME_PATH}/output"
+    files = []
+    if os.path.isdir(output_dir):
+        with os.scandir(output_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.endswith(".part"):
+                    stat = entry.stat()
+                    files.append({"name": entry.name, "size": stat.st_size, "mtime": round(stat.st_mtime, 1)})
+    OUTPUT_INDEX.update(built=time.time(), files=sorted(files, key=lambda f: f["name"]))
+    return OUTPUT_INDEX["files"]
+
+
+def parse_range(header: str, size: int):
+    """Single "bytes=" range -> (start, end) inclusive; None to serve the whole file
+
+    Raises ValueError for an unsatisfiable range. Multi-range requests get
+    the whole file (allowed by RFC 9110).
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, _, last = spec.strip().partition("-")
+    try:
+        if not first:
+            length = int(last)
+            if length <= 0:
+                raise ValueError(header)
+            return max(0, size - length), size - 1
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        raise ValueError(header)
+    if start >= size or end < start:
+        raise ValueError(header)
+    return start, end
+
+
+def iter_file(path: str, start: int = 0, end: int = -1):
+    """Yield a byte range of a file in STREAM_CHUNK pieces (end inclusive, -1 = EOF)"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start + 1 if end >= 0 else -1
+        while remaining:
+            chunk = f.read(STREAM_CHUNK if remaining < 0 else min(STREAM_CHUNK, remaining))
+            if not chunk:
+                return
+            remaining -= len(chunk) if remaining > 0 else 0
+            yield chunk
+
+
+def follow_job_output(job_id: str, poll_seconds: float = 10):
+    """Stream a running TS job as its segments land, in plan order
+
+    TS segments carry continuous timestamps, so their concatenation is the
+    final merged file (see append_merge); a player can start on the first
+    segment while later ones are still restoring.
+    """
+    sent = 0
+    while True:
+        ledger = JobLedger(job_id)
+        segments = [s["file"] for s in ledger.state["plan"].get("segments", [])]
+        while sent < len(segments) and ledger.state["segments"][segments[sent]].get("state") == "done":
+            output = ledger.state["segments"][segments[sent]]["output"]
+            yield from iter_file(f"{VOLUME_PATH}/output/{output}")
+            sent += 1
+        if segments and sent == len(segments):
+            return
+        if ledger.state["status"] in ("partial", "failed", "cancelled"):
+            print(f"Stream of {job_id} stopped: job {ledger.state['status']}")
+            return
+        time.sleep(poll_seconds)
+        reload_volume()
+
+
+with image.imports():
+    from fastapi import Request
+
+
+@app.function(volumes={VOLUME_PATH: volume}, timeout=14400)
 @modal.fastapi_endpoint(method="GET")
-def download_file(filename: str = ""):
-    """Web endpoint to download files from volume"""
+def download_file(request: "Request", filename: str = "", offset: int = 0, limit: int = 100, job: str = "",
+                  checksum: bool = False):
+    """Web endpoint to download files from volume
+
+    Without filename: paginated output listing (name, size, mtime) served
+    from a per-container index refreshed every OUTPUT_INDEX_TTL seconds.
+    With filename: ETag/Last-Modified validators, If-None-Match (304) and
+    single Range requests (206, honouring If-Range) for parallel or resumed
+    downloads. checksum=true returns {"name", "size", "sha256"} instead of
+    the file (memoized per path/size/mtime and committed, so each file
+    version is hashed once). With job: chunked stream of a running
+    container=ts job's restored segments, in order, as they finish.
+
+    Only names inside output/ are served: filename and job must not contain
+    path separators or "..".
+    """
     import os
-    from fastapi.responses import FileResponse, JSONResponse
-    
+    from email.utils import formatdate
+    from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+
+    try:
+        if job:
+            check_filename(job)
+        if filename:
+            check_filename(filename[len("output/"):] if filename.startswith("output/") else filename)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    if job:
+        ledger = JobLedger(job)
+        if not ledger.state["job"]:
+            reload_volume()
+            ledger = JobLedger(job)
+        if not ledger.state["job"]:
+            return JSONResponse({"error": f"Unknown job: {job}"}, status_code=404)
+        if ledger.state["job"]["params"].get("container") != "ts":
+            return JSONResponse({"error": "Only container=ts jobs can be streamed while running"},
+                                status_code=409)
+        return StreamingResponse(follow_job_output(job), media_type="video/mp2t",
+                                 headers={"Content-Disposition": f'attachment; filename="{job}.ts"'})
+
     if not filename:
-        output_dir = f"{VOLUME_PATH}/output"
-        if os.path.exists(output_dir):
-            files = sorted(os.listdir(output_dir))
-            return JSONResponse({"files": files})
-        return JSONResponse({"files": []})
-    
+        files = output_index()
+        offset = max(0, offset)
+        limit = min(max(1, limit), 1000)
+        page = files[offset:offset + limit]
+        return JSONResponse({
+            "files": page,
+            "total": len(files),
+            "offset": offset,
+            "next": offset + limit if offset + limit < len(files) else None,
+        })
+
     if not filename.startswith("output/"):
         filename = f"output/{filename}"
-    
+
     file_path = f"{VOLUME_PATH}/{filename}"
+    if not os.path.exists(file_path):
+        reload_volume()
     if not os.path.exists(file_path):
         return JSONResponse({"error": f"File not found: {filename}"}, status_code=404)
-    
+
+    stat = os.stat(file_path)
+    if checksum:
+        sha256 = file_digest(file_path)
+        volume.commit()  # 摘要缓存落盘，其他容器不必重复计算
+        return JSONResponse({"name": os.path.basename(file_path), "size": stat.st_size, "sha256": sha256})
+    etag = f'"{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    media_type = "video/mp2t" if file_path.endswith(".ts") else "video/mp4"
+    headers = {"ETag": etag, "Last-Modified": last_modified, "Accept-Ranges": "bytes"}
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if if_none_match and (if_none_match.strip() == "*" or etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range", "")
+    if_range = request.headers.get("if-range", "")
+    # If-Range 不匹配说明文件已变化，忽略 Range 返回完整文件
+    if range_header and (not if_range or if_range in (etag, last_modified)):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat.st_size}"})
+        if byte_range:
+            start, end = byte_range
+            return StreamingResponse(
+                iter_file(file_path, start, end),
+                status_code=206,
+                media_type=media_type,
+                headers={**headers, "Content-Range": f"bytes {start}-{end}/{stat.st_size}",
+                         "Content-Length": str(end - start + 1)},
+            )
+
     return FileResponse(
         file_path,
         filename=os.path.basename(file_path),
-        media_type="video/mp4"
+        media_type=media_type,
+        headers=headers,
     )
 
 
@@ -477,11 +3791,27 @@ def main(
     detection: str = "v4-fast",
     max_clip: int = 900,
     pattern: str = "",
-    segment: int = 10,
+    segment: str = "10",
     prefix: str = "",
     output: str = "",
     parallel: bool = False,
     max_parallel: int = 10,
+    adaptive: bool = False,
+    stream: bool = False,
+    container: str = "mp4",
+    warm: bool = False,
+    job: str = "",
+    gpu: str = "T4",
+    deadline: float = 0,
+    history_file: str = "",
+    status: str = "",
+    min_mb: float = 0,
+    limit: int = 0,
+    offset: int = 0,
+    refresh: bool = False,
+    user: str = "",
+    priority: int = 0,
+    slots: int = 0,
 ):
     """
     Lada Modal CLI v7 DEV - Docker Based with v4 Models
@@ -490,30 +3820,48 @@ def main(
     
     Examples:
         modal run lada_modal_v7_dev.py --url "http://..." --parallel
+        modal run lada_modal_v7_dev.py --url "http://a.mp4 http://b.mp4" --parallel
+        modal run lada_modal_v7_dev.py --url "http://..." --stream
         modal run lada_modal_v7_dev.py --action parallel --filename video.mp4
+        modal run lada_modal_v7_dev.py --action parallel --filename video.mp4 --max-parallel 20 --adaptive
+        modal run lada_modal_v7_dev.py --action parallel --filename video.mp4 --segment auto
+        modal run lada_modal_v7_dev.py --action parallel --filename video.mp4 --container ts
+        modal run lada_modal_v7_dev.py --action parallel --filename video.mp4 --warm
+        modal run lada_modal_v7_dev.py --action batch --pattern "*.mp4" --max-parallel 20
+        modal run lada_modal_v7_dev.py --action parallel --filename video.mp4 --gpu auto --deadline 60
+        modal run lada_modal_v7_dev.py --action predict --filename video.mp4 [--deadline 60]
+        modal run lada_modal_v7_dev.py --action predict --filename local.mp4 --history-file stats.jsonl
+        modal run lada_modal_v7_dev.py --action status [--job <job_id>]
+        modal run lada_modal_v7_dev.py --action resume --job <job_id>
+        modal run lada_modal_v7_dev.py --action list-output --status merged --min-mb 100 --limit 20
+        modal run lada_modal_v7_dev.py --action list-input --prefix movie --refresh
+        modal run lada_modal_v7_dev.py --action parallel --filename clip.mp4 --priority 2   # urgent
+        modal run lada_modal_v7_dev.py --action queue [--slots 30]
         modal run lada_modal_v7_dev.py --filename video.mp4 --detection v4-accurate
     """
+    import getpass
+    import os
     import time
     import re
     start = time.time()
+    segment = segment if segment == "auto" else float(segment)
+    user = user or getpass.getuser()
     
     if action in ("list-input", "list_input", "input"):
-        files = list_files.remote("input")
+        entries = cached_catalog("input", refresh=refresh)
+        # 编号与 --filename N 选择一致（过滤不改变编号）
+        index = {f["name"]: i for i, f in enumerate(catalog_query(entries), 1)}
         print("Input files:")
-        for i, f in enumerate(files, 1):
-            if 'size_mb' in f:
-                print(f"  [{i}] {f['name']} ({f['size_mb']} MB)")
-            else:
-                print(f"  [{i}] {f['name']}")
+        for f in catalog_query(entries, prefix, status, min_mb, 0, offset, limit):
+            print(f"  [{index[f['name']]}] {f['name']} ({f['size_mb']} MB, {f['status']})")
 
     elif action in ("list-output", "list_output", "output"):
-        files = list_files.remote("output")
+        entries = cached_catalog("output", refresh=refresh)
+        # 编号与 --filename N 选择一致（过滤不改变编号）
+        index = {f["name"]: i for i, f in enumerate(catalog_query(entries), 1)}
         print("Output files:")
-        for i, f in enumerate(files, 1):
-            if 'size_mb' in f:
-                print(f"  [{i}] {f['name']} ({f['size_mb']} MB)")
-            else:
-                print(f"  [{i}] {f['name']}")
+        for f in catalog_query(entries, prefix, status, min_mb, 0, offset, limit):
+            print(f"  [{index[f['name']]}] {f['name']} ({f['size_mb']} MB, {f['status']})")
 
     elif action == "split":
         if not filename:
@@ -524,11 +3872,11 @@ def main(
 
     elif action == "merge":
         def get_mergeable_prefixes():
-            files = list_files.remote("output")
+            files = catalog_query(cached_catalog("output", refresh=refresh))
             prefixes = {}
             for f in files:
                 name = f.get('name', '')
-                match = re.match(r'(.+_part)\d+.*\.mp4$', name)
+                match = re.match(rf'(.+_part)\d+.*\.{container}$', name)
                 if match:
                     p = match.group(1)
                     if p not in prefixes:
@@ -560,7 +3908,7 @@ def main(
                 print(f"Error: Invalid index {prefix}")
                 return
 
-        result = merge_videos.remote(prefix, output or "merged.mp4")
+        result = merge_videos.remote(prefix, output or "merged.mp4", container)
         print(f"Merged: {result}")
 
     elif action == "parallel":
@@ -568,7 +3916,7 @@ def main(
             print("Error: --filename required")
             return
         if filename.isdigit():
-            files = list_files.remote("input")
+            files = catalog_query(cached_catalog("input", refresh=refresh))
             idx = int(filename) - 1
             if 0 <= idx < len(files):
                 filename = files[idx]['name']
@@ -578,15 +3926,61 @@ def main(
                 return
         print(f"Starting parallel restore: {filename}")
         print(f"Segment: {segment} min, Max parallel: {max_parallel}, MaxClip: {max_clip}")
-        result = parallel_restore.remote(filename, segment, codec, crf, detection, max_clip, max_parallel)
+        result = parallel_restore.remote(filename, segment, codec, crf, detection, max_clip, max_parallel, adaptive,
+                                         container=container, warm=warm, gpu=gpu, deadline_minutes=deadline,
+                                         user=user, priority=priority)
+        if result.get("prediction"):
+            print(f"\nPredicted makespan: {result['prediction']['makespan'] / 60:.1f} min, "
+                  f"actual: {result.get('elapsed_minutes')} min")
         print(f"\nResult: {result}")
 
+    elif action == "batch":
+        if not pattern:
+            print("Error: --pattern required (e.g. \"*.mp4\")")
+            return
+        print(f"Starting batch restore: {pattern}")
+        print(f"Segment: {segment} min, Max parallel: {max_parallel}, MaxClip: {max_clip}")
+        result = batch_restore.remote(pattern, segment, codec, crf, detection, max_clip, max_parallel, adaptive,
+                                      container=container, warm=warm, gpu=gpu, deadline_minutes=deadline,
+                                      user=user, priority=priority)
+        for name, info in result["files"].items():
+            print(f"  {name}: {info['status']} {info.get('output', info.get('error', ''))}")
+        print(f"\nStatus: {result['status']}, {result['segments']} segments, {result['elapsed_minutes']} min")
+
+    elif action == "predict":
+        if not filename:
+            print("Error: --filename required")
+            return
+        if history_file:
+            # 离线：本地历史文件 + 本地视频（或远程探测）
+            history = load_history(history_dir=history_file)
+            info = probe_video(filename) if os.path.exists(filename) else predict_gpu.remote(filename)
+            result = select_gpu(info["duration"], info["fps"], info["height"], max_parallel, history,
+                                detection, deadline * 60)
+            print(f"History: {len(history)} records from {history_file}")
+        else:
+            result = predict_gpu.remote(filename, max_parallel, detection, deadline)
+        print(f"{'GPU':>6} {'fps':>7} {'segments':>9} {'makespan':>10} {'GPU-h':>7} {'cost':>8}")
+        for o in result["options"]:
+            print(f"{o['gpu']:>6} {o['restore_fps']:>7.1f} {o['segments']:>9} {o['makespan'] / 60:>8.1f}m "
+                  f"{o['gpu_seconds'] / 3600:>7.2f} {'$' + format(o['cost'], '.2f'):>8}")
+        print(f"\nSelected: {result['gpu']}" + ("" if result["deadline_met"] else " (no GPU meets the deadline)"))
+        return
+
     elif action == "restore":
-        if url:
-            result = restore_from_url.remote(url, filename, codec, crf, detection, max_clip, parallel, segment)
+        urls = url.split()
+        if len(urls) > 1:
+            result = restore_from_urls.remote(urls, codec, crf, detection, max_clip, parallel, segment, max_parallel,
+                                              user, priority)
+        elif url and stream:
+            result = stream_restore_from_url.remote(url, filename, segment, codec, crf, detection, max_clip,
+                                                    max_parallel, user, priority)
+        elif url:
+            result = restore_from_url.remote(url, filename, codec, crf, detection, max_clip, parallel, segment,
+                                             max_parallel, user, priority)
         elif filename:
             if filename.isdigit():
-                files = list_files.remote("input")
+                files = catalog_query(cached_catalog("input", refresh=refresh))
                 idx = int(filename) - 1
                 if 0 <= idx < len(files):
                     filename = files[idx]['name']
@@ -595,21 +3989,80 @@ def main(
                     print(f"Error: Invalid index {filename}")
                     return
             if parallel:
-                result = parallel_restore.remote(filename, segment, codec, crf, detection, max_clip, max_parallel)
+                result = parallel_restore.remote(filename, segment, codec, crf, detection, max_clip, max_parallel, adaptive,
+                                         container=container, warm=warm, gpu=gpu,
+                                         deadline_minutes=deadline, user=user, priority=priority)
             else:
-                result = restore_video.remote(filename, codec, crf, detection, max_clip, skip_existing=False)
+                result = restore_cached.remote(filename, codec, crf, detection, max_clip) or \
+                    queued_restore.remote(filename, codec, crf, detection, max_clip, user, priority)
         else:
             print("Error: --filename or --url required")
             return
         print(f"\nResult: {result}")
 
+    elif action == "status":
+        status = job_status.remote(job)
+        if not job:
+            print("Jobs:")
+            for s in status:
+                print(f"  {s['job_id']}: {s['status']} {s['states']} attempts={s['attempts']}")
+            return
+        if not status:
+            print(f"Error: Unknown job {job}")
+            return
+        print(f"Job {job}: {status['status']} {status['states']} attempts={status['attempts']}")
+        for seg, state in status["segment_states"].items():
+            print(f"  {seg}: {state.get('state')} (attempts {state.get('attempts', 0)})")
+        return
+
+    elif action == "resume":
+        status = job_status.remote(job) if job else {}
+        if not status:
+            print("Error: --job <job_id> required (see --action status)")
+            return
+        params = status["params"]
+        print(f"Resuming {job}: {status['states']}")
+        if status.get("url") and not status.get("planned"):
+            # 流式任务在下载完成前中断：重新流式下载，已修复的分段由缓存命中
+            result = stream_restore_from_url.remote(status["url"], params["filename"], params["segment_minutes"],
+                                                    params["codec"], params["crf"], params["detection"],
+                                                    params["max_clip_length"], max_parallel, user, priority)
+            print(f"\nResult: {result}")
+            return
+        result = parallel_restore.remote(
+            params["filename"], params["segment_minutes"], params["codec"], params["crf"], params["detection"],
+            params["max_clip_length"], max_parallel, adaptive, params["scene"], container=params["container"],
+            warm=warm, gpu=gpu, deadline_minutes=deadline, user=user, priority=priority,
+        )
+        print(f"\nResult: {result}")
+
+    elif action == "queue":
+        if slots:
+            job_queue.put(QUEUE_SLOTS_KEY, slots)
+            print(f"Shared GPU slots set to {slots}")
+        stats = queue_stats(live_tickets(), queue_slots())
+        print(f"Slots: {stats['slots_used']}/{stats['slots']} in use, {stats['running']} running, "
+              f"{stats['depth']} queued, wait max {stats['max_wait_seconds']:.0f}s / "
+              f"mean {stats['mean_wait_seconds']:.0f}s")
+        for name, info in sorted(stats["users"].items()):
+            print(f"  {name}: {info['jobs']} jobs, {info['share']} slots, demand {info['demand']}")
+        for key, info in sorted(stats["jobs"].items(), key=lambda item: item[1]["submitted"]):
+            print(f"    {info['job']} [{info['user']}, priority {info['priority']}] share {info['share']}/"
+                  f"{info['demand']}, waited {info['wait_seconds']:.0f}s")
+        return
+
     else:
         print(f"Unknown action: {action}")
         print("Available actions:")
         print("  restore   - Process single video (add --parallel for parallel mode)")
         print("  parallel  - Split + parallel process + merge")
+        print("  batch     - Parallel restore of all input files matching --pattern")
+        print("  predict   - Dry-run GPU choice and cost (--deadline, --history-file)")
         print("  split     - Split video into segments")
         print("  merge     - Merge segments")
+        print("  status    - Show job ledger state (--job for one job)")
+        print("  resume    - Resume unfinished segments of a job (--job)")
+        print("  queue     - Shared GPU queue: shares, depth and wait times (--slots N)")
         print("  input     - List input files")
         print("  output    - List output files")
         return
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""
+Local transfer manifest (.lada_manifest.json) shared by upload.py and download.py
+
+Per directory, records each file's sha256 memoized by (size, mtime) and, for
+uploads, the hash that was last uploaded. Downloads run on several threads,
+so every mutation of the shared dict goes through manifest_lock.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+MANIFEST = ".lada_manifest.json"
+
+manifest_lock = threading.Lock()
+
+
+def load_manifest(local_dir: Path) -> dict:
+    try:
+        with open(local_dir / MANIFEST, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(local_dir: Path, manifest: dict):
+    with manifest_lock:
+        tmp = local_dir / (MANIFEST + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp, local_dir / MANIFEST)
+
+
+def file_sha256(path: Path, manifest: dict) -> str:
+    """sha256 of a local file, memoized in the manifest by (size, mtime)"""
+    stat = path.stat()
+    stamp = [stat.st_size, int(stat.st_mtime)]
+    entry = manifest.get(path.name, {})
+    if entry.get("stamp") == stamp:
+        return entry["sha256"]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(8 * 1024 * 1024), b""):
+            digest.update(block)
+    with manifest_lock:
+        # 保留 uploaded 等其他字段，只更新摘要
+        manifest[path.name] = {**entry, "stamp": stamp, "sha256": digest.hexdigest()}
+    return digest.hexdigest()
@@ -0,0 +1,221 @@
+"""Offline tests for the pure scheduling, ledger and helper functions"""
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("modal")
+
+import lada_modal_v7_dev as pipeline  # noqa: E402
+
+
+class LocalDict(dict):
+    def put(self, key, value):
+        self[key] = value
+
+
+# fair_shares
+
+def test_fair_shares_splits_evenly_between_users():
+    jobs = {
+        "a": {"user": "alice", "weight": 1.0, "demand": 10, "submitted": 1},
+        "b": {"user": "bob", "weight": 1.0, "demand": 10, "submitted": 2},
+    }
+    assert pipeline.fair_shares(jobs, 8) == {"a": 4, "b": 4}
+
+
+def test_fair_shares_caps_at_demand_and_passes_on_the_rest():
+    jobs = {
+        "a": {"user": "alice", "weight": 1.0, "demand": 2, "submitted": 1},
+        "b": {"user": "bob", "weight": 1.0, "demand": 10, "submitted": 2},
+    }
+    assert pipeline.fair_shares(jobs, 8) == {"a": 2, "b": 6}
+
+
+def test_fair_shares_weights_and_ties():
+    jobs = {
+        "a": {"user": "alice", "weight": 2.0, "demand": 10, "submitted": 2},
+        "b": {"user": "bob", "weight": 1.0, "demand": 10, "submitted": 1},
+    }
+    assert pipeline.fair_shares(jobs, 6) == {"a": 4, "b": 2}
+    # 奇数个名额：平分后多出的一个给先提交的任务
+    jobs["a"]["weight"] = 1.0
+    assert pipeline.fair_shares(jobs, 3) == {"a": 1, "b": 2}
+
+
+def test_fair_shares_splits_a_user_between_their_jobs():
+    jobs = {
+        "a1": {"user": "alice", "weight": 1.0, "demand": 10, "submitted": 1},
+        "a2": {"user": "alice", "weight": 1.0, "demand": 10, "submitted": 2},
+        "b": {"user": "bob", "weight": 1.0, "demand": 10, "submitted": 3},
+    }
+    assert pipeline.fair_shares(jobs, 8) == {"a1": 2, "a2": 2, "b": 4}
+    assert pipeline.fair_shares(jobs, 0) == {"a1": 0, "a2": 0, "b": 0}
+
+
+# balanced_cuts
+
+def test_balanced_cuts_single_segment():
+    assert pipeline.balanced_cuts([2.0, 4.0, 6.0], 8.0, 10.0) == []
+
+
+def test_balanced_cuts_near_equal_segments():
+    keyframes = [float(k) for k in range(0, 100, 2)]
+    assert pipeline.balanced_cuts(keyframes, 100.0, 25.0) == [24.0, 50.0, 74.0]
+
+
+def test_balanced_cuts_rebalances_after_a_long_gop():
+    # 第一个关键帧远超目标位置：后面的分段平分剩余时长
+    keyframes = [40.0] + [float(k) for k in range(42, 120, 2)]
+    assert pipeline.balanced_cuts(keyframes, 120.0, 30.0) == [40.0, 66.0, 92.0]
+
+
+def test_balanced_cuts_prefers_scene_cuts_within_window():
+    keyframes = [float(k) for k in range(0, 100, 2)]
+    assert pipeline.balanced_cuts(keyframes, 100.0, 50.0) == [50.0]
+    assert pipeline.balanced_cuts(keyframes, 100.0, 50.0, scene_cuts=[46.0]) == [46.0]
+    # 超出窗口的场景切点不影响选择
+    assert pipeline.balanced_cuts(keyframes, 100.0, 50.0, scene_cuts=[30.0]) == [50.0]
+
+
+# parse_range
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=500-", (500, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=0-0,10-20", None),
+    ("items=0-10", None),
+])
+def test_parse_range(header, expected):
+    assert pipeline.parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=50-10", "bytes=-0", "bytes=a-b", "bytes=-"])
+def test_parse_range_unsatisfiable(header):
+    with pytest.raises(ValueError):
+        pipeline.parse_range(header, 1000)
+
+
+# job_params
+
+def params(segment_minutes):
+    return pipeline.job_params("movie.mp4", segment_minutes, "h264", 20, "fast", 180, False, "mp4")
+
+
+def test_job_params_normalises_segment_minutes():
+    ids = {pipeline.JobLedger.job_id_for("movie.mp4", params(m)) for m in (10, 10.0, "10", "10.0")}
+    assert len(ids) == 1
+    assert ids.pop().startswith("movie-")
+    assert params("10")["segment_minutes"] == 10
+    assert params("2.5")["segment_minutes"] == 2.5
+    assert params("auto")["segment_minutes"] == "auto"
+
+
+# JobLedger
+
+def test_ledger_replay_resumes_state(tmp_path, monkeypatch):
+    monkeypatch.setattr(pipeline, "job_registry", LocalDict())
+    plan = {"segments": [{"file": "m_000.mp4", "frames": 100}, {"file": "m_001.mp4", "frames": 80}]}
+    ledger = pipeline.JobLedger("m-1234", jobs_dir=str(tmp_path))
+    assert ledger.state["status"] == "new"
+    ledger.append("job", file="m.mp4", params={"crf": 20})
+    ledger.append("plan", plan=plan)
+    ledger.append("status", status="running")
+    ledger.append("segment", file="m_000.mp4", state="done", output="out/m_000.mp4", attempts=2)
+    ledger.append("segment", file="m_001.mp4", state="failed", error="boom")
+    with open(ledger.path, "a") as f:
+        f.write("{truncated\n")
+
+    resumed = pipeline.JobLedger("m-1234", jobs_dir=str(tmp_path))
+    assert resumed.state["job"]["file"] == "m.mp4"
+    assert resumed.state["status"] == "running"
+    assert resumed.pending() == ["m_001.mp4"]
+    assert resumed.outputs() == ["out/m_000.mp4", None]
+    assert resumed.state["segments"]["m_000.mp4"]["frames"] == 100
+
+    # 续跑时尝试次数累加，重新写入计划也不会丢掉已完成的分段
+    resumed.append("plan", plan=plan)
+    resumed.append("segment", file="m_001.mp4", state="done", output="out/m_001.mp4")
+    summary = resumed.summary()
+    assert summary["states"] == {"done": 2}
+    assert summary["attempts"] == 4
+    assert pipeline.job_registry["m-1234:status"]["states"] == {"done": 2}
+    assert (tmp_path / "m-1234.status.json").exists()
+
+
+# run_segments
+
+def test_run_segments_retries_failures():
+    calls = {}
+    lock = threading.Lock()
+
+    def restore(segment):
+        with lock:
+            calls[segment] = calls.get(segment, 0) + 1
+            first = calls[segment] == 1
+        if segment == "b" and first:
+            raise RuntimeError("transient")
+        return {"status": "success"}
+
+    executor = pipeline.CallableExecutor(restore, 2)
+    try:
+        results = dict(pipeline.run_segments(["a", "b", "c"], executor, pipeline.ConcurrencyController(2),
+                                             retries=1, backoff=0.0, poll_seconds=0.05))
+    finally:
+        executor.shutdown()
+    assert {s: r["status"] for s, r in results.items()} == {"a": "success", "b": "success", "c": "success"}
+    assert results["b"]["attempts"] == 2
+    assert results["a"]["attempts"] == 1
+
+
+def test_run_segments_gives_up_after_retries():
+    def restore(segment):
+        raise RuntimeError("broken")
+
+    executor = pipeline.CallableExecutor(restore, 1)
+    try:
+        results = list(pipeline.run_segments(["a"], executor, pipeline.ConcurrencyController(1),
+                                             retries=2, backoff=0.0, poll_seconds=0.05))
+    finally:
+        executor.shutdown()
+    assert len(results) == 1
+    segment, result = results[0]
+    assert result["status"] == "failed"
+    assert "broken" in result["error"]
+    assert result["attempts"] == 3
+
+
+def test_run_segments_speculates_on_stragglers():
+    calls = {}
+    lock = threading.Lock()
+    release = threading.Event()
+
+    def restore(segment):
+        with lock:
+            calls[segment] = calls.get(segment, 0) + 1
+            first = calls[segment] == 1
+        if segment == "slow" and first:
+            release.wait(10)
+            return {"status": "success", "copy": "original"}
+        time.sleep(0.02)
+        return {"status": "success", "copy": "duplicate" if segment == "slow" else "only"}
+
+    segments = ["slow", "a", "b", "c"]
+    frames = {s: 10 for s in segments}
+    executor = pipeline.CallableExecutor(restore, 4)
+    started = time.time()
+    try:
+        results = dict(pipeline.run_segments(segments, executor, pipeline.ConcurrencyController(4),
+                                             frames=frames, speculate=2.0, min_peers=3, poll_seconds=0.05))
+    finally:
+        release.set()
+        executor.shutdown()
+    assert time.time() - started < 5
+    assert set(results) == set(segments)
+    assert results["slow"]["copy"] == "duplicate"
+    assert results["slow"]["speculative"] is True
+    assert results["slow"]["attempts"] == 2
+    assert calls["a"] == 1
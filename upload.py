@@ -6,11 +6,21 @@ Upload videos to Modal Volume
 import subprocess
 import sys
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 
+from manifest import file_sha256, load_manifest, save_manifest
+
 # Get modal.exe path from .venv312
 SCRIPT_DIR = Path(__file__).parent
 MODAL_EXE = SCRIPT_DIR / ".venv312" / "Scripts" / "modal.exe"
+sys.path.insert(0, str(SCRIPT_DIR))
+
+VOLUME_NAME = "lada-videos"
+VIDEO_EXTENSIONS = {".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv", ".webm"}
+UPLOAD_WORKERS = 4
+RETRIES = 3
 
 
 def activate_profile(profile: str):
@@ -20,14 +30,55 @@ def activate_profile(profile: str):
                       capture_output=True)
 
 
-def upload_file(local_path: str, remote_subdir: str = "input", profile: str = None):
+def remote_sizes(remote_subdir: str = "input") -> dict:
+    """{filename: size in bytes} of a volume directory (empty if it does not exist)"""
+    import json
+
+    try:
+        import modal
+        entries = modal.Volume.from_name(VOLUME_NAME).listdir(f"/{remote_subdir}")
+        return {os.path.basename(e.path): e.size for e in entries}
+    except ImportError:
+        pass
+    except Exception as e:
+        print(f"Warning: remote listing failed ({e}), uploading everything")
+        return {}
+
+    # 没有 modal Python 包时退回 CLI（--json 输出的 Size 为字节数时才可比较）
+    cmd = [str(MODAL_EXE), "volume", "ls", VOLUME_NAME, f"/{remote_subdir}", "--json"]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    try:
+        return {os.path.basename(item["Filename"]): int(item["Size"])
+                for item in json.loads(result.stdout) if item.get("Type") == "file"}
+    except (json.JSONDecodeError, KeyError, ValueError):
+        return {}
+
+
+def register_upload(local_path: Path, remote_subdir: str):
+    """Add an uploaded file to the pipeline's catalog so listings see it without a volume rescan"""
+    try:
+        import lada_modal_v7_dev as pipeline
+        stat = local_path.stat()
+        pipeline.catalog.put(f"{remote_subdir}/{local_path.name}", {
+            "name": local_path.name, "size": stat.st_size, "mtime": round(time.time(), 1),
+            "status": pipeline.catalog_status(remote_subdir, local_path.name)})
+        pipeline.catalog.put(pipeline.CATALOG_VERSION, time.time())
+    except ImportError:
+        pass
+    except Exception as e:
+        print(f"Warning: catalog not updated for {local_path.name} ({e})")
+
+
+def upload_file(local_path: str, remote_subdir: str = "input", profile: str = None, force: bool = False):
     """
     Upload single file to Modal Volume
     
     Args:
         local_path: Local file path
         remote_subdir: Volume subdirectory, default input
-        profile: Modal profile name
+        profile: Modal profile name (activated here only for single uploads;
+            upload_directory activates it once)
+        force: Overwrite an existing remote file
     """
     local_path = Path(local_path)
     
@@ -37,62 +88,227 @@ def upload_file(local_path: str, remote_subdir: str = "input", profile: str = No
     
     remote_path = f"/{remote_subdir}/{local_path.name}"
     
-    print(f"Uploading: {local_path} -> lada-videos:{remote_path}")
+    print(f"Uploading: {local_path} -> {VOLUME_NAME}:{remote_path}")
     
-    # Activate profile first
     activate_profile(profile)
     
-    cmd = [str(MODAL_EXE), "volume", "put", "lada-videos", str(local_path), remote_path]
-    result = subprocess.run(cmd)
-    
-    if result.returncode == 0:
-        print(f"Done: {local_path.name}")
-        return True
-    else:
-        print(f"Failed: {local_path.name}")
-        return False
+    cmd = [str(MODAL_EXE), "volume", "put", VOLUME_NAME, str(local_path), remote_path]
+    if force:
+        cmd.append("--force")
+
+    for attempt in range(1, RETRIES + 1):
+        result = subprocess.run(cmd, capture_output=True, text=True)
+        if result.returncode == 0:
+            print(f"Done: {local_path.name}")
+            register_upload(local_path, remote_subdir)
+            return True
+        if attempt < RETRIES:
+            print(f"Retry {attempt}/{RETRIES - 1}: {local_path.name} ({result.stderr.strip()[-200:]})")
+            time.sleep(2 ** attempt)
+    print(f"Failed: {local_path.name} ({result.stderr.strip()[-200:]})")
+    return False
+
 
+def upload_directory(local_dir: str, remote_subdir: str = "input", profile: str = None,
+                     workers: int = UPLOAD_WORKERS):
+    """Upload all video files in directory
 
-def upload_directory(local_dir: str, remote_subdir: str = "input", profile: str = None):
-    """Upload all video files in directory"""
+    Files whose remote size matches and whose local sha256 matches the one
+    recorded at the last upload (.lada_manifest.json) are skipped; the rest,
+    including files never uploaded from here, go through a pool of
+    concurrent `modal volume put` processes.
+    """
     local_dir = Path(local_dir)
     
     if not local_dir.is_dir():
         print(f"Error: Not a directory: {local_dir}")
         return
     
-    video_extensions = {".mp4", ".mkv", ".avi", ".mov", ".wmv", ".flv", ".webm"}
-    files = [f for f in local_dir.iterdir() if f.suffix.lower() in video_extensions]
+    files = sorted(f for f in local_dir.iterdir() if f.suffix.lower() in VIDEO_EXTENSIONS)
     
     if not files:
         print(f"No video files found in: {local_dir}")
         return
     
     print(f"Found {len(files)} video files")
-    
-    success = 0
+    activate_profile(profile)
+
+    remote = remote_sizes(remote_subdir)
+    manifest = load_manifest(local_dir)
+    todo, skipped = [], 0
     for f in files:
-        if upload_file(str(f), remote_subdir, profile):
-            success += 1
-    
-    print(f"\nUploaded: {success}/{len(files)}")
+        uploaded = manifest.get(f.name, {}).get("uploaded")
+        # 大小相同不代表内容相同：必须有上传记录且哈希一致才跳过
+        if remote.get(f.name) == f.stat().st_size and uploaded and uploaded == file_sha256(f, manifest):
+            print(f"Skip (unchanged): {f.name}")
+            skipped += 1
+            continue
+        todo.append(f)
+
+    start = time.time()
+    success, uploaded_bytes = 0, 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(upload_file, str(f), remote_subdir, None, f.name in remote): f for f in todo}
+        for i, future in enumerate(as_completed(futures), 1):
+            f = futures[future]
+            if future.result():
+                success += 1
+                uploaded_bytes += f.stat().st_size
+                file_sha256(f, manifest)
+                manifest[f.name]["uploaded"] = manifest[f.name]["sha256"]
+                save_manifest(local_dir, manifest)
+            mb_done = uploaded_bytes / (1024 * 1024)
+            print(f"[{i}/{len(todo)}] {mb_done:.1f} MB uploaded")
+
+    elapsed = max(time.time() - start, 1e-6)
+    mb = uploaded_bytes / (1024 * 1024)
+    print(f"\nUploaded: {success}/{len(todo)}, skipped: {skipped}, failed: {len(todo) - success}")
+    print(f"Transferred {mb:.1f} MB in {elapsed:.1f}s ({mb / elapsed:.1f} MB/s)")
+
+
+def presplit_upload(local_path: str, segment_minutes: float = 10, profile: str = None,
+                    workers: int = UPLOAD_WORKERS, codec: str = "h264_nvenc", crf: int = 20,
+                    detection: str = "v4-fast", max_clip: int = 900, max_parallel: int = 10,
+                    container: str = "mp4", user: str = "", priority: int = 0):
+    """Split locally, upload segments in order and start restoring each one as it lands
+
+    Uses the same keyframe-balanced plan and {name}_partNNN naming as
+    split_video, and uploads the plan to /plans so parallel_restore treats
+    the file as already split (the source itself is never uploaded). Once
+    every segment is restored, parallel_restore finds them all in the cache
+    and only merges. Restores are started through the shared GPU queue
+    (QueueTicket), like every other submission path. A video shorter than
+    one segment is uploaded whole and restored directly by parallel_restore.
+    """
+    import getpass
+    import json
+    import shutil
+    import tempfile
+
+    import modal
+    import lada_modal_v7_dev as pipeline
+
+    local_path = Path(local_path)
+    filename = local_path.name
+    user = user or getpass.getuser()
+    name, ext = os.path.splitext(filename)
+    activate_profile(profile)
+
+    def restore_remote():
+        """parallel_restore: restores a single-segment file, or only merges cached segments"""
+        parallel_restore = modal.Function.from_name(pipeline.app.name, "parallel_restore")
+        result = parallel_restore.remote(filename, segment_minutes, codec, crf, detection, max_clip, max_parallel,
+                                         container=container, user=user, priority=priority)
+        print(f"Result: {result.get('status')} {result.get('output', '')}")
+
+    work_dir = Path(tempfile.mkdtemp(prefix="lada_split_"))
+    try:
+        start = time.time()
+        plan = pipeline.plan_split(str(local_path), segment_minutes)
+        if len(plan["segments"]) == 1:
+            print("Video is short, uploading without splitting and restoring it directly")
+            if upload_file(str(local_path), force=filename in remote_sizes()):
+                restore_remote()
+            return
+        audio_path = work_dir / "audio" / pipeline.sidecar_name(filename)
+        plan = pipeline.split_with_audio(str(local_path), str(work_dir / f"{name}_part%03d{ext}"), plan,
+                                         str(audio_path))
+        print(f"Split into {len(plan['segments'])} segments locally in {time.time() - start:.1f}s")
+        if "audio" in plan:
+            # 音频/字幕等流只传一次，合并时由 merge_videos 封装回去
+            upload_file(str(audio_path), "audio", force=True)
+            plan["audio"] = f"{pipeline.VOLUME_PATH}/audio/{pipeline.sidecar_name(filename)}"
+
+        plan_path = work_dir / f"{filename}.json"
+        plan_path.write_text(json.dumps(plan), encoding="utf-8")
+        subprocess.run([str(MODAL_EXE), "volume", "put", VOLUME_NAME, str(plan_path),
+                        f"/plans/{filename}.json", "--force"], capture_output=True)
+
+        restore = modal.Function.from_name(pipeline.app.name, "restore_video")
+        starts = {seg["file"]: seg["start"] for seg in plan["segments"]}
+        remote = remote_sizes()
+        upload = {"bytes": 0, "failed": []}
+
+        def uploaded():
+            """Yield segments as their uploads finish (uploads keep running while GPUs are busy)"""
+            # 按顺序提交上传；每个分段一落盘就进入修复队列，后续分段继续上传
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                futures = {pool.submit(upload_file, str(work_dir / seg), "input", None, seg in remote): seg
+                           for seg in starts}
+                for future in as_completed(futures):
+                    seg = futures[future]
+                    if not future.result():
+                        upload["failed"].append(seg)
+                        continue
+                    upload["bytes"] += (work_dir / seg).stat().st_size
+                    yield seg
+            elapsed = max(time.time() - start, 1e-6)
+            mb = upload["bytes"] / (1024 * 1024)
+            print(f"Uploaded {mb:.1f} MB in {elapsed:.1f}s ({mb / elapsed:.1f} MB/s)")
+
+        ticket = pipeline.QueueTicket(filename, user, priority, len(starts))
+        controller = pipeline.ConcurrencyController(max_parallel, ticket=ticket)
+        executor = pipeline.CallableExecutor(
+            lambda seg: restore.spawn(seg, codec, crf, detection, max_clip, True, container, starts[seg]),
+            controller.maximum,
+            spawned=True,
+        )
+        failed = []
+        try:
+            for done, (seg, result) in enumerate(pipeline.run_segments(uploaded(), executor, controller), 1):
+                print(f"[{done}/{len(starts)}] {seg}: {result.get('status')} {result.get('error', '')}")
+                if result.get("status") not in ("success", "skipped"):
+                    failed.append(seg)
+        finally:
+            executor.shutdown()
+            ticket.close()
+        failed += upload["failed"]
+    finally:
+        shutil.rmtree(work_dir)
+    if failed:
+        print(f"{len(failed)} segments failed; rerun parallel restore for {filename} to retry them")
+        return
+
+    print("All segments restored, merging...")
+    restore_remote()
 
 
 def main():
     if len(sys.argv) < 2:
         print("Usage:")
-        print("  python upload.py <file_or_directory> [profile]")
+        print("  python upload.py <file_or_directory> [profile] [workers]")
         print("  python upload.py video.mp4 hcxsmyl")
         print("  python upload.py ./videos/ made54898")
+        print("  python upload.py ./videos/ made54898 8")
+        print("  python upload.py video.mp4 hcxsmyl --presplit [minutes]   # split locally, restore while uploading")
+        print("  python upload.py video.mp4 hcxsmyl --presplit --priority 2  # urgent in the shared GPU queue")
         return
     
-    path = Path(sys.argv[1])
-    profile = sys.argv[2] if len(sys.argv) > 2 else None
+    args = sys.argv[1:]
+    presplit = None
+    if "--presplit" in args:
+        i = args.index("--presplit")
+        value = args[i + 1] if i + 1 < len(args) else ""
+        presplit = float(value) if value.replace(".", "", 1).isdigit() else 10.0
+        del args[i:i + 2 if value.replace(".", "", 1).isdigit() else i + 1]
+
+    priority = 0
+    if "--priority" in args:
+        i = args.index("--priority")
+        priority = int(args[i + 1])
+        del args[i:i + 2]
+
+    path = Path(args[0])
+    profile = args[1] if len(args) > 1 else None
+    workers = int(args[2]) if len(args) > 2 else UPLOAD_WORKERS
     
-    if path.is_file():
-        upload_file(str(path), profile=profile)
+    if path.is_file() and presplit:
+        presplit_upload(str(path), presplit, profile, workers, priority=priority)
+    elif path.is_file():
+        activate_profile(profile)
+        upload_file(str(path), force=path.name in remote_sizes())
     elif path.is_dir():
-        upload_directory(str(path), profile=profile)
+        upload_directory(str(path), profile=profile, workers=workers)
     else:
         print(f"Error: Path not found: {path}")
 